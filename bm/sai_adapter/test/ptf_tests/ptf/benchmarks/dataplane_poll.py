@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""
+Measure DataPlane.poll throughput with many ports
+
+Packets are injected directly into the DataPlane queues (no sockets are
+involved) so that the numbers only reflect queueing and dequeueing cost under
+DataPlane.cvar. Example:
+
+    python benchmarks/dataplane_poll.py --ports 64 --packets 50000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import ptf
+ptf.config.update({
+    "disable_ipv6": True, "disable_vxlan": True, "disable_erspan": True,
+    "disable_geneve": True, "disable_mpls": True, "disable_nvgre": True,
+})
+import ptf.ptfutils
+import ptf.dataplane as dataplane
+
+
+class NullPort(dataplane.DataPlanePortIface,
+               dataplane.DataPlanePacketSourceIface):
+    """
+    Port which never receives anything and discards everything sent to it
+    """
+    def __init__(self, interface_name, device_number, port_number):
+        self.rd, self.wr = os.pipe()
+
+    def __del__(self):
+        os.close(self.rd)
+        os.close(self.wr)
+
+    def fileno(self):
+        return self.rd
+
+    def get_packet_source(self):
+        return self
+
+    def send(self, packet):
+        return len(packet)
+
+
+def fill(dp, nports, npackets, pkt):
+    with dp.cvar:
+        for i in xrange(npackets):
+            dp.enqueue(0, i % nports, pkt, time.time())
+
+
+def run(dp, nports, npackets, pkt, port_number):
+    fill(dp, nports, npackets, pkt)
+    start = time.time()
+    got = 0
+    if port_number is None:
+        while dp.poll(0, None, timeout=0)[2] is not None:
+            got += 1
+    else:
+        for port in xrange(nports):
+            while dp.poll(0, port, timeout=0)[2] is not None:
+                got += 1
+    return got, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--ports", type=int, default=64)
+    parser.add_argument("--packets", type=int, default=50000)
+    args = parser.parse_args()
+
+    ptf.ptfutils.default_timeout = 0
+    dp = dataplane.DataPlane(config={
+        "platform": "benchmark",
+        "dataplane": {"portclass": NullPort},
+        "qlen": args.packets,
+    })
+    try:
+        for port in xrange(args.ports):
+            dp.port_add("null%d" % port, 0, port)
+        pkt = "\x00" * 100
+        for name, port_number in [("oldest across ports", None),
+                                  ("port by port", 0)]:
+            got, elapsed = run(dp, args.ports, args.packets, pkt, port_number)
+            print "%-20s %8d packets %8.3f s %10.0f pkts/s" % (
+                name, got, elapsed, got / elapsed)
+    finally:
+        dp.kill()
+
+
+if __name__ == "__main__":
+    main()
@@ -23,9 +23,11 @@
 import sys
 import os
 import argparse
+import errno
 import time
 import struct
 import socket
+import select
 import Queue
 try:
     import nnpy
@@ -90,6 +92,55 @@ def if_exists(iff):
 
     return iff in ifaces
 
+# From linux/netlink.h and linux/rtnetlink.h
+NETLINK_ROUTE  = 0
+RTMGRP_LINK    = 0x1
+RTM_NEWLINK    = 16
+RTM_DELLINK    = 17
+IFLA_IFNAME    = 3
+NLMSG_HDR      = struct.Struct("=LHHLL")
+IFINFOMSG      = struct.Struct("=BxHiII")
+RTATTR_HDR     = struct.Struct("=HH")
+
+def nl_align(length):
+    return (length + 3) & ~3
+
+def parse_link_events(data):
+    """
+    Parse RTM_NEWLINK / RTM_DELLINK messages received on a netlink socket
+    @retval List of (interface name, IFF_UP set)
+    """
+    events = []
+    offset = 0
+    while offset + NLMSG_HDR.size <= len(data):
+        msg_len, msg_type, _, _, _ = NLMSG_HDR.unpack_from(data, offset)
+        if msg_len < NLMSG_HDR.size:
+            break
+        end = offset + msg_len
+        if msg_type in (RTM_NEWLINK, RTM_DELLINK):
+            _, _, _, flags, _ = IFINFOMSG.unpack_from(
+                data, offset + NLMSG_HDR.size)
+            attr = offset + NLMSG_HDR.size + IFINFOMSG.size
+            while attr + RTATTR_HDR.size <= end:
+                attr_len, attr_type = RTATTR_HDR.unpack_from(data, attr)
+                if attr_len < RTATTR_HDR.size:
+                    break
+                if attr_type == IFLA_IFNAME:
+                    name = data[attr + RTATTR_HDR.size:attr + attr_len]
+                    up = msg_type == RTM_NEWLINK and (flags & IFF_UP) != 0
+                    events.append((name.rstrip("\x00"), up))
+                    break
+                attr += nl_align(attr_len)
+        offset += nl_align(msg_len)
+    return events
+
+def nn_send(sock, msg):
+    # copied from ptf.dataplane
+    try:
+        sock.send(bytearray(msg))
+    except TypeError:
+        sock.send(list(str(msg)))
+
 # Taken from ptf parser
 class ActionInterface(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
@@ -148,6 +199,10 @@ parser.add_argument(
     "--interface", "-i", type=str, dest="interfaces",
     metavar="INTERFACE", action=ActionInterface, default=[],
     help="Specify a port number and the dataplane interface to use. May be given multiple times. Example: 0-1@eth2 (use eth2 as port 1 of device 0)")
+parser.add_argument(
+    "--mode", type=str, dest="mode", choices=["threads", "epoll"],
+    default="threads",
+    help="Use one thread per interface and per device socket ('threads'), or a single thread polling all the sockets with epoll ('epoll'), which scales better with the number of interfaces")
 parser.add_argument(
     "--verbose", "-v", dest="verbose", action='store_true',
     help="Specify if you need verbose output")
@@ -177,6 +232,13 @@ logging.basicConfig(format='%(message)s')
 logger = logging.getLogger('ptf_nn_agent')
 
 class IfaceMgr(threading.Thread):
+    # maximum number of packets read from the interface before forwarding
+    # them to the nanomsg socket
+    RCV_BATCH_MAX = 64
+    # how often (in seconds) to check if the interface is up, when link
+    # events are not available
+    link_poll_interval = None
+
     def __init__(self, dev, port, iface_name, iface_rcv_buf=0, iface_snd_buf=0):
         threading.Thread.__init__(self)
         self.daemon = True
@@ -187,19 +249,42 @@ class IfaceMgr(threading.Thread):
         self.iface_name = iface_name
         self.iface_rcv_buf = iface_rcv_buf
         self.iface_snd_buf = iface_snd_buf
+        self.socket = None
+        # set by the LinkMonitor when the state of the interface changes
+        self.link_event = threading.Event()
+        self.link_event_time = None
+        self.link_up_ctr = 0
+        self.link_up_latency = 0
 
     def forward(self, p):
         # can that conflict with sniff?
         self.socket.send(p)
         self.tx_ctr += 1
 
-    def received(self, p):
-        logger.debug("IfaceMgr {}-{} ({}) received a packet".format(
-            self.dev, self.port, self.iface_name))
+    def received(self, pkts):
+        logger.debug("IfaceMgr {}-{} ({}) received {} packet(s)".format(
+            self.dev, self.port, self.iface_name, len(pkts)))
         if self.dev in nano_mgrs:
             nano_mgr = nano_mgrs[self.dev]
-            nano_mgr.forward(str(p), self.port)
-            self.rx_ctr += 1
+            nano_mgr.forward_batch(pkts, self.port)
+            self.rx_ctr += len(pkts)
+
+    def recv_batch(self, block=True):
+        """
+        Receive a packet, blocking unless 'block' is False, then whatever is
+        already queued on the socket, up to RCV_BATCH_MAX packets
+        """
+        pkts = []
+        if block:
+            pkts.append(self.socket.recv(4096))
+        while len(pkts) < self.RCV_BATCH_MAX:
+            try:
+                pkts.append(self.socket.recv(4096, socket.MSG_DONTWAIT))
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+        return pkts
 
     def get_mac(self):
         try:
@@ -212,6 +297,33 @@ class IfaceMgr(threading.Thread):
     def get_ctrs(self):
         return self.rx_ctr, self.tx_ctr
 
+    def get_link_stats(self):
+        """
+        Return the number of times the socket was opened after the link went
+        up and the time it took the last time, in microseconds
+        """
+        return self.link_up_ctr, self.link_up_latency
+
+    def link_changed(self, timestamp, up):
+        # latency is measured from the first event telling us the link is up
+        # since it was last seen down
+        if up is False:
+            self.link_event_time = None
+        elif self.link_event_time is None:
+            self.link_event_time = timestamp
+        self.link_event.set()
+
+    def wait_up(self, poll_interval=None):
+        """
+        Block until the interface is up, re-checking when the LinkMonitor
+        signals a change, or every 'poll_interval' seconds if given
+        """
+        while True:
+            self.link_event.clear()
+            if self.is_up():
+                return
+            self.link_event.wait(poll_interval)
+
     def port_up(self):
         set_if_status(self.iface_name, True)
         logger.debug("IfaceMgr {}-{} ({}) status set to UP".format(
@@ -222,37 +334,53 @@ class IfaceMgr(threading.Thread):
         logger.debug("IfaceMgr {}-{} ({}) status set to DOWN".format(
                      self.dev, self.port, self.iface_name))
 
+    def is_up(self):
+        return if_exists(self.iface_name) and get_if_status(self.iface_name)
+
+    def open_socket(self):
+        self.socket = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                                    socket.htons(0x03))
+        try:
+            if self.iface_rcv_buf != 0:
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.iface_rcv_buf)
+
+            if self.iface_snd_buf  != 0:
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.iface_snd_buf)
+
+            self.socket.bind((self.iface_name, 0))
+        except socket.error:
+            self.close_socket()
+            raise
+        self.link_up_ctr += 1
+        if self.link_event_time is not None:
+            self.link_up_latency = int(
+                (time.time() - self.link_event_time) * 1000000)
+            self.link_event_time = None
+        logger.debug("IfaceMgr {}-{} ({}) AF_PACKET socket is open".format(
+                     self.dev, self.port, self.iface_name))
+
+    def close_socket(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
     def run(self):
         # run this loop in case the interface goes down by external action
         # or the interface disappears
         while True:
             # wait until the port goes up
-            while True:
-                if if_exists(self.iface_name) and get_if_status(self.iface_name):
-                    break
-                time.sleep(1)
+            self.wait_up(self.link_poll_interval)
 
             logger.debug("IfaceMgr {}-{} ({}) status changed to UP".format(
                          self.dev, self.port, self.iface_name))
             try:
-                self.socket = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
-                                            socket.htons(0x03))
-                if self.iface_rcv_buf != 0:
-                    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.iface_rcv_buf)
-
-                if self.iface_snd_buf  != 0:
-                    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.iface_snd_buf)
-
-                self.socket.bind((self.iface_name, 0))
-                logger.debug("IfaceMgr {}-{} ({}) AF_PACKET socket is open".format(
-                             self.dev, self.port, self.iface_name))
+                self.open_socket()
                 while True:
-                    msg = self.socket.recv(4096)
-                    self.received(msg)
+                    self.received(self.recv_batch())
             except socket.error as err:
                 logger.debug("IfaceMgr {}-{} ({}) Error reading from the socket.".format(
                              self.dev, self.port, self.iface_name))
-                self.socket.close()
+                self.close_socket()
 
 
 class NanomsgMgr(threading.Thread):
@@ -263,16 +391,28 @@ class NanomsgMgr(threading.Thread):
     MSG_TYPE_PACKET_OUT = 4
     MSG_TYPE_INFO_REQ = 5
     MSG_TYPE_INFO_REP = 6
+    MSG_TYPE_PACKET_IN_BATCH = 7
+    MSG_TYPE_PACKET_OUT_BATCH = 8
+    MSG_TYPE_CTRS_SNAPSHOT = 9
 
     MSG_PORT_STATUS_UP = 0
     MSG_PORT_STATUS_DOWN = 1
 
     MSG_INFO_TYPE_HWADDR = 0
     MSG_INFO_TYPE_CTRS = 1
+    MSG_INFO_TYPE_VERSION = 2
+    MSG_INFO_TYPE_CTRS_SUBSCRIBE = 3
+    MSG_INFO_TYPE_CTRS_ALL = 4
 
     MSG_INFO_STATUS_SUCCESS = 0
     MSG_INFO_STATUS_NOT_SUPPORTED = 1
 
+    # see DataPlanePacketSourceNN in ptf.dataplane
+    PROTOCOL_VERSION = 3
+
+    # maximum number of messages handled at once in epoll mode
+    RCV_BATCH_MAX = 64
+
     def __init__(self, dev, socket_addr, nn_rcv_buf=0, nn_snd_buf=0):
         threading.Thread.__init__(self)
         self.daemon = True
@@ -284,13 +424,76 @@ class NanomsgMgr(threading.Thread):
         if nn_snd_buf != 0:
             self.socket.setsockopt(nnpy.SOL_SOCKET, nnpy.SNDBUF, nn_snd_buf)
         self.socket.bind(socket_addr)
+        # protocol version of the PTF side, which tells us about it with a
+        # MSG_INFO_TYPE_VERSION request
+        self.peer_version = 1
+        # counters are pushed when they change, at most every ctrs_period
+        # seconds, once PTF subscribed to them
+        self.ctrs_period = None
+        self.next_push = None
+        self.last_ctrs = None
+        self.pusher = None
 
     def forward(self, p, port):
         msg = struct.pack("<iii{}s".format(len(p)), self.MSG_TYPE_PACKET_OUT,
                           port, len(p), p)
-        # because nnpy expects unicode when using str
-        msg = list(msg)
-        self.socket.send(msg)
+        nn_send(self.socket, msg)
+
+    def forward_batch(self, pkts, port):
+        if self.peer_version < 2 or len(pkts) < 2:
+            for p in pkts:
+                self.forward(p, port)
+            return
+        payload = bytearray()
+        for p in pkts:
+            payload += struct.pack("<ii", port, len(p))
+            payload += p
+        msg = bytearray(struct.pack("<iii", self.MSG_TYPE_PACKET_OUT_BATCH,
+                                    len(pkts), len(payload)))
+        msg += payload
+        nn_send(self.socket, msg)
+
+    def get_all_ctrs(self):
+        return sorted([(port, ) + iface_mgr.get_ctrs()
+                       for (dev, port), iface_mgr in iface_mgrs.items()
+                       if dev == self.dev])
+
+    def send_ctrs_snapshot(self, ctrs):
+        payload = "".join([struct.pack("<iii", *c) for c in ctrs])
+        msg = struct.pack("<iii", self.MSG_TYPE_CTRS_SNAPSHOT, len(ctrs),
+                          len(payload)) + payload
+        nn_send(self.socket, msg)
+
+    def push_ctrs(self):
+        """
+        Send a counters snapshot if they changed since the last one, and
+        schedule the next check
+        """
+        if self.ctrs_period is None:
+            return
+        self.next_push = time.time() + self.ctrs_period
+        ctrs = self.get_all_ctrs()
+        if ctrs != self.last_ctrs:
+            self.send_ctrs_snapshot(ctrs)
+            self.last_ctrs = ctrs
+
+    def push_loop(self):
+        while True:
+            time.sleep(self.ctrs_period or 1)
+            self.push_ctrs()
+
+    def subscribe_ctrs(self, period_ms):
+        self.last_ctrs = None
+        if period_ms <= 0:
+            self.ctrs_period = None
+            self.next_push = None
+            return
+        self.ctrs_period = period_ms / 1000.
+        self.next_push = time.time()
+        if args.mode == "threads" and self.pusher is None:
+            self.pusher = threading.Thread(target=self.push_loop)
+            self.pusher.daemon = True
+            self.pusher.start()
 
     def handle_info_req(self, port_number, info_id, msg):
         def handle_not_supported():
@@ -316,14 +519,41 @@ class NanomsgMgr(threading.Thread):
             else:
                 iface_mgr = iface_mgrs[(self.dev, port_number)]
                 rx, tx = iface_mgr.get_ctrs()
-                fmt = "<iiiiii"
+                link_ups, link_up_latency = iface_mgr.get_link_stats()
+                fmt = "<iiiiiiii"
                 rep = struct.pack(fmt, self.MSG_TYPE_INFO_REP, port_number,
-                                  info_id, self.MSG_INFO_STATUS_SUCCESS, rx, tx)
+                                  info_id, self.MSG_INFO_STATUS_SUCCESS, rx, tx,
+                                  link_ups, link_up_latency)
                 self.socket.send(rep)
 
+        def handle_version():
+            if len(msg) >= 4:
+                version, = struct.unpack_from("<i", msg)
+                self.peer_version = min(version, self.PROTOCOL_VERSION)
+            fmt = "<iiiii"
+            rep = struct.pack(fmt, self.MSG_TYPE_INFO_REP, port_number,
+                              info_id, self.MSG_INFO_STATUS_SUCCESS,
+                              self.PROTOCOL_VERSION)
+            self.socket.send(rep)
+
+        def handle_ctrs_subscribe():
+            period_ms, = struct.unpack_from("<i", msg)
+            self.subscribe_ctrs(period_ms)
+            fmt = "<iiii"
+            rep = struct.pack(fmt, self.MSG_TYPE_INFO_REP, port_number,
+                              info_id, self.MSG_INFO_STATUS_SUCCESS)
+            self.socket.send(rep)
+
+        def handle_ctrs_all():
+            # the reply is a snapshot message
+            self.send_ctrs_snapshot(self.get_all_ctrs())
+
         handlers = {
-            self.MSG_INFO_TYPE_HWADDR: handle_hwaddr,
-            self.MSG_INFO_TYPE_CTRS:   handle_ctrs,
+            self.MSG_INFO_TYPE_HWADDR:         handle_hwaddr,
+            self.MSG_INFO_TYPE_CTRS:           handle_ctrs,
+            self.MSG_INFO_TYPE_VERSION:        handle_version,
+            self.MSG_INFO_TYPE_CTRS_SUBSCRIBE: handle_ctrs_subscribe,
+            self.MSG_INFO_TYPE_CTRS_ALL:       handle_ctrs_all,
         }
         handlers.get(info_id, handle_not_supported)()
 
@@ -336,27 +566,201 @@ class NanomsgMgr(threading.Thread):
             elif status == self.MSG_PORT_STATUS_DOWN:
                 iface_mgr.port_down()
 
+    def fileno(self):
+        """
+        Return a file descriptor which is readable when a message can be
+        received from the nanomsg socket
+        """
+        return self.socket.getsockopt(nnpy.SOL_SOCKET, nnpy.RCVFD)
+
+    def recv_all(self):
+        """
+        Handle all the messages which can be received without blocking, up
+        to RCV_BATCH_MAX of them
+        """
+        for _ in xrange(self.RCV_BATCH_MAX):
+            try:
+                msg = self.socket.recv(nnpy.DONTWAIT)
+            except nnpy.NNError:
+                # EAGAIN
+                return
+            self.handle_msg(msg)
+
     def run(self):
         while True:
-            msg = self.socket.recv()
-            fmt = "<iii"
-            msg_type, port_number, more = struct.unpack_from(fmt, msg)
-            hdr_size = struct.calcsize(fmt)
-            msg = msg[hdr_size:]
-            if msg_type == self.MSG_TYPE_INFO_REQ:
-                self.handle_info_req(port_number, more, msg)
-                continue
-            if msg_type == self.MSG_TYPE_PORT_SET_STATUS:
-                self.handle_set_status_req(port_number, more)
-                continue
-            if msg_type != self.MSG_TYPE_PACKET_IN:
-                continue
+            self.handle_msg(self.socket.recv())
+
+    def handle_msg(self, msg):
+        fmt = "<iii"
+        msg_type, port_number, more = struct.unpack_from(fmt, msg)
+        hdr_size = struct.calcsize(fmt)
+        msg = msg[hdr_size:]
+        if msg_type == self.MSG_TYPE_INFO_REQ:
+            self.handle_info_req(port_number, more, msg)
+            return
+        if msg_type == self.MSG_TYPE_PORT_SET_STATUS:
+            self.handle_set_status_req(port_number, more)
+            return
+        if msg_type == self.MSG_TYPE_PACKET_IN_BATCH:
+            # port_number is the number of packets in the batch
             assert (len(msg) == more)
-            logger.debug("NanomsgMgr {}-{} ({}) received a packet".format(
-                self.dev, port_number, self.socket_addr))
-            if (self.dev, port_number) in iface_mgrs:
-                iface_mgr = iface_mgrs[(self.dev, port_number)]
-                iface_mgr.forward(msg)
+            offset = 0
+            for _ in xrange(port_number):
+                port, length = struct.unpack_from("<ii", msg, offset)
+                offset += 8
+                self.packet_in(port, msg[offset:offset + length])
+                offset += length
+            return
+        if msg_type != self.MSG_TYPE_PACKET_IN:
+            return
+        assert (len(msg) == more)
+        self.packet_in(port_number, msg)
+
+    def packet_in(self, port_number, msg):
+        logger.debug("NanomsgMgr {}-{} ({}) received a packet".format(
+            self.dev, port_number, self.socket_addr))
+        if (self.dev, port_number) in iface_mgrs:
+            iface_mgr = iface_mgrs[(self.dev, port_number)]
+            iface_mgr.forward(msg)
+
+class LinkMonitor(threading.Thread):
+    """
+    Listen to netlink link events and tell the IfaceMgr of the interface
+    about them, so that sockets are re-opened as soon as a link goes up
+    instead of polling the state of each interface.
+    """
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.socket = socket.socket(AF_NETLINK, SOCK_DGRAM, NETLINK_ROUTE)
+        self.socket.bind((0, RTMGRP_LINK))
+        self.iface_mgrs = {}
+        for iface_mgr in iface_mgrs.values():
+            self.iface_mgrs.setdefault(iface_mgr.iface_name, []).append(
+                iface_mgr)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def handle_events(self):
+        """
+        Read pending link events
+        @retval List of the IfaceMgr objects whose link changed
+        """
+        try:
+            data = self.socket.recv(65536)
+        except socket.error as err:
+            # we may have lost some events, check every interface
+            if err.errno == errno.ENOBUFS:
+                logger.debug("LinkMonitor: netlink socket overrun")
+            else:
+                logger.error("LinkMonitor: cannot read netlink socket: %s", err)
+            events = [(name, None) for name in self.iface_mgrs]
+        else:
+            events = parse_link_events(data)
+        now = time.time()
+        changed = []
+        for name, up in events:
+            for iface_mgr in self.iface_mgrs.get(name, []):
+                iface_mgr.link_changed(now, up)
+                changed.append(iface_mgr)
+        return changed
+
+    def run(self):
+        while True:
+            self.handle_events()
+
+class EventLoop(object):
+    """
+    Serve all the interfaces and device sockets from a single thread, with
+    epoll, instead of a thread for each of them.
+    """
+    def __init__(self, link_monitor=None):
+        self.poller = select.epoll()
+        # dict from file descriptor to IfaceMgr, NanomsgMgr or LinkMonitor
+        self.handlers = {}
+        self.link_monitor = link_monitor
+
+    def register(self, fd, mgr):
+        self.handlers[fd] = mgr
+        self.poller.register(fd, select.EPOLLIN)
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+        del self.handlers[fd]
+
+    def iface_up(self, iface_mgr):
+        logger.debug("IfaceMgr {}-{} ({}) status changed to UP".format(
+                     iface_mgr.dev, iface_mgr.port, iface_mgr.iface_name))
+        try:
+            iface_mgr.open_socket()
+        except socket.error:
+            return
+        self.register(iface_mgr.socket.fileno(), iface_mgr)
+
+    def iface_error(self, fd, iface_mgr):
+        logger.debug("IfaceMgr {}-{} ({}) Error reading from the socket.".format(
+                     iface_mgr.dev, iface_mgr.port, iface_mgr.iface_name))
+        self.unregister(fd)
+        iface_mgr.close_socket()
+        # the link may already be up again
+        self.check_ifaces([iface_mgr])
+
+    def check_ifaces(self, ifaces):
+        for iface_mgr in ifaces:
+            if iface_mgr.socket is None and iface_mgr.is_up():
+                self.iface_up(iface_mgr)
+
+    def run(self):
+        for nano_mgr in nano_mgrs.values():
+            self.register(nano_mgr.fileno(), nano_mgr)
+        if self.link_monitor is not None:
+            self.register(self.link_monitor.fileno(), self.link_monitor)
+        self.check_ifaces(iface_mgrs.values())
+        poll_interval = IfaceMgr.link_poll_interval
+        next_check = None
+        while True:
+            if poll_interval is not None and next_check is None:
+                next_check = time.time() + poll_interval
+            deadlines = [nano_mgr.next_push for nano_mgr in nano_mgrs.values()
+                         if nano_mgr.next_push is not None]
+            if next_check is not None:
+                deadlines.append(next_check)
+            timeout = -1
+            if deadlines:
+                timeout = max(min(deadlines) - time.time(), 0)
+            try:
+                events = self.poller.poll(timeout)
+            except IOError as err:
+                if err.errno == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                mgr = self.handlers.get(fd)
+                if mgr is None:
+                    continue
+                if isinstance(mgr, NanomsgMgr):
+                    mgr.recv_all()
+                    continue
+                if isinstance(mgr, LinkMonitor):
+                    self.check_ifaces(mgr.handle_events())
+                    continue
+                try:
+                    if event & (select.EPOLLERR | select.EPOLLHUP):
+                        raise socket.error()
+                    pkts = mgr.recv_batch(block=False)
+                except socket.error:
+                    self.iface_error(fd, mgr)
+                    continue
+                if pkts:
+                    mgr.received(pkts)
+            now = time.time()
+            for nano_mgr in nano_mgrs.values():
+                if nano_mgr.next_push is not None and now >= nano_mgr.next_push:
+                    nano_mgr.push_ctrs()
+            if next_check is not None and now >= next_check:
+                self.check_ifaces(iface_mgrs.values())
+                next_check = None
 
 def main():
     if args.verbose:
@@ -364,14 +768,36 @@ def main():
     else:
         logger.setLevel(logging.INFO)
 
+    # the dicts are filled before any thread is started, they are only read
+    # afterwards
     for dev, port, iface in args.interfaces:
-        i = IfaceMgr(dev, port, iface, args.iface_rcv_buf, args.iface_snd_buf)
-        i.start()
-        iface_mgrs[(dev, port)] = i
+        iface_mgrs[(dev, port)] = IfaceMgr(
+            dev, port, iface, args.iface_rcv_buf, args.iface_snd_buf)
     for dev, addr in args.device_sockets:
-        n = NanomsgMgr(dev, addr, args.nn_rcv_buf, args.nn_snd_buf)
+        nano_mgrs[dev] = NanomsgMgr(dev, addr, args.nn_rcv_buf, args.nn_snd_buf)
+
+    try:
+        link_monitor = LinkMonitor()
+    except socket.error:
+        logger.info("Cannot listen to netlink link events, "
+                    "checking interfaces every second")
+        link_monitor = None
+        IfaceMgr.link_poll_interval = 1
+
+    if args.mode == "epoll":
+        logger.info("READY")
+        try:
+            EventLoop(link_monitor).run()
+        except KeyboardInterrupt:
+            return
+        return
+
+    if link_monitor is not None:
+        link_monitor.start()
+    for i in iface_mgrs.values():
+        i.start()
+    for n in nano_mgrs.values():
         n.start()
-        nano_mgrs[dev] = n
     logger.info("READY")
     try:
         while True:
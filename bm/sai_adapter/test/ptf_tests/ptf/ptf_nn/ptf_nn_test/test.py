@@ -1,3 +1,4 @@
+import time
 import ptf
 from ptf.base_tests import BaseTest
 from ptf import config
@@ -11,7 +12,7 @@ class DataplaneBaseTest(BaseTest):
         self.dataplane = ptf.dataplane_instance
         self.dataplane.flush()
         if config["log_dir"] != None:
-            filename = os.path.join(config["log_dir"], str(self)) + ".pcap"
+            filename = os.path.join(config["log_dir"], str(self)) + ".pcapng"
             self.dataplane.start_pcap(filename)
 
     def tearDown(self):
@@ -75,3 +76,64 @@ class GetCountersTest(DataplaneBaseTest):
         print " (1, 1) %d:%d" % counters_11_e
         self.assertTrue(counters_01_e[1] > counters_01_b[1])
         self.assertTrue(counters_11_e[0] > counters_11_b[0])
+
+class BatchTest(DataplaneBaseTest):
+    def __init__(self):
+        DataplaneBaseTest.__init__(self)
+
+    def runTest(self):
+        pkt = "ab" * 20
+        # sent as a single PACKET_IN_BATCH message to agents which support it
+        testutils.send_packet(self, (0, 1), str(pkt), count=100)
+        print "packets sent"
+        self.assertEqual(
+            testutils.count_matched_packets(self, pkt, 1, device_number=1), 100)
+
+class GetCountersAllTest(DataplaneBaseTest):
+    def __init__(self):
+        DataplaneBaseTest.__init__(self)
+
+    def runTest(self):
+        counters_0_b = self.dataplane.get_nn_counters_all(0)
+        counters_1_b = self.dataplane.get_nn_counters_all(1)
+        self.assertIn(1, counters_0_b)
+        self.assertIn(1, counters_1_b)
+        pkt = "ab" * 20
+        testutils.send_packet(self, (0, 1), str(pkt))
+        print "packet sent"
+        testutils.verify_packet(self, pkt, (1, 1))
+        counters_0_e = self.dataplane.get_nn_counters_all(0)
+        counters_1_e = self.dataplane.get_nn_counters_all(1)
+        self.assertTrue(counters_0_e[1][1] > counters_0_b[1][1])
+        self.assertTrue(counters_1_e[1][0] > counters_1_b[1][0])
+
+class VerifyPacketsOtherTest(DataplaneBaseTest):
+    def __init__(self):
+        DataplaneBaseTest.__init__(self)
+
+    def runTest(self):
+        pkt = "ab" * 20
+        other_pkt = "cd" * 20
+        # like verify_no_packet, other packets on a port which does not expect
+        # the packet are ignored
+        testutils.send_packet(self, (0, 1), str(other_pkt))
+        print "packet sent"
+        testutils.verify_packets(self, pkt, [], device_number=1)
+        # but the packet itself is not
+        testutils.send_packet(self, (0, 1), str(pkt))
+        print "packet sent"
+        with self.assertRaises(AssertionError):
+            testutils.verify_packets(self, pkt, [], device_number=1)
+
+class QuietWindowTest(DataplaneBaseTest):
+    def __init__(self):
+        DataplaneBaseTest.__init__(self)
+
+    def runTest(self):
+        # the quiet window starts with the poll at the earliest, even on a
+        # device which has not received anything yet
+        start = time.time()
+        res = self.dataplane.poll(device_number=1, timeout=2, quiet_window=0.5)
+        elapsed = time.time() - start
+        self.assertIsNone(res[2])
+        self.assertTrue(0.5 <= elapsed < 2)
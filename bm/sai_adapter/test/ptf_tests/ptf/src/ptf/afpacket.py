@@ -6,8 +6,16 @@ in the data returned by recv. Instead, it delivers the VLAN TCI in a control
 message. Python 2.x doesn't have built-in support for recvmsg, so we have to
 use ctypes to call it. The recv function exported by this module reconstructs
 the VLAN tag if it was offloaded.
+
+The RxRing class provides an alternative receive path based on a TPACKET_V3
+memory-mapped ring (PACKET_MMAP), which does not require a system call per
+packet. The VLAN tag is reconstructed the same way, from the frame headers.
 """
 
+import errno
+import mmap
+import os
+import select
 import socket
 import struct
 from ctypes import *
@@ -16,6 +24,23 @@ ETH_P_8021Q = 0x8100
 SOL_PACKET = 263
 PACKET_AUXDATA = 8
 TP_STATUS_VLAN_VALID = 1 << 4
+MSG_DONTWAIT = 0x40
+
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1 << 0
+TP_STATUS_VLAN_TPID_VALID = 1 << 6
+
+# struct tpacket_req3
+TPacketReq3 = struct.Struct("IIIIIII")
+# struct tpacket_block_desc: version, offset_to_priv, then the start of
+# struct tpacket_hdr_v1: block_status, num_pkts, offset_to_first_pkt
+TPacketBlockDesc = struct.Struct("IIIII")
+TPACKET_BLOCK_STATUS_OFFSET = 8
+# struct tpacket3_hdr, including struct tpacket_hdr_variant1
+TPacket3Hdr = struct.Struct("IIIIIIHHIIHH")
 
 class struct_iovec(Structure):
     _fields_ = [
@@ -34,6 +59,12 @@ class struct_msghdr(Structure):
         ("msg_flags", c_int),
     ]
 
+class struct_mmsghdr(Structure):
+    _fields_ = [
+        ("msg_hdr", struct_msghdr),
+        ("msg_len", c_uint),
+    ]
+
 class struct_cmsghdr(Structure):
     _fields_ = [
         ("cmsg_len", c_size_t),
@@ -52,10 +83,23 @@ class struct_tpacket_auxdata(Structure):
         ("tp_padding", c_ushort),
     ]
 
-libc = CDLL("libc.so.6")
+libc = CDLL("libc.so.6", use_errno=True)
 recvmsg = libc.recvmsg
 recvmsg.argtypes = [c_int, POINTER(struct_msghdr), c_int]
 recvmsg.retype = c_int
+try:
+    sendmmsg = libc.sendmmsg
+    sendmmsg.argtypes = [c_int, POINTER(struct_mmsghdr), c_uint, c_int]
+    sendmmsg.restype = c_int
+except AttributeError:
+    # glibc older than 2.14
+    sendmmsg = None
+
+def insert_vlan_tag(data, tci, tpid=ETH_P_8021Q):
+    """
+    Re-insert an offloaded VLAN tag after the Ethernet addresses
+    """
+    return data[:12] + struct.pack("!HH", tpid, tci) + data[12:]
 
 def enable_auxdata(sk):
     """
@@ -65,11 +109,13 @@ def enable_auxdata(sk):
     """
     sk.setsockopt(SOL_PACKET, PACKET_AUXDATA, 1)
 
-def recv(sk, bufsize):
+def recv(sk, bufsize, flags=0):
     """
     Receive a packet from an AF_PACKET socket
     @sk Socket
     @bufsize Maximum packet size
+    @flags recvmsg flags; with MSG_DONTWAIT, None is returned when no packet
+    is available
     """
     buf = create_string_buffer(bufsize)
 
@@ -89,8 +135,10 @@ def recv(sk, bufsize):
     msghdr.msg_controllen = ctrl_bufsize
     msghdr.msg_flags = 0
 
-    rv = recvmsg(sk.fileno(), byref(msghdr), 0)
+    rv = recvmsg(sk.fileno(), byref(msghdr), flags)
     if rv < 0:
+        if flags & MSG_DONTWAIT and get_errno() in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return None
         raise RuntimeError("recvmsg failed: rv=%d" % rv)
 
     # The kernel only delivers control messages we ask for. We
@@ -106,7 +154,124 @@ def recv(sk, bufsize):
 
     if auxdata.tp_vlan_tci != 0 or auxdata.tp_status & TP_STATUS_VLAN_VALID:
         # Insert VLAN tag
-        tag = struct.pack("!HH", ETH_P_8021Q, auxdata.tp_vlan_tci)
-        return buf.raw[:12] + tag + buf.raw[12:rv]
+        return insert_vlan_tag(buf.raw[:rv], auxdata.tp_vlan_tci)
     else:
         return buf.raw[:rv]
+
+def send_batch(sk, pkts, timeout=None):
+    """
+    Send packets on an AF_PACKET socket, using as few sendmmsg calls as the
+    socket send buffer allows
+    @sk Socket, must be bound to an interface
+    @pkts List of packets (strings)
+    @timeout Maximum time to wait for the socket to become writable, defaults
+    to the socket timeout
+    @retval The number of packets sent
+    """
+    if sendmmsg is None:
+        for pkt in pkts:
+            sk.send(pkt)
+        return len(pkts)
+
+    if timeout is None:
+        timeout = sk.gettimeout()
+    count = len(pkts)
+    iovs = (struct_iovec * count)()
+    msgs = (struct_mmsghdr * count)()
+    # keeps the c_char_p objects (which point to the packet strings) alive
+    bufs = {}
+    for i, pkt in enumerate(pkts):
+        if id(pkt) not in bufs:
+            bufs[id(pkt)] = c_char_p(pkt)
+        iovs[i].iov_base = cast(bufs[id(pkt)], c_void_p)
+        iovs[i].iov_len = len(pkt)
+        msgs[i].msg_hdr.msg_iov = pointer(iovs[i])
+        msgs[i].msg_hdr.msg_iovlen = 1
+
+    sent = 0
+    while sent < count:
+        rv = sendmmsg(sk.fileno(), byref(msgs[sent]), count - sent, 0)
+        if rv >= 0:
+            sent += rv
+            continue
+        err = get_errno()
+        if err not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+            raise socket.error(err, os.strerror(err))
+        # send buffer is full, wait for the interface to catch up
+        if not select.select([], [sk], [], timeout)[1]:
+            break
+    return sent
+
+class RxRing(object):
+    """
+    TPACKET_V3 receive ring mapped in memory
+
+    The kernel fills fixed-size blocks with variable-size frames and hands a
+    block over to user space when it is full or when retire_blk_tov
+    milliseconds have elapsed since its first frame, at which point the socket
+    becomes readable. Frames are copied out of a block before it is given back
+    to the kernel, since the caller typically queues them.
+    """
+
+    def __init__(self, sk, block_size, block_nr, frame_size, retire_blk_tov):
+        """
+        Set up the ring on an AF_PACKET socket
+        @sk Socket
+        @block_size Size of a block, must be a multiple of the page size
+        @block_nr Number of blocks in the ring
+        @frame_size Nominal frame size, only used to size the ring
+        @retire_blk_tov Block retire timeout in milliseconds
+        Raises socket.error or EnvironmentError if the kernel does not support
+        TPACKET_V3 or the ring cannot be mapped.
+        """
+        self.block_size = block_size
+        self.block_nr = block_nr
+        sk.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        sk.setsockopt(SOL_PACKET, PACKET_RX_RING, TPacketReq3.pack(
+            block_size,
+            block_nr,
+            frame_size,
+            block_size * block_nr / frame_size, # frame_nr
+            retire_blk_tov,
+            0, # sizeof_priv
+            0, # feature_req_word
+        ))
+        self.ring = mmap.mmap(sk.fileno(), block_size * block_nr,
+                              mmap.MAP_SHARED,
+                              mmap.PROT_READ | mmap.PROT_WRITE)
+        self.block = 0
+
+    def close(self):
+        self.ring.close()
+
+    def frames(self, max_blocks=None):
+        """
+        Read frames from the blocks owned by user space, in order, giving each
+        block back to the kernel once all its frames have been read.
+        @max_blocks Maximum number of blocks to read
+        @retval Generator of (frame data, timestamp)
+        """
+        ring = self.ring
+        blocks = 0
+        while max_blocks is None or blocks < max_blocks:
+            block_offset = self.block * self.block_size
+            _, _, status, num_pkts, offset = TPacketBlockDesc.unpack_from(
+                ring, block_offset)
+            if not status & TP_STATUS_USER:
+                return
+            offset += block_offset
+            for _ in xrange(num_pkts):
+                (next_offset, sec, nsec, snaplen, _, status, mac, _, _,
+                 vlan_tci, vlan_tpid, _) = TPacket3Hdr.unpack_from(ring, offset)
+                data = ring[offset + mac:offset + mac + snaplen]
+                if vlan_tci != 0 or status & TP_STATUS_VLAN_VALID:
+                    if not status & TP_STATUS_VLAN_TPID_VALID:
+                        vlan_tpid = ETH_P_8021Q
+                    data = insert_vlan_tag(data, vlan_tci, vlan_tpid)
+                yield data, sec + nsec * 1e-9
+                offset += next_offset
+            struct.pack_into("I", ring,
+                             block_offset + TPACKET_BLOCK_STATUS_OFFSET,
+                             TP_STATUS_KERNEL)
+            self.block = (self.block + 1) % self.block_nr
+            blocks += 1
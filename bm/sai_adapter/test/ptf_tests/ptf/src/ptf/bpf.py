@@ -0,0 +1,216 @@
+"""
+Classic BPF receive filters
+
+A filter is a list of predicates, all of which a packet must satisfy to be
+received. compile() turns it into a classic BPF program which attach() loads
+in the kernel with SO_ATTACH_FILTER, so that packets which would be discarded
+by the test anyway are dropped before being copied to the DataPlane, queued,
+written to the pcap file and counted.
+
+Predicates:
+    accept_ethertypes(types): the EtherType is one of 'types'
+    drop_ethertypes(types): the EtherType is not one of 'types'
+    drop_ipv6_nd(): the packet is not an IPv6 neighbor discovery message
+    (ICMPv6 type 133 to 137, without extension headers)
+
+The EtherType is read at offset 12; on Linux VLAN tags are usually stripped by
+the time the filter runs, in which case this is the encapsulated EtherType.
+"""
+
+import socket
+import struct
+from ctypes import *
+
+SO_ATTACH_FILTER = 26
+SO_DETACH_FILTER = 27
+
+# From linux/filter.h
+BPF_LD = 0x00
+BPF_JMP = 0x05
+BPF_RET = 0x06
+BPF_H = 0x08
+BPF_B = 0x10
+BPF_ABS = 0x20
+BPF_JA = 0x00
+BPF_JEQ = 0x10
+BPF_JGT = 0x20
+BPF_JGE = 0x30
+BPF_K = 0x00
+
+ETHERTYPE_OFFSET = 12
+ETH_P_IPV6 = 0x86dd
+IPV6_NEXT_HEADER_OFFSET = 20
+ICMPV6_TYPE_OFFSET = 54
+IPPROTO_ICMPV6 = 58
+ND_ROUTER_SOLICIT = 133
+ND_REDIRECT = 137
+
+# snap length returned for accepted packets
+ACCEPT_LEN = 0x40000
+
+# symbolic jump targets, resolved by compile()
+NEXT = "next"
+DROP = "drop"
+
+class sock_filter(Structure):
+    _fields_ = [
+        ("code", c_ushort),
+        ("jt", c_ubyte),
+        ("jf", c_ubyte),
+        ("k", c_uint),
+    ]
+
+class sock_fprog(Structure):
+    _fields_ = [
+        ("len", c_ushort),
+        ("filter", POINTER(sock_filter)),
+    ]
+
+def load_half(offset):
+    return (BPF_LD | BPF_H | BPF_ABS, 0, 0, offset)
+
+def load_byte(offset):
+    return (BPF_LD | BPF_B | BPF_ABS, 0, 0, offset)
+
+def jump(op, k, jt, jf):
+    return (BPF_JMP | op | BPF_K, jt, jf, k)
+
+def accept_ethertypes(types):
+    insns = [load_half(ETHERTYPE_OFFSET)]
+    insns += [jump(BPF_JEQ, t, NEXT, 0) for t in types]
+    insns.append((BPF_JMP | BPF_JA, 0, 0, DROP))
+    return insns
+
+def drop_ethertypes(types):
+    insns = [load_half(ETHERTYPE_OFFSET)]
+    insns += [jump(BPF_JEQ, t, DROP, 0) for t in types]
+    insns.append((BPF_JMP | BPF_JA, 0, 0, NEXT))
+    return insns
+
+def drop_ipv6_nd():
+    return [
+        load_half(ETHERTYPE_OFFSET),
+        jump(BPF_JEQ, ETH_P_IPV6, 0, NEXT),
+        load_byte(IPV6_NEXT_HEADER_OFFSET),
+        jump(BPF_JEQ, IPPROTO_ICMPV6, 0, NEXT),
+        load_byte(ICMPV6_TYPE_OFFSET),
+        jump(BPF_JGE, ND_ROUTER_SOLICIT, 0, NEXT),
+        jump(BPF_JGT, ND_REDIRECT, NEXT, DROP),
+    ]
+
+def compile(predicates):
+    """
+    Return the BPF program (a list of (code, jt, jf, k) tuples) accepting
+    the packets which satisfy all the predicates
+    """
+    blocks = [list(p) for p in predicates]
+    size = sum([len(b) for b in blocks])
+    accept, drop = size, size + 1
+    program = []
+    for block in blocks:
+        next_block = len(program) + len(block)
+        for insn in block:
+            here = len(program) + 1
+            def target(label):
+                if label == NEXT:
+                    return next_block - here
+                if label == DROP:
+                    return drop - here
+                return label
+            code, jt, jf, k = insn
+            if code == BPF_JMP | BPF_JA:
+                k = target(k)
+            else:
+                jt, jf = target(jt), target(jf)
+            if jt > 255 or jf > 255:
+                raise ValueError("BPF filter too long")
+            program.append((code, jt, jf, k))
+    program.append((BPF_RET | BPF_K, 0, 0, ACCEPT_LEN))
+    program.append((BPF_RET | BPF_K, 0, 0, 0))
+    return program
+
+def run(program, data):
+    """
+    Interpret the program on a packet, return True if it is accepted. Used
+    to check programs without a socket.
+    """
+    pc = 0
+    acc = 0
+    while True:
+        code, jt, jf, k = program[pc]
+        pc += 1
+        if code == BPF_RET | BPF_K:
+            return k != 0
+        if code == BPF_JMP | BPF_JA:
+            pc += k
+        elif code & 0x07 == BPF_LD:
+            size = 2 if code & BPF_H else 1
+            if k + size > len(data):
+                return False
+            acc = 0
+            for c in data[k:k + size]:
+                acc = (acc << 8) | ord(c)
+        else:
+            op = code & 0xf0
+            if op == BPF_JEQ:
+                taken = acc == k
+            elif op == BPF_JGT:
+                taken = acc > k
+            else:
+                taken = acc >= k
+            pc += jt if taken else jf
+
+def attach(sock, program):
+    """
+    Attach a BPF program to a socket, replacing the current one if any
+    """
+    insns = (sock_filter * len(program))(*program)
+    fprog = sock_fprog(len(program), insns)
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER,
+                    string_at(addressof(fprog), sizeof(fprog)))
+
+def detach(sock):
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_DETACH_FILTER, 0)
+    except socket.error:
+        # no filter attached
+        pass
+
+def utest():
+    def frame(ethertype, payload=""):
+        return "\x00" * 12 + struct.pack("!H", ethertype) + payload
+    def ipv6(next_header, icmpv6_type=0):
+        header = "\x60" + "\x00" * 5 + chr(next_header) + "\x40" + "\x00" * 32
+        return frame(ETH_P_IPV6, header + chr(icmpv6_type) + "\x00" * 7)
+    ipv4 = frame(0x0800, "\x45" + "\x00" * 19)
+    arp = frame(0x0806, "\x00" * 28)
+    # no predicate, as after reset_filters: everything is accepted
+    p = compile([])
+    assert(run(p, ipv4) and run(p, ipv6(IPPROTO_ICMPV6, 135)))
+    p = compile([accept_ethertypes([0x0800, 0x0806])])
+    assert(run(p, ipv4) and run(p, arp))
+    assert(not run(p, ipv6(17)))
+    # not_ipv6_filter
+    p = compile([drop_ethertypes([ETH_P_IPV6])])
+    assert(run(p, ipv4))
+    assert(not run(p, ipv6(17)))
+    # not_ipv6_nd_filter
+    p = compile([drop_ipv6_nd()])
+    for icmpv6_type in range(ND_ROUTER_SOLICIT, ND_REDIRECT + 1):
+        assert(not run(p, ipv6(IPPROTO_ICMPV6, icmpv6_type)))
+    assert(run(p, ipv6(IPPROTO_ICMPV6, 128)))
+    assert(run(p, ipv6(IPPROTO_ICMPV6, ND_REDIRECT + 1)))
+    assert(run(p, ipv6(17, 135)) and run(p, ipv4))
+    # a packet must satisfy all the predicates
+    p = compile([accept_ethertypes([ETH_P_IPV6]), drop_ipv6_nd()])
+    assert(run(p, ipv6(17)))
+    assert(not run(p, ipv4) and not run(p, ipv6(IPPROTO_ICMPV6, 136)))
+    # packets too short for a load are dropped, as by the kernel
+    assert(not run(p, ipv6(IPPROTO_ICMPV6)[:20]))
+    try:
+        compile([accept_ethertypes(range(300))])
+        assert(False)
+    except ValueError:
+        pass
+
+utest()
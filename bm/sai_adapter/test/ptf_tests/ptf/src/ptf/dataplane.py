@@ -21,7 +21,11 @@ import time
 import select
 import logging
 import struct
+import heapq
+import itertools
+from array import array
 from collections import defaultdict
+from collections import deque
 from threading import Thread
 from threading import Lock
 from threading import Condition
@@ -38,6 +42,7 @@ except ImportError:
 
 if "linux" in sys.platform:
     import afpacket
+    import bpf
 else:
     import pcap
 
@@ -51,6 +56,17 @@ have_pypcap = False
 #except:
 #    pass
 
+def nn_send(sock, msg):
+    """
+    Send a raw message on a nnpy socket. Recent nnpy versions take any buffer
+    as is, older ones try to encode str objects, in which case we fall back
+    to sending a list of characters.
+    """
+    try:
+        sock.send(bytearray(msg))
+    except TypeError:
+        sock.send(list(str(msg)))
+
 def match_exp_pkt(exp_pkt, pkt):
     """
     Compare the string value of pkt with the string value of exp_pkt,
@@ -58,15 +74,23 @@ def match_exp_pkt(exp_pkt, pkt):
     less than the minimum Ethernet frame size (60 bytes), then padding
     bytes in pkt are ignored.
     """
+    return compile_exp_pkt(exp_pkt)(pkt)
+
+def compile_exp_pkt(exp_pkt):
+    """
+    Return a function taking a packet and returning True iff it matches
+    exp_pkt (see match_exp_pkt). exp_pkt is serialized once, here, so the
+    returned function is cheap to call for every received packet.
+    """
     if isinstance(exp_pkt, mask.Mask):
         if not exp_pkt.is_valid():
-            return False
-        return exp_pkt.pkt_match(pkt)
+            return lambda pkt: False
+        exp_pkt.compile()
+        return exp_pkt.pkt_match
     e = str(exp_pkt)
-    p = str(pkt)
     if len(e) < 60:
-        p = p[:len(e)]
-    return e == p
+        return lambda pkt: str(pkt)[:len(e)] == e
+    return lambda pkt: str(pkt) == e
 
 
 class DataPlanePacketSourceIface:
@@ -88,6 +112,18 @@ class DataPlanePacketSourceIface:
         """
         raise NotImplementedError()
 
+    def drain(self):
+        """
+        Receive the packets which are ready on this source. Called when
+        fileno() is readable; the default implementation receives a single
+        packet, sources which can do non-blocking reads should override it.
+        @retval List of (device, port, packet data, timestamp)
+        """
+        t = self.recv()
+        if t is None:
+            return []
+        return [t]
+
 
 class DataPlanePortIface:
     def get_packet_source(self):
@@ -104,6 +140,14 @@ class DataPlanePortIface:
         """
         raise NotImplementedError()
 
+    def send_batch(self, packets):
+        """
+        Send several packets out this port.
+        @param packets List of packet data to send to the port
+        @retval The number of bytes sent
+        """
+        return sum([self.send(packet) for packet in packets])
+
     def down(self):
         """
         Bring the physical link down.
@@ -116,6 +160,12 @@ class DataPlanePortIface:
         """
         raise NotImplementedError()
 
+    def close(self):
+        """
+        Release the resources of this port. It is not used afterwards.
+        """
+        pass
+
 
 class DataPlanePortLinux(DataPlanePortIface, DataPlanePacketSourceIface):
     """
@@ -125,6 +175,9 @@ class DataPlanePortLinux(DataPlanePortIface, DataPlanePacketSourceIface):
     RCV_SIZE_DEFAULT = 4096
     ETH_P_ALL = 0x03
     RCV_TIMEOUT = 10000
+    # Maximum number of packets read by drain() per wakeup, so that a single
+    # busy port cannot starve the others
+    RCV_DRAIN_MAX = 256
 
     def __init__(self, interface_name, device_number, port_number):
         """
@@ -140,8 +193,15 @@ class DataPlanePortLinux(DataPlanePortIface, DataPlanePacketSourceIface):
         self.socket.settimeout(self.RCV_TIMEOUT)
 
     def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Close the port socket.
+        """
         if self.socket:
             self.socket.close()
+            self.socket = None
 
     def fileno(self):
         """
@@ -157,6 +217,21 @@ class DataPlanePortLinux(DataPlanePortIface, DataPlanePacketSourceIface):
         pkt = afpacket.recv(self.socket, self.RCV_SIZE_DEFAULT)
         return (self.device_number, self.port_number, pkt, time.time())
 
+    def drain(self):
+        """
+        Receive packets from this port until the socket would block.
+        @retval List of (device, port, packet data, timestamp)
+        """
+        pkts = []
+        while len(pkts) < self.RCV_DRAIN_MAX:
+            pkt = afpacket.recv(self.socket, self.RCV_SIZE_DEFAULT,
+                                afpacket.MSG_DONTWAIT)
+            if pkt is None:
+                break
+            pkts.append((self.device_number, self.port_number, pkt,
+                         time.time()))
+        return pkts
+
     def get_packet_source(self):
         """
         @retval An object implementing DataPlanePacketSourceIface
@@ -171,6 +246,25 @@ class DataPlanePortLinux(DataPlanePortIface, DataPlanePacketSourceIface):
         """
         return self.socket.send(packet)
 
+    def send_batch(self, packets):
+        """
+        Send several packets out this port with sendmmsg.
+        @param packets List of packet data to send to the port
+        @retval The number of bytes sent
+        """
+        sent = afpacket.send_batch(self.socket, packets)
+        return sum([len(packet) for packet in packets[:sent]])
+
+    def set_filter(self, program):
+        """
+        Attach a BPF program (see ptf.bpf) to the socket, so that the kernel
+        only delivers the packets it accepts, or detach it if None.
+        """
+        if program is None:
+            bpf.detach(self.socket)
+        else:
+            bpf.attach(self.socket, program)
+
     def down(self):
         """
         Bring the physical link down.
@@ -190,6 +284,72 @@ class DataPlanePortLinux(DataPlanePortIface, DataPlanePacketSourceIface):
         return netutils.get_mac(self.interface_name)
 
 
+class DataPlanePortLinuxMmap(DataPlanePortLinux):
+    """
+    Same as DataPlanePortLinux, but receives packets through a TPACKET_V3
+    memory-mapped ring instead of one recvmsg call per packet. Falls back to
+    the DataPlanePortLinux receive path if the ring cannot be set up.
+    """
+
+    RING_BLOCK_SIZE = 1 << 16
+    RING_BLOCK_NR = 32
+    RING_FRAME_SIZE = 2048
+    # in milliseconds, this is the maximum latency added by the ring
+    RING_BLOCK_TIMEOUT = 2
+
+    def __init__(self, interface_name, device_number, port_number):
+        DataPlanePortLinux.__init__(self, interface_name, device_number,
+                                    port_number)
+        self.pending = deque()
+        try:
+            self.ring = afpacket.RxRing(self.socket, self.RING_BLOCK_SIZE,
+                                        self.RING_BLOCK_NR,
+                                        self.RING_FRAME_SIZE,
+                                        self.RING_BLOCK_TIMEOUT)
+        except (socket.error, EnvironmentError) as e:
+            logging.getLogger("dataplane").warning(
+                "Cannot set up rx ring on %s (%s), using recvmsg",
+                interface_name, e)
+            self.ring = None
+
+    def close(self):
+        """
+        Unmap the rx ring and close the port socket.
+        """
+        if self.ring:
+            self.ring.close()
+            self.ring = None
+        DataPlanePortLinux.close(self)
+
+    def recv(self):
+        """
+        Receive a packet from this port.
+        @retval (device, port, packet data, timestamp), or None if the ring is
+        empty
+        """
+        if self.ring is None:
+            return DataPlanePortLinux.recv(self)
+        if not self.pending:
+            self.pending.extend(self.drain())
+        if not self.pending:
+            return None
+        return self.pending.popleft()
+
+    def drain(self):
+        """
+        Receive the packets from all the blocks handed over by the kernel.
+        @retval List of (device, port, packet data, timestamp)
+        """
+        if self.ring is None:
+            return DataPlanePortLinux.drain(self)
+        pkts = list(self.pending)
+        self.pending.clear()
+        for pkt, timestamp in self.ring.frames(self.RING_BLOCK_NR):
+            pkts.append((self.device_number, self.port_number, pkt,
+                         timestamp))
+        return pkts
+
+
 class DataPlanePacketSourceNN(DataPlanePacketSourceIface):
     """
     Wrapper class around nnpy used to capture data packets, send data packets
@@ -207,17 +367,36 @@ class DataPlanePacketSourceNN(DataPlanePacketSourceIface):
     MSG_TYPE_PACKET_OUT = 4
     MSG_TYPE_INFO_REQ = 5
     MSG_TYPE_INFO_REP = 6
+    MSG_TYPE_PACKET_IN_BATCH = 7
+    MSG_TYPE_PACKET_OUT_BATCH = 8
+    MSG_TYPE_CTRS_SNAPSHOT = 9
 
     MSG_PORT_STATUS_UP = 0
     MSG_PORT_STATUS_DOWN = 1
 
     MSG_INFO_TYPE_HWADDR = 0
     MSG_INFO_TYPE_CTRS = 1
+    MSG_INFO_TYPE_VERSION = 2
+    MSG_INFO_TYPE_CTRS_SUBSCRIBE = 3
+    MSG_INFO_TYPE_CTRS_ALL = 4
 
     MSG_INFO_STATUS_SUCCESS = 0
     MSG_INFO_STATUS_NOT_SUPPORTED = 1
 
-    def __init__(self, device_number, socket_addr, rcv_timeout):
+    # Version 2 adds PACKET_IN_BATCH / PACKET_OUT_BATCH messages, which carry
+    # several packets behind a single <type, packet count, payload length>
+    # header, each packet being preceded by <port, length>. Versions are
+    # exchanged with a MSG_INFO_TYPE_VERSION request, to which agents which
+    # predate versioning reply "not supported" (version 1).
+    # Version 3 adds CTRS_SNAPSHOT messages, a <type, port count, payload
+    # length> header followed by <port, rx, tx> for every port of the device.
+    # The agent sends one in reply to a MSG_INFO_TYPE_CTRS_ALL request, and
+    # whenever the counters change (at most every <period> ms) after a
+    # MSG_INFO_TYPE_CTRS_SUBSCRIBE request carrying <period>.
+    PROTOCOL_VERSION = 3
+
+    def __init__(self, device_number, socket_addr, rcv_timeout,
+                 counters_period=0):
         self.device_number = device_number
         self.socket_addr = socket_addr
         self.socket = nnpy.Socket(nnpy.AF_SP, nnpy.PAIR)
@@ -228,6 +407,18 @@ class DataPlanePacketSourceNN(DataPlanePacketSourceIface):
         self.cvar = Condition()
         self.mac_addresses = {}
         self.nn_counters = {}
+        self.nn_link_stats = {}
+        self.versions = {}
+        self.pending = deque()
+        # dict from port number to (rx, tx), as last pushed by the agent; it
+        # is replaced as a whole on every update so it can be read without
+        # locking
+        self.nn_counters_snapshot = None
+        self.nn_counters_snapshots = 0
+        self.counters_period = counters_period
+        # Tell the agent which protocol version we support; the reply is
+        # handled by the receive loop, batches are only used once it is in
+        self.__request_version(0)
 
     def close(self):
         # TODO(antonin): something to do?
@@ -252,6 +443,28 @@ class DataPlanePacketSourceNN(DataPlanePacketSourceIface):
     def __request_ctrs(self, port_number):
         self.__send_info_req_msg(port_number, self.MSG_INFO_TYPE_CTRS)
 
+    def __request_version(self, port_number):
+        msg = struct.pack("<iiii", self.MSG_TYPE_INFO_REQ, port_number,
+                          self.MSG_INFO_TYPE_VERSION, self.PROTOCOL_VERSION)
+        self.socket.send(msg)
+
+    def __request_ctrs_all(self):
+        self.__send_info_req_msg(0, self.MSG_INFO_TYPE_CTRS_ALL)
+
+    def __subscribe_ctrs(self, period):
+        msg = struct.pack("<iiii", self.MSG_TYPE_INFO_REQ, 0,
+                          self.MSG_INFO_TYPE_CTRS_SUBSCRIBE, period)
+        self.socket.send(msg)
+
+    def peer_version(self):
+        """
+        Return the protocol version agreed with the agent, 1 until the agent
+        replied to our version request
+        """
+        if not self.versions:
+            return 1
+        return min(self.PROTOCOL_VERSION, self.versions.values()[0])
+
     def port_add(self, port_number):
         self.__send_port_msg(self.MSG_TYPE_PORT_ADD, port_number, 0)
 
@@ -279,10 +492,56 @@ class DataPlanePacketSourceNN(DataPlanePacketSourceIface):
                 self.cvar.notify_all()
         elif info_type == self.MSG_INFO_TYPE_CTRS:
             with self.cvar:
-                self.nn_counters[port_number] = struct.unpack_from('<ii', msg)
+                if msg is None:
+                    self.nn_counters[port_number] = None
+                else:
+                    self.nn_counters[port_number] = struct.unpack_from('<ii', msg)
+                # agents which monitor links append <link up count, last
+                # link up latency in microseconds>
+                if msg is not None and len(msg) >= 16:
+                    self.nn_link_stats[port_number] = \
+                        struct.unpack_from('<ii', msg, 8)
                 self.cvar.notify_all()
-
-    def recv(self):
+        elif info_type == self.MSG_INFO_TYPE_VERSION:
+            with self.cvar:
+                if msg is None:
+                    self.versions[port_number] = 1
+                else:
+                    self.versions[port_number], = struct.unpack_from('<i', msg)
+                self.cvar.notify_all()
+            if self.peer_version() >= 3 and self.counters_period > 0:
+                self.__subscribe_ctrs(self.counters_period)
+
+    def __handle_ctrs_snapshot(self, count, msg):
+        snapshot = {}
+        for i in xrange(count):
+            port_number, rx, tx = struct.unpack_from('<iii', msg, i * 12)
+            snapshot[port_number] = (rx, tx)
+        with self.cvar:
+            self.nn_counters_snapshot = snapshot
+            self.nn_counters_snapshots += 1
+            self.cvar.notify_all()
+
+    def __parse_batch(self, count, msg):
+        pkts = []
+        offset = 0
+        timestamp = time.time()
+        for _ in xrange(count):
+            port_number, length = struct.unpack_from("<ii", msg, offset)
+            offset += 8
+            pkts.append((self.device_number, port_number,
+                         msg[offset:offset + length], timestamp))
+            offset += length
+        assert (offset == len(msg))
+        return pkts
+
+    def drain(self):
+        """
+        Receive one nanomsg message, which may carry several packets.
+        @retval List of (device, port, packet data, timestamp)
+        """
+        pkts = list(self.pending)
+        self.pending.clear()
         msg = self.socket.recv()
         fmt = "<iii"
         msg_type, port_number, more = struct.unpack_from(fmt, msg)
@@ -290,21 +549,55 @@ class DataPlanePacketSourceNN(DataPlanePacketSourceIface):
         msg = msg[hdr_size:]
         if msg_type == self.MSG_TYPE_INFO_REP:
             self.__handle_info_rep(port_number, more, msg)
-            # we return None (not a data packet)
-            return
+            # not a data packet
+            return pkts
+        if msg_type == self.MSG_TYPE_CTRS_SNAPSHOT:
+            # port_number is the number of ports in the snapshot
+            assert (len(msg) == more)
+            self.__handle_ctrs_snapshot(port_number, msg)
+            return pkts
+        if msg_type == self.MSG_TYPE_PACKET_OUT_BATCH:
+            # port_number is the number of packets in the batch
+            assert (len(msg) == more)
+            pkts.extend(self.__parse_batch(port_number, msg))
+            return pkts
         assert (msg_type == self.MSG_TYPE_PACKET_OUT)
         assert (len(msg) == more)
-        return (self.device_number, port_number, msg, time.time())
+        pkts.append((self.device_number, port_number, msg, time.time()))
+        return pkts
+
+    def recv(self):
+        if not self.pending:
+            self.pending.extend(self.drain())
+        if not self.pending:
+            # we return None (not a data packet)
+            return
+        return self.pending.popleft()
 
     def send(self, port_number, packet):
         msg = struct.pack("<iii%ds" % len(packet), self.MSG_TYPE_PACKET_IN,
                           port_number, len(packet), packet)
-        # because nnpy expects unicode when using str
-        msg = list(msg)
-        self.socket.send(msg)
+        nn_send(self.socket, msg)
         # nnpy does not return the number of bytes sent
         return len(packet)
 
+    def send_batch(self, port_number, packets):
+        """
+        Send several packets to a port, in a single message if the agent
+        supports it
+        """
+        if self.peer_version() < 2 or len(packets) < 2:
+            return sum([self.send(port_number, packet) for packet in packets])
+        payload = bytearray()
+        for packet in packets:
+            payload += struct.pack("<ii", port_number, len(packet))
+            payload += packet
+        msg = bytearray(struct.pack("<iii", self.MSG_TYPE_PACKET_IN_BATCH,
+                                    len(packets), len(payload)))
+        msg += payload
+        nn_send(self.socket, msg)
+        return sum([len(packet) for packet in packets])
+
     def get_info(self, port_number, cache, send_request, timeout=2):
         # we use a timeout in case other endpoint does not reply
         end = time.time() + timeout
@@ -319,11 +612,53 @@ class DataPlanePacketSourceNN(DataPlanePacketSourceIface):
     def get_mac(self, port_number, timeout=2):
         return self.get_info(port_number, self.mac_addresses, self.__request_mac, timeout)
 
-    def get_nn_counters(self, port_number, timeout=2):
+    def get_nn_counters(self, port_number, timeout=2, cached=False):
+        """
+        Return (rx, tx) for the port. If 'cached' is True, the counters last
+        pushed by the agent are returned when available, without waiting for
+        a reply.
+        """
+        snapshot = self.nn_counters_snapshot
+        if cached and snapshot is not None and port_number in snapshot:
+            return snapshot[port_number]
         if port_number in self.nn_counters:
             del self.nn_counters[port_number]
         return self.get_info(port_number, self.nn_counters, self.__request_ctrs, timeout)
 
+    def get_nn_counters_all(self, timeout=2, cached=False):
+        """
+        Return a dict from port number to (rx, tx) for all the ports of the
+        device, with a single request, or None if the agent does not support
+        it. If 'cached' is True, the counters last pushed by the agent are
+        returned when available, without waiting for a reply.
+        """
+        end = time.time() + timeout
+        self.get_info(0, self.versions, self.__request_version, timeout)
+        if self.peer_version() < 3:
+            return None
+        snapshot = self.nn_counters_snapshot
+        if cached and snapshot is not None:
+            return snapshot
+        with self.cvar:
+            snapshots = self.nn_counters_snapshots
+            self.__request_ctrs_all()
+            time_remaining = end - time.time()
+            while snapshots == self.nn_counters_snapshots and time_remaining > 0:
+                self.cvar.wait(time_remaining)
+                time_remaining = end - time.time()
+            if snapshots == self.nn_counters_snapshots:
+                return None
+            return self.nn_counters_snapshot
+
+    def get_nn_link_stats(self, port_number, timeout=2):
+        """
+        Return (number of times the link went up, latency in microseconds
+        between the last link up event and the agent capturing again), or
+        None if the agent does not report it
+        """
+        self.get_nn_counters(port_number, timeout)
+        return self.nn_link_stats.get(port_number, None)
+
 
 class DataPlanePortNN(DataPlanePortIface):
     """
@@ -331,6 +666,9 @@ class DataPlanePortNN(DataPlanePortIface):
     """
 
     RCV_TIMEOUT = 10000
+    # how often (in ms) the agent may push counters when they change, 0 to
+    # disable pushes
+    COUNTERS_PERIOD = 100
 
     # indexed by device_number, maps to a PacketInjectNN instance
     packet_injecters = {}
@@ -343,15 +681,24 @@ class DataPlanePortNN(DataPlanePortIface):
         self.interface_name = interface_name
         if device_number not in self.packet_injecters:
             self.packet_injecters[device_number] = DataPlanePacketSourceNN(
-                device_number, interface_name, self.RCV_TIMEOUT)
+                device_number, interface_name, self.RCV_TIMEOUT,
+                self.COUNTERS_PERIOD)
         self.packet_inject = self.packet_injecters[device_number]
         self.port_number = port_number
         self.device_number = device_number
         self.packet_inject.port_add(port_number)
 
     def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Remove the port from the agent. The nanomsg socket is shared by all
+        the ports of the device and stays open.
+        """
         if self.packet_inject:
             self.packet_inject.port_remove(self.port_number)
+            self.packet_inject = None
 
     def get_packet_source(self):
         """
@@ -368,6 +715,15 @@ class DataPlanePortNN(DataPlanePortIface):
         return self.packet_injecters[self.device_number].send(
             self.port_number, packet)
 
+    def send_batch(self, packets):
+        """
+        Send several packets out this port.
+        @param packets List of packet data to send to the port
+        @retval The number of bytes sent
+        """
+        return self.packet_injecters[self.device_number].send_batch(
+            self.port_number, packets)
+
     def down(self):
         """
         Bring the physical link down.
@@ -389,11 +745,25 @@ class DataPlanePortNN(DataPlanePortIface):
         return self.packet_injecters[self.device_number].get_mac(
             self.port_number)
 
-    def nn_counters(self):
+    def nn_counters(self, cached=False):
         """
         Return counters
         """
         return self.packet_injecters[self.device_number].get_nn_counters(
+            self.port_number, cached=cached)
+
+    def nn_counters_all(self, cached=False):
+        """
+        Return counters for all the ports of the device
+        """
+        return self.packet_injecters[self.device_number].get_nn_counters_all(
+            cached=cached)
+
+    def nn_link_stats(self):
+        """
+        Return link up statistics
+        """
+        return self.packet_injecters[self.device_number].get_nn_link_stats(
             self.port_number)
 
 
@@ -420,8 +790,15 @@ class DataPlanePort(DataPlanePortIface, DataPlanePacketSourceIface):
         self.socket.settimeout(self.RCV_TIMEOUT)
 
     def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Close the port socket.
+        """
         if self.socket:
             self.socket.close()
+            self.socket = None
 
     def fileno(self):
         """
@@ -502,6 +879,78 @@ class DataPlanePortPcap:
     def up(self):
         pass
 
+    def close(self):
+        if self.pcap is not None and hasattr(self.pcap, "close"):
+            self.pcap.close()
+        self.pcap = None
+
+class PortCounters(object):
+    """
+    Packet and byte counters for all the ports of a device, stored in arrays
+    indexed by port number
+    """
+    FIELDS = ("rx_packets", "rx_bytes", "tx_packets", "tx_bytes")
+
+    def __init__(self, size=0, timestamp=None):
+        for field in self.FIELDS:
+            setattr(self, field, array('L', [0]) * size)
+        self.timestamp = timestamp
+
+    def __len__(self):
+        return len(self.rx_packets)
+
+    def grow(self, port_number):
+        missing = port_number + 1 - len(self)
+        if missing > 0:
+            for field in self.FIELDS:
+                counters = getattr(self, field)
+                counters.extend(array(counters.typecode, [0]) * missing)
+
+    def add_rx(self, port_number, nbytes):
+        if port_number >= len(self):
+            self.grow(port_number)
+        self.rx_packets[port_number] += 1
+        self.rx_bytes[port_number] += nbytes
+
+    def add_tx(self, port_number, npackets, nbytes):
+        if port_number >= len(self):
+            self.grow(port_number)
+        self.tx_packets[port_number] += npackets
+        self.tx_bytes[port_number] += nbytes
+
+    def get(self, port_number):
+        """
+        Return (rx packets, rx bytes, tx packets, tx bytes) for a port
+        """
+        if port_number >= len(self):
+            return (0, 0, 0, 0)
+        return tuple([int(getattr(self, field)[port_number])
+                      for field in self.FIELDS])
+
+    def copy(self):
+        other = PortCounters(timestamp=time.time())
+        for field in self.FIELDS:
+            setattr(other, field, array('L', getattr(self, field)))
+        return other
+
+    def diff(self, older):
+        """
+        Return the counters accumulated between 'older' and this snapshot.
+        The differences are signed: they are negative for the counters which
+        went backwards, e.g. if the snapshots are passed in the wrong order.
+        """
+        result = PortCounters(timestamp=self.timestamp)
+        size = max(len(self), len(older))
+        for field in self.FIELDS:
+            current, previous = getattr(self, field), getattr(older, field)
+            delta = array('l', [0]) * size
+            for i in xrange(size):
+                delta[i] = ((current[i] if i < len(current) else 0) -
+                            (previous[i] if i < len(previous) else 0))
+            setattr(result, field, delta)
+        return result
+
+
 class DataPlane(Thread):
     """
     This class provides methods to send and receive packets on the dataplane.
@@ -512,6 +961,10 @@ class DataPlane(Thread):
     """
 
     MAX_QUEUE_LEN = 100
+    RX_LATENCY_SAMPLES = 10000
+    # upper bounds (in seconds) of the enqueue-to-poll latency histogram
+    # buckets, the last bucket counts everything above the last bound
+    QUEUE_LATENCY_BUCKETS = (0.001, 0.01, 0.1, 1.0, 10.0)
 
     def __init__(self, config=None):
         Thread.__init__(self)
@@ -519,14 +972,35 @@ class DataPlane(Thread):
         # dict from device number, port number to port object
         self.ports = {}
 
-        # dict from device number, port number to list of (timestamp, packet)
+        # dict from device number, port number to bounded deque of
+        # (packet, timestamp)
         self.packet_queues = {}
 
-        # counters of received packets (may include packets which were dropped due to queue overflow)
-        self.rx_counters = defaultdict(int)
+        # dict from device number to a heap of (timestamp, seq, port number,
+        # queue entry) tuples, one for every packet that became the head of
+        # its port queue. Entries whose packet is no longer at the head of
+        # its queue are stale and are discarded lazily.
+        self.oldest_index = defaultdict(list)
+        self.oldest_seq = itertools.count()
+
+        # dict from device number to PortCounters; receive counters may
+        # include packets which were dropped due to queue overflow, see
+        # queue_stats. Updated with cvar held.
+        self.counters = defaultdict(PortCounters)
+
+        # dict from device number, port number to queue statistics, see
+        # get_queue_stats
+        self.queue_stats = {}
+
+        # time of the last packet received on each device and port, and of
+        # the last packet sent on each device, used to detect quiescence
+        self.last_rx_time = {}
+        self.device_last_rx_time = defaultdict(float)
+        self.device_last_tx_time = defaultdict(float)
 
-        # counters of transmited packets
-        self.tx_counters = defaultdict(int)
+        # dict from device number to the time elapsed between the last
+        # packet sent and every packet received, to tune quiet windows
+        self.rx_latencies = defaultdict(lambda: deque(maxlen=self.RX_LATENCY_SAMPLES))
 
         # cvar serves double duty as a regular top level lock and
         # as a condition variable
@@ -536,8 +1010,20 @@ class DataPlane(Thread):
         self.waker = ptfutils.EventDescriptor()
         self.killed = False
 
+        # dict from file descriptor to [packet source, number of ports using
+        # it]. Sources are registered with the event loop once, in port_add.
+        self.sources = {}
+        if hasattr(select, "epoll"):
+            self.poller = select.epoll()
+            self.poller.register(self.waker.fileno(), select.EPOLLIN)
+        else:
+            self.poller = None
+
         self.logger = logging.getLogger("dataplane")
         self.pcap_writer = None
+        # BPF program attached to the ports which support it, see
+        # set_kernel_filter
+        self.kernel_filter = None
 
 
         if config is None:
@@ -561,6 +1047,8 @@ class DataPlane(Thread):
             self.dppclass = DataPlanePortNN
         elif "dataplane" in self.config and "portclass" in self.config["dataplane"]:
             self.dppclass = self.config["dataplane"]["portclass"]
+        elif "linux" in sys.platform and self.config.get("rx_ring"):
+            self.dppclass = DataPlanePortLinuxMmap
         elif "linux" in sys.platform:
             self.dppclass = DataPlanePortLinux
         elif have_pypcap:
@@ -581,44 +1069,162 @@ class DataPlane(Thread):
         Activity function for class
         """
         while not self.killed:
-            sockets = set([p.get_packet_source() for p in self.ports.values()])
-            sockets.add(self.waker)
             try:
-                sel_in, sel_out, sel_err = select.select(sockets, [], [], 1)
+                ready = self.wait_sources(1)
             except:
                 print sys.exc_info()
                 self.logger.error("Select error, exiting")
                 break
 
             with self.cvar:
-                for sel in sel_in:
-                    if sel == self.waker:
+                for source in ready:
+                    if source == self.waker:
                         self.waker.wait()
                         continue
-                    else:
+                    if not self.is_registered(source):
+                        # Removed (and closed) since the wait returned
+                        continue
+                    for t in source.drain():
                         # Enqueue packet
-                        t = sel.recv()
-                        if t is None:
-                            continue
                         device_number, port_number, pkt, timestamp = t
                         self.logger.debug("Pkt len %d in on device %d, port %d",
                                           len(pkt), device_number, port_number)
                         if self.pcap_writer:
                             self.pcap_writer.write(pkt, timestamp,
                                                    device_number, port_number)
-                        queue = self.packet_queues[(device_number, port_number)]
-                        if len(queue) >= self.qlen:
-                            # Queue full, throw away oldest
-                            queue.pop(0)
-                            self.logger.debug("Discarding oldest packet to make room")
-                        queue.append((pkt, timestamp))
-                        self.rx_counters[(device_number, port_number)] += 1
+                        self.enqueue(device_number, port_number, pkt, timestamp)
                 self.cvar.notify_all()
 
         self.logger.info("Thread exit")
 
+    def wait_sources(self, timeout):
+        """
+        Wait until some packet sources (or the waker) are readable.
+        @retval List of readable sources
+        """
+        if self.poller is None:
+            sources = [s for s, _ in self.sources.values()]
+            sources.append(self.waker)
+            try:
+                return select.select(sources, [], [], timeout)[0]
+            except (select.error, socket.error, ValueError):
+                with self.cvar:
+                    if all(self.is_registered(s) for s in sources[:-1]):
+                        raise
+                # A port was removed and closed meanwhile, the next wait
+                # uses the remaining sources
+                return []
+        ready = []
+        for fd, _ in self.poller.poll(timeout):
+            if fd == self.waker.fileno():
+                ready.append(self.waker)
+                continue
+            entry = self.sources.get(fd)
+            if entry is not None:
+                ready.append(entry[0])
+        return ready
+
+    def is_registered(self, source):
+        """
+        Tell if a packet source is registered. Must be called with cvar held.
+        """
+        for registered, _ in self.sources.values():
+            if registered is source:
+                return True
+        return False
+
+    def register_source(self, source):
+        fd = source.fileno()
+        with self.cvar:
+            if fd in self.sources:
+                self.sources[fd][1] += 1
+                return
+            self.sources[fd] = [source, 1]
+            if self.poller is not None:
+                self.poller.register(fd, select.EPOLLIN)
+        if self.poller is None:
+            # Need to wake up event loop to change the sockets being selected on.
+            self.waker.notify()
+
+    def unregister_source(self, source):
+        fd = source.fileno()
+        with self.cvar:
+            if fd not in self.sources:
+                return
+            self.sources[fd][1] -= 1
+            if self.sources[fd][1] > 0:
+                return
+            del self.sources[fd]
+            if self.poller is not None:
+                self.poller.unregister(fd)
+        if self.poller is None:
+            self.waker.notify()
+
+    def enqueue(self, device_number, port_number, pkt, timestamp):
+        """
+        Append a received packet to its port queue, discarding the oldest
+        packet if the queue is full. Must be called with cvar held.
+        """
+        port_id = (device_number, port_number)
+        queue = self.packet_queues[port_id]
+        stats = self.queue_stats[port_id]
+        if len(queue) >= self.qlen:
+            # Queue full, throw away oldest
+            queue.popleft()
+            stats["dropped"] += 1
+            self.logger.debug("Discarding oldest packet to make room")
+            self.index_head(port_id)
+        queue.append((pkt, timestamp))
+        stats["enqueued"] += 1
+        stats["high_water"] = max(stats["high_water"], len(queue))
+        if len(queue) == 1:
+            self.index_head(port_id)
+        self.counters[device_number].add_rx(port_number, len(pkt))
+        self.last_rx_time[port_id] = timestamp
+        self.device_last_rx_time[device_number] = max(
+            self.device_last_rx_time[device_number], timestamp)
+        if self.device_last_tx_time[device_number]:
+            self.rx_latencies[device_number].append(
+                timestamp - self.device_last_tx_time[device_number])
+
+    def index_head(self, port_id):
+        """
+        Record the packet at the head of a port queue in the oldest packet
+        index of its device. Must be called whenever the head changes.
+        """
+        queue = self.packet_queues[port_id]
+        if not queue:
+            return
+        device_number, port_number = port_id
+        heap = self.oldest_index[device_number]
+        if len(heap) > 4 * len(self.packet_queues) + 64:
+            # Too many stale entries (polling on specific ports never pops
+            # them), rebuild the index from the queue heads
+            heap[:] = [e for e in heap if self.is_head(device_number, e)]
+            heapq.heapify(heap)
+        entry = queue[0]
+        heapq.heappush(heap, (entry[1], next(self.oldest_seq), port_number,
+                              entry))
+
+    def is_head(self, device_number, index_entry):
+        queue = self.packet_queues.get((device_number, index_entry[2]))
+        return bool(queue) and queue[0] is index_entry[3]
+
+    def reindex(self):
+        """
+        Rebuild the oldest packet index from scratch.
+        """
+        self.oldest_index.clear()
+        for port_id in self.packet_queues.keys():
+            self.index_head(port_id)
+
     def set_qlen(self, qlen):
-        self.qlen = qlen
+        with self.cvar:
+            self.qlen = qlen
+            for port_id, queue in self.packet_queues.items():
+                self.queue_stats[port_id]["dropped"] += max(0, len(queue) - qlen)
+                self.packet_queues[port_id] = deque(queue, maxlen=qlen)
+            self.reindex()
 
     def port_add(self, interface_name, device_number, port_number):
         """
@@ -633,9 +1239,50 @@ class DataPlane(Thread):
                                             device_number, port_number)
         self.ports[port_id]._port_number = port_number
         self.ports[port_id]._device_number = device_number
-        self.packet_queues[port_id] = []
-        # Need to wake up event loop to change the sockets being selected on.
-        self.waker.notify()
+        self.packet_queues[port_id] = deque(maxlen=self.qlen)
+        self.queue_stats[port_id] = self.new_queue_stats()
+        if self.kernel_filter is not None:
+            self.apply_kernel_filter(self.ports[port_id])
+        self.register_source(self.ports[port_id].get_packet_source())
+
+    def apply_kernel_filter(self, port):
+        if not hasattr(port, "set_filter"):
+            return
+        try:
+            port.set_filter(self.kernel_filter)
+        except socket.error as e:
+            self.logger.warning("Cannot attach BPF filter to %s: %s",
+                                port.interface_name, e)
+
+    def set_kernel_filter(self, predicates):
+        """
+        Only receive, on the ports which support it, the packets satisfying
+        all the given ptf.bpf predicates; the filtering happens in the
+        kernel. Remove the filter if 'predicates' is empty or None. Ports
+        which do not support BPF (e.g. nanomsg ports) are not affected.
+        """
+        if predicates:
+            self.kernel_filter = bpf.compile(predicates)
+        else:
+            self.kernel_filter = None
+        for port in self.ports.values():
+            self.apply_kernel_filter(port)
+
+    def port_remove(self, device_number, port_number):
+        """
+        Remove a port from the dataplane, drop its queued packets and close it
+        @param device_number, port_number The port to remove
+        """
+        port_id = (device_number, port_number)
+        with self.cvar:
+            # The receive thread drains the sources with cvar held, so the
+            # port is not in use while it is closed
+            port = self.ports.pop(port_id)
+            self.unregister_source(port.get_packet_source())
+            del self.packet_queues[port_id]
+            del self.queue_stats[port_id]
+            if hasattr(port, "close"):
+                port.close()
 
     def send(self, device_number, port_number, packet):
         """
@@ -649,31 +1296,57 @@ class DataPlane(Thread):
             self.pcap_writer.write(packet, time.time(),
                                    device_number, port_number)
         bytes = self.ports[(device_number, port_number)].send(packet)
-        self.tx_counters[(device_number, port_number)] += 1
+        with self.cvar:
+            self.counters[device_number].add_tx(port_number, 1, len(packet))
+        self.device_last_tx_time[device_number] = time.time()
         if bytes != len(packet):
             self.logger.error("Unhandled send error, length mismatch %d != %d" %
                      (bytes, len(packet)))
         return bytes
 
+    def send_batch(self, device_number, port_number, packets):
+        """
+        Send several packets to the given port, with a single log message,
+        pcap write and counter update for the whole batch
+        @param device_number, port_number The port to send the data to
+        @param packets List of raw packet data to send to port
+        """
+        self.logger.debug("Sending %d packets to device %d, port %d" %
+                          (len(packets), device_number, port_number))
+        if self.pcap_writer:
+            self.pcap_writer.write_batch(packets, time.time(),
+                                         device_number, port_number)
+        port = self.ports[(device_number, port_number)]
+        if hasattr(port, "send_batch"):
+            bytes = port.send_batch(packets)
+        else:
+            bytes = sum([port.send(packet) for packet in packets])
+        expected = sum([len(packet) for packet in packets])
+        with self.cvar:
+            self.counters[device_number].add_tx(port_number, len(packets),
+                                                expected)
+        self.device_last_tx_time[device_number] = time.time()
+        if bytes != expected:
+            self.logger.error("Unhandled send error, length mismatch %d != %d" %
+                     (bytes, expected))
+        return bytes
+
     def oldest_port_number(self, device):
         """
         Returns the port number with the oldest packet,
         or None if no packets are queued.
         """
-        min_port_number = None
-        min_time = float('inf')
-        for (port_id, queue) in self.packet_queues.items():
-            if port_id[0] != device:
-                continue
-            if queue and queue[0][1] < min_time:
-                min_time = queue[0][1]
-                min_port_number = port_id[1]
-        return min_port_number
+        heap = self.oldest_index[device]
+        while heap:
+            if self.is_head(device, heap[0]):
+                return heap[0][2]
+            heapq.heappop(heap)
+        return None
 
     # Dequeues and yields packets in the order they were received.
     # Yields (port, packet, received time).
     # If port is not specified yields packets from all ports.
-    def packets(self, device, port=None):
+    def packets(self, device, port=None, consume=True):
         while True:
             if port is None:
                 rcv_port = self.oldest_port_number(device)
@@ -691,10 +1364,101 @@ class DataPlane(Thread):
                                   device, rcv_port)
                 break
 
-            pkt, time = queue.pop(0)
-            yield (rcv_port, pkt, time)
+            pkt, pkt_time = queue.popleft()
+            self.index_head((device, rcv_port))
+            if consume:
+                self.count_consumed((device, rcv_port), pkt_time)
+            yield (rcv_port, pkt, pkt_time)
+
+    def new_queue_stats(self):
+        return {
+            "enqueued": 0,
+            "dropped": 0,
+            "consumed": 0,
+            "flushed": 0,
+            "high_water": 0,
+            "latency": [0] * (len(self.QUEUE_LATENCY_BUCKETS) + 1),
+        }
+
+    def count_consumed(self, port_id, pkt_time, now=None):
+        stats = self.queue_stats[port_id]
+        stats["consumed"] += 1
+        latency = (now or time.time()) - pkt_time
+        bucket = 0
+        while bucket < len(self.QUEUE_LATENCY_BUCKETS) and \
+              latency > self.QUEUE_LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        stats["latency"][bucket] += 1
+
+    def get_queue_stats(self, device_number, port_number):
+        """
+        Get the queue statistics of a port, as a dict:
+        'enqueued': packets added to the queue
+        'dropped': packets discarded because the queue was full
+        'consumed': packets dequeued by poll (whether they matched or not)
+        'flushed': packets discarded by flush
+        'high_water': maximum queue length
+        'latency': histogram of the time packets spent in the queue before
+        being consumed, with the bucket bounds in QUEUE_LATENCY_BUCKETS
+        """
+        with self.cvar:
+            stats = dict(self.queue_stats[(device_number, port_number)])
+            stats["latency"] = list(stats["latency"])
+            return stats
+
+    def reset_queue_stats(self):
+        with self.cvar:
+            for port_id in self.queue_stats.keys():
+                self.queue_stats[port_id] = self.new_queue_stats()
+
+    def dump_queue_stats(self, reset=True):
+        """
+        Log the queue statistics of every port which saw traffic, with a
+        warning for ports which dropped packets because their queue was full.
+        Meant to be called at the end of each test.
+        """
+        for port_id in sorted(self.queue_stats.keys()):
+            stats = self.get_queue_stats(*port_id)
+            if not stats["enqueued"]:
+                continue
+            log = self.logger.warning if stats["dropped"] else self.logger.info
+            log("Queue stats device %d, port %d: enqueued %d, dropped %d, "
+                "consumed %d, flushed %d, high water %d/%d, latency %s",
+                port_id[0], port_id[1], stats["enqueued"], stats["dropped"],
+                stats["consumed"], stats["flushed"], stats["high_water"],
+                self.qlen, stats["latency"])
+        if reset:
+            self.reset_queue_stats()
+
+    def quiet_time_remaining(self, device_number, quiet_window, since=0):
+        """
+        Return how long until no packet has been sent or received on the
+        device for quiet_window seconds (zero or less if that is already the
+        case).
+        @param since Start of the wait: the device is not quiet before
+        quiet_window seconds have elapsed since then either, even if it has
+        never sent or received anything
+        """
+        last_activity = max(self.device_last_tx_time[device_number],
+                            self.device_last_rx_time[device_number], since)
+        return last_activity + quiet_window - time.time()
+
+    def rx_latency_percentiles(self, device_number, percentiles=(50, 90, 99, 100)):
+        """
+        Return a dict from percentile to the time elapsed between the last
+        packet sent and a packet received on the device, over the last
+        RX_LATENCY_SAMPLES received packets. Useful to pick a quiet window
+        for negative checks.
+        """
+        with self.cvar:
+            samples = sorted(self.rx_latencies[device_number])
+        if not samples:
+            return {}
+        return dict([(p, samples[min(len(samples) - 1, len(samples) * p / 100)])
+                     for p in percentiles])
 
-    def poll(self, device_number=0, port_number=None, timeout=-1, exp_pkt=None, filters=[]):
+    def poll(self, device_number=0, port_number=None, timeout=-1, exp_pkt=None, filters=[],
+             quiet_window=None):
         """
         Poll one or all dataplane ports for a packet
 
@@ -712,6 +1476,9 @@ class DataPlane(Thread):
         @param exp_pkt If not None, look for this packet and ignore any
         others received.  Note that if port_number is None, all packets
         from all ports will be discarded until the exp_pkt is found
+        @param quiet_window If not None, stop waiting before the timeout once
+        no packet has been sent or received on the device for this many
+        seconds, and the call has lasted at least as long
         @return The tuple device_number, port_number, packet, pkt_time where
         packet is received from device_number, port_number at time pkt_time.  If
         a timeout occurs, return None, None, None, None
@@ -722,8 +1489,15 @@ class DataPlane(Thread):
                 if not f(pkt): return False
             return True
 
-        if exp_pkt and (port_number is None):
-            self.logger.warn("Dataplane poll with exp_pkt but no port number")
+        # serialize the expected packet once, not for every queued packet
+        # and every wakeup
+        exp_pkt_match = None
+        if exp_pkt is not None and not isinstance(exp_pkt, mask.Mask):
+            exp_pkt = str(exp_pkt)
+        if exp_pkt:
+            exp_pkt_match = compile_exp_pkt(exp_pkt)
+            if port_number is None:
+                self.logger.warn("Dataplane poll with exp_pkt but no port number")
 
         # Retrieve the packet. Returns (device number, port number, packet, time).
         def grab():
@@ -735,13 +1509,20 @@ class DataPlane(Thread):
                 if not filter_check(pkt):
                     self.logger.debug("Paket does not match filter, discarding")
                     continue
-                if not exp_pkt or match_exp_pkt(exp_pkt, pkt):
+                if not exp_pkt_match or exp_pkt_match(pkt):
                     return (rcv_device_number, rcv_port_number, pkt, time)
             self.logger.debug("Did not find packet")
             return None
 
+        quiet_fn = None
+        if quiet_window is not None:
+            start = time.time()
+            quiet_fn = lambda: self.quiet_time_remaining(device_number,
+                                                         quiet_window, start)
+
         with self.cvar:
-            ret = ptfutils.timed_wait(self.cvar, grab, timeout=timeout)
+            ret = ptfutils.timed_wait(self.cvar, grab, timeout=timeout,
+                                      quiet_fn=quiet_fn)
 
         if ret != None:
             return ret
@@ -750,6 +1531,111 @@ class DataPlane(Thread):
                               device_number, port_number)
             return (None, None, None, None)
 
+    def grab_batch(self, device_number, ports):
+        """
+        Dequeue all the packets queued for the given ports (all ports of the
+        device if None), oldest first. They are not counted as consumed
+        until settle_batch is called. Must be called with cvar held.
+        @retval List of (port number, packet, received time), or None if no
+        packet was queued
+        """
+        if ports is None:
+            batch = list(self.packets(device_number, consume=False))
+        else:
+            batch = []
+            for port in ports:
+                if (device_number, port) in self.packet_queues:
+                    batch.extend(self.packets(device_number, port,
+                                              consume=False))
+            if len(ports) > 1:
+                batch.sort(key=lambda entry: entry[2])
+        return batch or None
+
+    def settle_batch(self, device_number, batch, consumed, grab_time):
+        """
+        Count the first 'consumed' packets of a batch returned by grab_batch
+        as consumed, and put the other ones back at the head of their queues.
+        A packet which no longer fits in its queue is dropped, as the oldest
+        packet of the queue. Must be called with cvar held.
+        @param grab_time Time the batch was dequeued
+        """
+        for (port_number, pkt, pkt_time) in batch[:consumed]:
+            port_id = (device_number, port_number)
+            if port_id in self.queue_stats:
+                self.count_consumed(port_id, pkt_time, grab_time)
+        requeued = set()
+        for (port_number, pkt, pkt_time) in reversed(batch[consumed:]):
+            port_id = (device_number, port_number)
+            queue = self.packet_queues.get(port_id)
+            if queue is None:
+                continue
+            if len(queue) >= self.qlen:
+                self.queue_stats[port_id]["dropped"] += 1
+                continue
+            queue.appendleft((pkt, pkt_time))
+            requeued.add(port_id)
+        for port_id in requeued:
+            self.index_head(port_id)
+
+    def stream(self, device_number=0, ports=None, timeout=-1, until=None,
+               filters=[], quiet_window=None):
+        """
+        Generator yielding packets received on one, several or all ports of
+        a device as they arrive
+
+        Unlike poll, all the packets already queued are dequeued at once, so
+        cvar is taken once per batch of packets rather than once per packet.
+        Packets for other ports stay queued. If the caller stops iterating
+        early, the packets of the current batch which were not yielded are
+        put back at the head of their queues.
+
+        @param device_number Get packets from this device
+        @param ports Port number or list of port numbers, None for all ports
+        @param timeout Stop once no packet has been received for this many
+        seconds
+        @param until If not None, stop at this time (as returned by time.time())
+        @param filters Only yield packets for which all of these return True
+        @param quiet_window If not None, stop waiting once no packet has been
+        sent or received on the device for this many seconds, and the stream
+        has lasted at least as long
+        @return Yields (device number, port number, packet, received time)
+        """
+        if timeout == -1:
+            timeout = ptfutils.default_timeout
+        if isinstance(ports, (int, long)):
+            ports = [ports]
+
+        quiet_fn = None
+        if quiet_window is not None:
+            start = time.time()
+            quiet_fn = lambda: self.quiet_time_remaining(device_number,
+                                                         quiet_window, start)
+
+        grab = lambda: self.grab_batch(device_number, ports)
+        while True:
+            wait = timeout
+            if until is not None:
+                wait = min(wait, until - time.time())
+                if wait < 0:
+                    return
+            with self.cvar:
+                batch = ptfutils.timed_wait(self.cvar, grab, timeout=wait,
+                                            quiet_fn=quiet_fn)
+            if batch is None:
+                return
+            grab_time = time.time()
+            consumed = 0
+            try:
+                for (port_number, pkt, pkt_time) in batch:
+                    consumed += 1
+                    if filters and not all([f(pkt) for f in filters]):
+                        continue
+                    yield (device_number, port_number, pkt, pkt_time)
+            finally:
+                with self.cvar:
+                    self.settle_batch(device_number, batch, consumed,
+                                      grab_time)
+
     def kill(self):
         """
         Stop the dataplane thread.
@@ -757,8 +1643,11 @@ class DataPlane(Thread):
         self.killed = True
         self.waker.notify()
         self.join()
+        if self.poller is not None:
+            self.poller.close()
         # Explicitly release ports to ensure we don't run out of sockets
         # even if someone keeps holding a reference to the dataplane.
+        self.sources.clear()
         del self.ports
 
     def port_down(self, device_number, port_number):
@@ -775,27 +1664,75 @@ class DataPlane(Thread):
 
     def get_counters(self, device_number, port_number):
         """Get the counters mac"""
-        return self.rx_counters[(device_number, port_number)], \
-               self.tx_counters[(device_number, port_number)]
+        with self.cvar:
+            counters = self.counters[device_number].get(port_number)
+        return counters[0], counters[2]
+
+    def snapshot(self, device_number):
+        """
+        Return a copy of the counters of all the ports of a device, taken
+        atomically with respect to the receive thread
+        @retval PortCounters, with arrays indexed by port number
+        """
+        with self.cvar:
+            return self.counters[device_number].copy()
+
+    def diff(self, older, newer):
+        """
+        Return the counters accumulated between two snapshots of a device
+        @retval PortCounters, with arrays indexed by port number
+        """
+        return newer.diff(older)
 
-    def get_nn_counters(self, device_number, port_number):
+    def get_nn_counters(self, device_number, port_number, cached=False):
         """Get the specified port counters from nn agent """
-        return self.ports[(device_number, port_number)].nn_counters()
+        return self.ports[(device_number, port_number)].nn_counters(cached)
+
+    def get_nn_counters_all(self, device_number, cached=False):
+        """
+        Get the counters of all the ports of a device from nn agent, as a dict
+        from port number to (rx, tx)
+        """
+        ports = [port for (device, port) in self.ports.keys()
+                 if device == device_number]
+        if not ports:
+            return {}
+        counters = self.ports[(device_number, ports[0])].nn_counters_all(cached)
+        if counters is None:
+            # agent does not support snapshots
+            return dict([(port, self.get_nn_counters(device_number, port))
+                         for port in ports])
+        return dict([(port, counters.get(port, None)) for port in ports])
+
+    def get_nn_link_stats(self, device_number, port_number):
+        """
+        Get the specified port link up count and latency from nn agent
+        """
+        return self.ports[(device_number, port_number)].nn_link_stats()
 
     def flush(self):
         """
         Drop any queued packets.
         """
-        for port_id in self.packet_queues.keys():
-            self.packet_queues[port_id] = []
+        with self.cvar:
+            for port_id, queue in self.packet_queues.items():
+                self.queue_stats[port_id]["flushed"] += len(queue)
+                queue.clear()
+            self.oldest_index.clear()
 
     def start_pcap(self, filename):
         assert(self.pcap_writer == None)
-        self.pcap_writer = PcapWriter(filename)
+        self.pcap_writer = PcapWriter(filename,
+                                      max_size=self.config.get("pcap_max_size"),
+                                      max_age=self.config.get("pcap_max_age"))
 
     def stop_pcap(self):
         if self.pcap_writer:
             with self.cvar:
-                self.pcap_writer.close()
+                pcap_writer = self.pcap_writer
                 self.pcap_writer = None
                 self.cvar.notify_all()
+            pcap_writer.close()
+            if pcap_writer.dropped:
+                self.logger.warning("%d packets were not captured, pcap writer queue full",
+                                    pcap_writer.dropped)
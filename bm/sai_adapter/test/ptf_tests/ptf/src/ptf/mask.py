@@ -1,19 +1,38 @@
+import binascii
 import packet as scapy
 
+try:
+    import numpy
+    with_numpy = True
+except ImportError:
+    with_numpy = False
+
+def bytes_to_int(data):
+    if not data:
+        return 0
+    return int(binascii.hexlify(data), 16)
+
 class Mask:
     def __init__(self, exp_pkt):
         self.exp_pkt = exp_pkt
         self.size = len(str(exp_pkt))
         self.valid = True
         self.mask = [0xff] * self.size
+        # (mask, masked expected packet) as integers, see compile()
+        self.compiled = None
 
     def set_do_not_care(self, offset, bitwidth):
-        # a very naive but simple method
-        # we do it bit by bit :)
-        for idx in xrange(offset, offset + bitwidth):
-            offsetB = idx / 8
-            offsetb = idx % 8
-            self.mask[offsetB] = self.mask[offsetB] & (~(1 << (7 - offsetb)))
+        # clear whole bytes at once, with partial masks for the first and last
+        # bytes if the range is not byte-aligned
+        end = offset + bitwidth
+        while offset < end:
+            offsetB = offset / 8
+            first = offset % 8
+            last = min(8, first + end - offset)
+            bits = (0xff >> first) & (0xff << (8 - last))
+            self.mask[offsetB] &= ~bits & 0xff
+            offset += last - first
+        self.compiled = None
 
     def set_do_not_care_scapy(self, hdr_type, field_name):
         if hdr_type not in self.exp_pkt:
@@ -43,16 +62,46 @@ class Mask:
     def is_valid(self):
         return self.valid
 
+    def compile(self):
+        """
+        Serialize the expected packet and the mask once, as integers, so that
+        matching a packet is a single masked comparison. Called lazily, and
+        again after the mask changes.
+        """
+        mask = bytes_to_int(''.join([chr(b) for b in self.mask]))
+        self.compiled = (mask, bytes_to_int(str(self.exp_pkt)) & mask)
+        return self.compiled
+
     def pkt_match(self, pkt):
         # just to be on the safe side
         pkt = str(pkt)
         if len(pkt) != self.size:
             return False
-        exp_pkt = str(self.exp_pkt)
-        for i in xrange(self.size):
-            if (ord(exp_pkt[i]) & self.mask[i]) != (ord(pkt[i]) & self.mask[i]):
-                return False
-        return True
+        mask, exp = self.compiled or self.compile()
+        return bytes_to_int(pkt) & mask == exp
+
+    def match_many(self, pkts):
+        """
+        Match a list of packets against the mask
+        @retval List of booleans, one per packet
+        """
+        pkts = [str(pkt) for pkt in pkts]
+        if not with_numpy:
+            return [self.pkt_match(pkt) for pkt in pkts]
+        result = [False] * len(pkts)
+        candidates = [i for i, pkt in enumerate(pkts) if len(pkt) == self.size]
+        if not candidates or not self.size:
+            for i in candidates:
+                result[i] = True
+            return result
+        mask = numpy.array(self.mask, dtype=numpy.uint8)
+        exp = numpy.frombuffer(str(self.exp_pkt), dtype=numpy.uint8) & mask
+        data = numpy.frombuffer(''.join([pkts[i] for i in candidates]),
+                                dtype=numpy.uint8).reshape(-1, self.size)
+        matches = ((data & mask) == exp).all(axis=1)
+        for i, match in zip(candidates, matches):
+            result[i] = bool(match)
+        return result
 
     def __str__(self):
         assert(self.valid)
@@ -68,5 +117,9 @@ def utest():
     assert(not m.pkt_match(p1))
     m.set_do_not_care_scapy(scapy.TCP, "chksum")
     assert(m.pkt_match(p1))
+    assert(m.match_many([p, p1, str(p)[:-1]]) == [True, True, False])
+    m = Mask(p)
+    m.set_do_not_care(3, 10)
+    assert(m.mask[:3] == [0xe0, 0x07, 0xff])
 
 utest()
@@ -0,0 +1,280 @@
+"""
+Packet templates
+
+Building packets with scapy is slow, which matters for tests sending many
+variants of the same packet (e.g. hash tests changing addresses and ports).
+A PacketTemplate serializes a packet once and then produces variants by
+patching fields directly in the serialized data, updating the IPv4, TCP and
+UDP checksums incrementally (RFC 1624) rather than recomputing them.
+
+    tmpl = PacketTemplate(simple_udp_packet(eth_dst=router_mac))
+    exp_tmpl = PacketTemplate(simple_udp_packet(eth_src=router_mac, ip_ttl=63))
+    for i in xrange(1000):
+        pkt = tmpl.build(ip_src=ips[i], udp_sport=1000 + i)
+        exp_pkt = exp_tmpl.mask(["eth_dst"], ip_src=ips[i], udp_sport=1000 + i)
+
+Field names follow the simple_*_packet arguments (see FIELDS). They refer to
+the outermost header of their type; prefix them with "inner_" for the second
+one, e.g. inner_ip_src in a VXLAN packet.
+"""
+
+import binascii
+import socket
+import struct
+
+import mask
+import packet as scapy
+
+def mac_to_int(mac):
+    return int(mac.replace(':', ''), 16)
+
+def ipv4_to_int(ip):
+    return struct.unpack("!I", socket.inet_aton(ip))[0]
+
+def ipv6_to_int(ip):
+    return int(binascii.hexlify(socket.inet_pton(socket.AF_INET6, ip)), 16)
+
+# field name: (header type, bit offset in the header, bit width, conversion
+# to an integer)
+FIELDS = {
+    "eth_dst":   (scapy.Ether, 0, 48, mac_to_int),
+    "eth_src":   (scapy.Ether, 48, 48, mac_to_int),
+    "vlan_pcp":  (scapy.Dot1Q, 0, 3, int),
+    "vlan_vid":  (scapy.Dot1Q, 4, 12, int),
+    "ip_tos":    (scapy.IP, 8, 8, int),
+    "ip_id":     (scapy.IP, 32, 16, int),
+    "ip_ttl":    (scapy.IP, 64, 8, int),
+    "ip_src":    (scapy.IP, 96, 32, ipv4_to_int),
+    "ip_dst":    (scapy.IP, 128, 32, ipv4_to_int),
+    "tcp_sport": (scapy.TCP, 0, 16, int),
+    "tcp_dport": (scapy.TCP, 16, 16, int),
+    "udp_sport": (scapy.UDP, 0, 16, int),
+    "udp_dport": (scapy.UDP, 16, 16, int),
+}
+
+IPv6 = getattr(scapy, "IPv6", None)
+if IPv6 is not None:
+    FIELDS.update({
+        "ipv6_tc":   (IPv6, 4, 8, int),
+        "ipv6_fl":   (IPv6, 12, 20, int),
+        "ipv6_hlim": (IPv6, 56, 8, int),
+        "ipv6_src":  (IPv6, 64, 128, ipv6_to_int),
+        "ipv6_dst":  (IPv6, 192, 128, ipv6_to_int),
+    })
+
+# checksums are updated automatically, they can only be masked
+CHECKSUM_FIELDS = {
+    "ip_chksum":  (scapy.IP, 80, 16),
+    "tcp_chksum": (scapy.TCP, 128, 16),
+    "udp_chksum": (scapy.UDP, 48, 16),
+}
+
+INNER_PREFIX = "inner_"
+
+def ones_complement_sum(data, start, end):
+    """
+    Sum of the 16-bit words of data[start:end], zero-padded to an even length
+    """
+    total = 0
+    for i in xrange(start, end - 1, 2):
+        total += (data[i] << 8) | data[i + 1]
+    if (end - start) % 2:
+        total += data[end - 1] << 8
+    return total
+
+def fold(total):
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return total
+
+class Checksum(object):
+    """
+    A checksum field and the byte ranges it covers, as (start, end) offsets
+    in the serialized packet
+    """
+    def __init__(self, offset, ranges, udp=False):
+        self.offset = offset
+        self.ranges = ranges
+        self.udp = udp
+
+class PacketTemplate(object):
+    def __init__(self, pkt):
+        """
+        @param pkt The base packet, as a scapy packet
+        """
+        self.pkt = pkt
+        self.data = bytearray(str(pkt))
+        # dict from (header type, occurrence) to the offset of the header
+        self.headers = {}
+        self.checksums = []
+        self.parse()
+
+    def parse(self):
+        data = self.data
+        offset = 0
+        last_ip = None
+        layer = self.pkt
+        header_types = set([field[0] for field in FIELDS.values()])
+        while layer:
+            header_len = len(str(layer)) - len(str(layer.payload))
+            for header_type in header_types:
+                if isinstance(layer, header_type):
+                    occurrence = 0
+                    while (header_type, occurrence) in self.headers:
+                        occurrence += 1
+                    self.headers[(header_type, occurrence)] = offset
+            if isinstance(layer, scapy.IP):
+                ihl = (data[offset] & 0xf) * 4
+                length = struct.unpack_from("!H", data, offset + 2)[0]
+                last_ip = (offset + 12, offset + 20, offset + ihl,
+                           offset + length)
+                self.checksums.append(
+                    Checksum(offset + 10, [(offset, offset + ihl)]))
+            elif IPv6 is not None and isinstance(layer, IPv6):
+                length = struct.unpack_from("!H", data, offset + 4)[0]
+                last_ip = (offset + 8, offset + 40, offset + 40,
+                           offset + 40 + length)
+            elif isinstance(layer, (scapy.TCP, scapy.UDP)) and last_ip:
+                udp = isinstance(layer, scapy.UDP)
+                csum_offset = offset + (6 if udp else 16)
+                addr_start, addr_end, _, ip_end = last_ip
+                if udp:
+                    ip_end = offset + struct.unpack_from(
+                        "!H", data, offset + 4)[0]
+                # a zero UDP checksum means no checksum
+                if not (udp and data[csum_offset] == data[csum_offset + 1] == 0):
+                    self.checksums.append(Checksum(
+                        csum_offset,
+                        [(addr_start, addr_end), (offset, min(ip_end, len(data)))],
+                        udp))
+            offset += header_len
+            layer = layer.payload
+        # inner checksums first, so that their changes are folded into the
+        # outer ones covering them
+        self.checksums.reverse()
+
+    def field_position(self, name, fields=FIELDS):
+        """
+        Return (bit offset in the packet, bit width) of a field
+        """
+        occurrence = 0
+        if name.startswith(INNER_PREFIX):
+            name = name[len(INNER_PREFIX):]
+            occurrence = 1
+        if name not in fields:
+            raise ValueError("Unknown packet template field %s" % name)
+        header_type, bit_offset, width = fields[name][:3]
+        key = (header_type, occurrence)
+        if key not in self.headers:
+            raise ValueError("No %s header for field %s in packet template" % (
+                header_type.__name__, name))
+        return self.headers[key] * 8 + bit_offset, width
+
+    def patch(self, data, start, new_bytes, skip=None):
+        """
+        Write new_bytes at data[start], updating the checksums which cover
+        that range
+        """
+        end = start + len(new_bytes)
+        old_bytes = data[start:end]
+        if old_bytes == new_bytes:
+            return
+        data[start:end] = new_bytes
+        for csum in self.checksums:
+            if csum is skip or (csum.offset < end and start < csum.offset + 2):
+                continue
+            old_sum, new_sum = 0, 0
+            for (range_start, range_end) in csum.ranges:
+                lo, hi = max(start, range_start), min(end, range_end)
+                if lo >= hi:
+                    continue
+                # align on the 16-bit words of the range
+                lo = range_start + ((lo - range_start) & ~1)
+                hi = min(range_start + ((hi - range_start + 1) & ~1), range_end)
+                new_sum += ones_complement_sum(data, lo, hi)
+                data[start:end] = old_bytes
+                old_sum += ones_complement_sum(data, lo, hi)
+                data[start:end] = new_bytes
+            if not old_sum and not new_sum:
+                continue
+            # RFC 1624, eqn. 3: HC' = ~(~HC + ~m + m')
+            current = (data[csum.offset] << 8) | data[csum.offset + 1]
+            value = fold((~current & 0xffff) + (~fold(old_sum) & 0xffff) +
+                         fold(new_sum))
+            value = ~value & 0xffff
+            if csum.udp and value == 0:
+                value = 0xffff
+            self.patch(data, csum.offset, bytearray(struct.pack("!H", value)),
+                       skip=csum)
+
+    def build_data(self, **fields):
+        data = bytearray(self.data)
+        for name, value in fields.items():
+            bit_offset, width = self.field_position(name)
+            value = FIELDS[name.replace(INNER_PREFIX, "", 1)][3](value)
+            start, end = bit_offset / 8, (bit_offset + width + 7) / 8
+            shift = end * 8 - bit_offset - width
+            field_mask = ((1 << width) - 1) << shift
+            current = mask.bytes_to_int(str(data[start:end]))
+            new = (current & ~field_mask) | ((value << shift) & field_mask)
+            new_bytes = binascii.unhexlify("%0*x" % (2 * (end - start), new))
+            self.patch(data, start, bytearray(new_bytes))
+        return data
+
+    def build(self, **fields):
+        """
+        Return the serialized packet with the given fields changed
+        """
+        return str(self.build_data(**fields))
+
+    def mask(self, do_not_care=[], **fields):
+        """
+        Return a ptf.mask.Mask matching the packet with the given fields
+        changed, ignoring the fields listed in do_not_care (which may include
+        ip_chksum, tcp_chksum and udp_chksum)
+        """
+        m = mask.Mask(self.build(**fields))
+        for name in do_not_care:
+            bare_name = name.replace(INNER_PREFIX, "", 1)
+            if bare_name in CHECKSUM_FIELDS:
+                bit_offset, width = self.field_position(name, CHECKSUM_FIELDS)
+            else:
+                bit_offset, width = self.field_position(name)
+            m.set_do_not_care(bit_offset, width)
+        return m
+
+def utest():
+    # explicit MAC addresses, scapy resolves the default ones based on the IP
+    # destination
+    eth = dict(dst="00:01:02:03:04:05", src="00:06:07:08:09:0a")
+    pkt = scapy.Ether(**eth) / scapy.Dot1Q(vlan=10) / scapy.IP(ttl=64) / \
+        scapy.UDP(sport=7, dport=7) / ("x" * 20)
+    tmpl = PacketTemplate(pkt)
+    fields = dict(eth_src="00:11:22:33:44:55", vlan_vid=20, ip_src="10.0.0.1",
+                  ip_dst="10.1.2.3", ip_ttl=63, udp_sport=1000, udp_dport=2000)
+    exp = scapy.Ether(dst=eth["dst"], src="00:11:22:33:44:55") / \
+        scapy.Dot1Q(vlan=20) / \
+        scapy.IP(src="10.0.0.1", dst="10.1.2.3", ttl=63) / \
+        scapy.UDP(sport=1000, dport=2000) / ("x" * 20)
+    assert(tmpl.build(**fields) == str(exp))
+    if IPv6 is not None:
+        pkt = scapy.Ether(**eth) / IPv6(fl=5) / scapy.TCP(sport=1, dport=2)
+        tmpl = PacketTemplate(pkt)
+        exp = scapy.Ether(**eth) / IPv6(src="2001::1", fl=0xabcde, hlim=1) / \
+            scapy.TCP(sport=3, dport=2)
+        assert(tmpl.build(ipv6_src="2001::1", ipv6_fl=0xabcde, ipv6_hlim=1,
+                          tcp_sport=3) == str(exp))
+    if scapy.VXLAN is None:
+        return
+    inner = scapy.Ether(**eth) / scapy.IP() / scapy.TCP()
+    pkt = scapy.Ether(**eth) / scapy.IP() / scapy.UDP(sport=1, dport=4789) / \
+        scapy.VXLAN(vni=1) / inner
+    tmpl = PacketTemplate(pkt)
+    exp = scapy.Ether(**eth) / scapy.IP() / scapy.UDP(sport=1, dport=4789) / \
+        scapy.VXLAN(vni=1) / scapy.Ether(**eth) / scapy.IP(src="1.2.3.4") / \
+        scapy.TCP(dport=99)
+    assert(tmpl.build(inner_ip_src="1.2.3.4", inner_tcp_dport=99) == str(exp))
+    m = tmpl.mask(["inner_tcp_dport", "inner_tcp_chksum"], inner_ip_src="1.2.3.4")
+    assert(m.pkt_match(exp))
+
+utest()
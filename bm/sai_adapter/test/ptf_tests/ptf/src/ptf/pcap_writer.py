@@ -1,30 +1,160 @@
 """
 Pcap file writer
+
+Packets are written in the pcapng format, with one interface per (device,
+port) pair. Writing happens in a background thread: write() only queues the
+packet, so that capturing does not slow down the dataplane receive loop. If
+the queue is full the packet is not captured and is counted in 'dropped'.
 """
 
+import os
 import struct
+import threading
+import time
+import Queue
+
+BlockHeader = struct.Struct("<LL")
+BlockTrailer = struct.Struct("<L")
+SectionHeader = struct.Struct("<LHHq")
+InterfaceDescription = struct.Struct("<HHL")
+EnhancedPacket = struct.Struct("<LLLLL")
+OptionHeader = struct.Struct("<HH")
+
+SHB_TYPE = 0x0a0d0d0a
+IDB_TYPE = 0x00000001
+EPB_TYPE = 0x00000006
+BYTE_ORDER_MAGIC = 0x1a2b3c4d
+LINKTYPE_ETHERNET = 1
+OPT_ENDOFOPT = 0
+OPT_IF_NAME = 2
+OPT_IF_TSRESOL = 9
 
-PcapHeader = struct.Struct("<LHHLLLL")
-PcapPktHeader = struct.Struct("<LLLL")
-PPIPktHeader = struct.Struct("<BBHL")
-PPIAggregateField = struct.Struct("<HHL")
+def pad4(data):
+    return data + "\x00" * (-len(data) % 4)
+
+def block(block_type, body):
+    """
+    Return a pcapng block with the given type and (unpadded) body
+    """
+    body = pad4(body)
+    length = BlockHeader.size + len(body) + BlockTrailer.size
+    return BlockHeader.pack(block_type, length) + body + \
+        BlockTrailer.pack(length)
+
+def option(code, value):
+    return OptionHeader.pack(code, len(value)) + pad4(value)
 
 class PcapWriter(object):
-    def __init__(self, filename):
+    QUEUE_LEN = 100000
+    BUFFER_SIZE = 1 << 20
+
+    def __init__(self, filename, max_size=None, max_age=None):
+        """
+        Open a pcap file and start the writer thread
+
+        'max_size' (bytes) and 'max_age' (seconds) enable rotation: once the
+        current file exceeds either, the capture continues in a new file,
+        with an index inserted before the extension of 'filename':
+        <name>.1.pcapng, <name>.2.pcapng, etc.
+        """
+        self.filename = filename
+        self.max_size = max_size
+        self.max_age = max_age
+        self.index = 0
+        self.dropped = 0
+        # protects 'dropped', which is updated from the dataplane threads
+        self.lock = threading.Lock()
+        self.stream = None
+        self.queue = Queue.Queue(self.QUEUE_LEN)
+        self.open(filename)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def open(self, filename):
+        if self.stream:
+            self.stream.close()
+        self.stream = open(filename, 'wb', self.BUFFER_SIZE)
+        self.opened = time.time()
+        self.size = 0
+        # dict from (device, port) to pcapng interface id, for this file
+        self.interfaces = {}
+        self.output(block(SHB_TYPE, SectionHeader.pack(
+            BYTE_ORDER_MAGIC,
+            1, # major
+            0, # minor
+            -1, # section length, unspecified
+        )))
+
+    def output(self, data):
+        self.stream.write(data)
+        self.size += len(data)
+
+    def next_filename(self):
+        self.index += 1
+        root, ext = os.path.splitext(self.filename)
+        return "%s.%d%s" % (root, self.index, ext)
+
+    def interface(self, device, port):
+        """
+        Return the interface id for (device, port), writing an Interface
+        Description Block if this is the first packet for it in this file
         """
-        Open a pcap file
+        key = (device, port)
+        if key not in self.interfaces:
+            self.interfaces[key] = len(self.interfaces)
+            self.output(block(IDB_TYPE, ''.join([
+                InterfaceDescription.pack(LINKTYPE_ETHERNET, 0, 65535),
+                option(OPT_IF_NAME, "%d-%d" % (device, port)),
+                option(OPT_IF_TSRESOL, chr(6)), # microseconds
+                option(OPT_ENDOFOPT, ""),
+            ])))
+        return self.interfaces[key]
+
+    def record(self, data, timestamp, interface_id):
+        """
+        Return the Enhanced Packet Block for a packet
         """
-        self.stream = open(filename, 'w')
+        ts = int(timestamp * 10**6)
+        return block(EPB_TYPE, EnhancedPacket.pack(
+            interface_id,
+            ts >> 32, # timestamp, high 32 bits
+            ts & 0xffffffff, # timestamp, low 32 bits
+            len(data), # captured length
+            len(data), # original length
+        ) + data)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            records = []
+            while True:
+                pkts, arg = item[0], item[1]
+                if pkts is None:
+                    # close request
+                    self.output(''.join(records))
+                    self.stream.close()
+                    return
+                timestamp, device, port = arg
+                interface_id = self.interface(device, port)
+                records.extend([self.record(data, timestamp, interface_id)
+                                for data in pkts])
+                try:
+                    item = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+            self.output(''.join(records))
+            self.stream.flush()
+            if (self.max_size and self.size >= self.max_size) or \
+               (self.max_age and time.time() - self.opened >= self.max_age):
+                self.open(self.next_filename())
 
-        self.stream.write(PcapHeader.pack(
-            0xa1b2c3d4, # magic
-            2, # major
-            4, # minor
-            0, # timezone offset
-            0, # timezone accuracy
-            65535, # snapshot length
-            192 # PPI linktype
-        ))
+    def enqueue(self, pkts, timestamp, device, port):
+        try:
+            self.queue.put_nowait((pkts, (timestamp, device, port)))
+        except Queue.Full:
+            with self.lock:
+                self.dropped += len(pkts)
 
     def write(self, data, timestamp, device, port):
         """
@@ -34,29 +164,24 @@ class PcapWriter(object):
         'timestamp' should be a float.
         'port' should be an integer port number.
         """
-        ppi_len = PPIPktHeader.size + 2 * PPIAggregateField.size
-        self.stream.write(PcapPktHeader.pack(
-            int(timestamp), # timestamp seconds
-            int((timestamp - int(timestamp)) * 10**6), # timestamp microseconds
-            len(data) + ppi_len, # truncated length
-            len(data) + ppi_len # un-truncated length
-        ))
-        self.stream.write(PPIPktHeader.pack(
-            0, # version
-            0, # flags
-            ppi_len, # length
-            1, # ethernet dlt
-        ))
-        self.stream.write(PPIAggregateField.pack(8, PPIAggregateField.size - 4, port))
-        self.stream.write(PPIAggregateField.pack(8, PPIAggregateField.size - 4, device))
-        self.stream.write(data)
+        self.enqueue([data], timestamp, device, port)
+
+    def write_batch(self, pkts, timestamp, device, port):
+        """
+        Write several packets with the same timestamp, device and port to a
+        pcap file
+        """
+        self.enqueue(pkts, timestamp, device, port)
 
     def close(self):
-        self.stream.close()
+        """
+        Write all the queued packets and close the file
+        """
+        self.queue.put((None, None))
+        self.thread.join()
 
 if __name__ == "__main__":
-    import time
-    print("Writing test pcap to test.pcap")
-    pcap_writer = PcapWriter("test.pcap")
-    pcap_writer.write("\x00\x01\x02\x03\x04\x05\x00\x0a\x0b\x0c\x0d\x0e\x08\x00", time.time(), 42)
+    print("Writing test pcap to test.pcapng")
+    pcap_writer = PcapWriter("test.pcapng")
+    pcap_writer.write("\x00\x01\x02\x03\x04\x05\x00\x0a\x0b\x0c\x0d\x0e\x08\x00", time.time(), 0, 42)
     pcap_writer.close()
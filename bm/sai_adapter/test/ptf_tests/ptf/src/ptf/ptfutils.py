@@ -9,9 +9,12 @@ import os
 import fcntl
 import logging
 import signal
+import sys
+import threading
 
 default_timeout = None # set by ptf
 default_negative_timeout = None # set by ptf
+default_negative_quiet_window = None # set by ptf
 
 def gen_xid():
     return random.randrange(1,0xffffffff)
@@ -21,8 +24,11 @@ Wait on a condition variable until the given function returns non-None or a time
 The condition variable must already be acquired.
 The timeout value -1 means use the default timeout.
 There is deliberately no support for an infinite timeout.
+If quiet_fn is given, it is called every time fn returns None and returns the
+time left before the wait can end early; the wait ends (returning None) as
+soon as that time is not positive.
 """
-def timed_wait(cv, fn, timeout=-1):
+def timed_wait(cv, fn, timeout=-1, quiet_fn=None):
     if timeout == -1:
         timeout = default_timeout
 
@@ -33,11 +39,47 @@ def timed_wait(cv, fn, timeout=-1):
             return val
 
         remaining_time = end_time - time.time()
+        if quiet_fn is not None:
+            quiet_time = quiet_fn()
+            if quiet_time <= 0:
+                return None
+            remaining_time = min(remaining_time, quiet_time)
         cv.wait(remaining_time)
 
         if time.time() > end_time:
             return None
 
+class BackgroundCall(threading.Thread):
+    """
+    Run a function in a background thread, e.g. to check received packets
+    while the test keeps sending. Call result() to wait for it and get its
+    return value; an exception raised by the function is raised again there.
+    """
+
+    def __init__(self, fn, *args, **kwargs):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.value = None
+        self.exc_info = None
+        self.start()
+
+    def run(self):
+        try:
+            self.value = self.fn(*self.args, **self.kwargs)
+        except:
+            self.exc_info = sys.exc_info()
+
+    def result(self, timeout=None):
+        self.join(timeout)
+        if self.is_alive():
+            raise RuntimeError("Background call still running")
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
 class EventDescriptor():
     """
     Similar to a condition variable, but can be passed to select().
@@ -26,12 +26,27 @@ MINSIZE = 0
 _import_blacklist.add('FILTERS')
 FILTERS = []
 
+def update_kernel_filter():
+    """
+    Filters with a 'bpf' attribute (a ptf.bpf predicate) are also enforced
+    in the kernel on the dataplane ports which support it, so that packets
+    they would reject are never queued. They are still evaluated in Python,
+    which covers the other ports and the packets queued before.
+    """
+    dataplane = ptf.dataplane_instance
+    if dataplane is None or not hasattr(dataplane, "set_kernel_filter"):
+        return
+    dataplane.set_kernel_filter(
+        [f.bpf for f in FILTERS if getattr(f, "bpf", None) is not None])
+
 def reset_filters():
-    FILTERS = []
+    del FILTERS[:]
+    update_kernel_filter()
 
 # Needs to be a callable
 def add_filter(my_filter):
     FILTERS.append(my_filter)
+    update_kernel_filter()
 
 def get_filters():
     return FILTERS
@@ -53,6 +68,23 @@ def ipv6_filter(pkt_str):
 def not_ipv6_filter(pkt_str):
     return not ipv6_filter(pkt_str)
 
+def not_ipv6_nd_filter(pkt_str):
+    try:
+        pkt = scapy.Ether(pkt_str)
+        nd = scapy.IPv6 in pkt and pkt[scapy.IPv6].nh == 58 and \
+            133 <= ord(str(pkt[scapy.IPv6].payload)[0]) <= 137
+    except:
+        return True
+    return not nd
+
+# kernel versions of the filters, see update_kernel_filter. They must never
+# drop a packet that the Python filter accepts; ipv6_filter has none since
+# it also accepts IPv6 behind VLAN tags or tunnels.
+if "linux" in sys.platform:
+    import ptf.bpf
+    not_ipv6_filter.bpf = ptf.bpf.drop_ethertypes([ptf.bpf.ETH_P_IPV6])
+    not_ipv6_nd_filter.bpf = ptf.bpf.drop_ipv6_nd()
+
 def ip_make_tos(tos, ecn, dscp):
     if ecn is not None:
         tos = (tos & ~(0x3)) | ecn
@@ -2141,13 +2173,12 @@ def send_packet(test, port_id, pkt, count=1):
     """
     device, port = port_to_tuple(port_id)
     pkt = str(pkt)
-    sent = 0
 
     for n in range(count):
         test.before_send(pkt, device_number=device, port_number=port)
-        sent += test.dataplane.send(device, port, pkt)
-
-    return sent
+    if count == 1:
+        return test.dataplane.send(device, port, pkt)
+    return test.dataplane.send_batch(device, port, [pkt] * count)
 
 def send(test, port_id, pkt, count=1):
     """
@@ -2155,19 +2186,33 @@ def send(test, port_id, pkt, count=1):
     """
     return send_packet(test, port_id, pkt, count=count)
 
-def dp_poll(test, device_number=0, port_number=None, timeout=-1, exp_pkt=None):
+def dp_poll(test, device_number=0, port_number=None, timeout=-1, exp_pkt=None,
+            quiet_window=None):
     """
     Wrapper function around dataplane.poll
     """
     t = test.dataplane.poll(
         device_number=device_number, port_number=port_number,
-        timeout=timeout, exp_pkt=exp_pkt, filters=FILTERS
+        timeout=timeout, exp_pkt=exp_pkt, filters=FILTERS,
+        quiet_window=quiet_window
     )
     (rcv_device, rcv_port, rcv_pkt, pkt_time) = t
     if rcv_pkt is not None:
         test.at_receive(rcv_pkt, device_number=rcv_device, port_number=rcv_port)
     return t
 
+def dp_stream(test, device_number=0, ports=None, timeout=-1, until=None,
+              quiet_window=None):
+    """
+    Wrapper function around dataplane.stream
+    """
+    for t in test.dataplane.stream(
+            device_number=device_number, ports=ports, timeout=timeout,
+            until=until, filters=FILTERS, quiet_window=quiet_window):
+        (rcv_device, rcv_port, rcv_pkt, pkt_time) = t
+        test.at_receive(rcv_pkt, device_number=rcv_device, port_number=rcv_port)
+        yield t
+
 def verify_packet(test, pkt, port_id):
     """
     Check that an expected packet is received
@@ -2186,6 +2231,9 @@ def verify_no_packet(test, pkt, port_id, timeout=None):
     Check that a particular packet is not received
     port_id can either be a single integer (port_number on default device 0)
     or a tuple of 2 integers (device_number, port_number)
+
+    If a negative quiet window is set (--negative-quiet-window), the check
+    ends as soon as the device has been quiet for that long.
     """
     if timeout is None:
         timeout = ptf.ptfutils.default_negative_timeout
@@ -2193,7 +2241,8 @@ def verify_no_packet(test, pkt, port_id, timeout=None):
     logging.debug("Negative check for pkt on device %d, port %d", device, port)
     (rcv_device, rcv_port, rcv_pkt, pkt_time) = dp_poll(
         test, device_number=device, port_number=port, exp_pkt=pkt,
-        timeout=timeout
+        timeout=timeout,
+        quiet_window=ptf.ptfutils.default_negative_quiet_window
     )
     test.assertTrue(rcv_pkt == None, "Received packet on device %d, port %r" % (device, port))
 
@@ -2201,7 +2250,9 @@ def verify_no_other_packets(test, device_number=0, timeout=None):
     """
     Check that no unexpected packets are received on specified device
 
-    This is a no-op if the --relax option is in effect.
+    This is a no-op if the --relax option is in effect. Like verify_no_packet,
+    the check ends early once the device is quiet if --negative-quiet-window
+    is set.
     """
     if ptf.config["relax"]:
         return
@@ -2210,7 +2261,8 @@ def verify_no_other_packets(test, device_number=0, timeout=None):
     logging.debug("Checking for unexpected packets on all ports of device %d" % device_number)
     (rcv_device, rcv_port, rcv_pkt, pkt_time) = dp_poll(
         test, device_number=device_number,
-        timeout=timeout
+        timeout=timeout,
+        quiet_window=ptf.ptfutils.default_negative_quiet_window
     )
     if rcv_pkt != None:
         logging.debug("Received unexpected packet on device %d, port %r: %s", device_number, rcv_port, format_packet(rcv_pkt))
@@ -2222,22 +2274,136 @@ def verify_packets(test, pkt, ports=[], device_number=0):
     given device (default device number is 0).
 
     Also verifies that the packet is not received on any other ports for this
-    device, and that no other packets are received on the device (unless --relax
-    is in effect).
+    device, and that no other packets are received on the specified ports
+    (unless --relax is in effect). As with verify_no_packet, other packets
+    received on the ports which do not expect the packet are ignored.
 
     This covers the common and simplest cases for checking dataplane outputs.
     For more complex usage, like multiple different packets being output, or
-    multiple packets on the same port, use the primitive verify_packet,
-    verify_no_packet, and verify_no_other_packets functions directly.
+    multiple packets on the same port, use verify_expected_packets or the
+    primitive verify_packet, verify_no_packet, and verify_no_other_packets
+    functions directly.
     """
+    expectations = {}
     for device, port in ptf_ports():
         if device != device_number:
             continue
-        if port in ports:
-            verify_packet(test, pkt, (device, port))
+        expectations[port] = pkt if port in ports else None
+    verify_expected_packets(test, expectations, device_number=device_number)
+
+def verify_expected_packets(test, expectations, device_number=0, timeout=None,
+                            negative_timeout=None):
+    """
+    Check the packets received on all the ports of a device in a single pass
+
+    'expectations' maps port numbers to the packet (scapy packet, string or
+    Mask) or list of packets expected on that port, or to None if no packet
+    is expected. Ports of the device which are not in 'expectations' are not
+    expected to receive anything either.
+
+    Packets are collected from all the ports at once: until every expected
+    packet has arrived (or 'timeout' expires), then for one more negative
+    timeout to catch extra packets (or until the device is quiet, see
+    verify_no_packet). This replaces one verify_packet or verify_no_packet
+    wait per port with a single shared deadline.
+
+    The check fails if an expected packet is missing, or if a packet expected
+    on some port is received on another port (or once too many). Other
+    packets received on a port once all its expected packets have arrived
+    also fail the check, unless the --relax option is in effect. Like
+    verify_packet, packets received on a port before its expected packets
+    are skipped, and like verify_no_packet, packets received on a port which
+    expects none are only checked against the packets expected elsewhere:
+    other packets on such a port are skipped.
+
+    Returns a dictionary which maps each port to a report dictionary:
+    'expected' (number of expected packets), 'matched' (number of expected
+    packets received), 'missing' (expected packets not received),
+    'unexpected' (packets expected on another port, or duplicates),
+    'skipped' and 'other' (received packets not expected anywhere, before
+    and after the port expectations were met, or 'skipped' on a port which
+    expects none).
+    """
+    if timeout is None:
+        timeout = ptf.ptfutils.default_timeout
+    if negative_timeout is None:
+        negative_timeout = ptf.ptfutils.default_negative_timeout
+
+    def compile_pkts(pkts):
+        if pkts is None:
+            pkts = []
+        elif not isinstance(pkts, (list, tuple)):
+            pkts = [pkts]
+        return [(pkt, ptf.dataplane.compile_exp_pkt(pkt)) for pkt in pkts]
+
+    pending = {}
+    report = {}
+
+    def add_port(port, pkts):
+        pending[port] = compile_pkts(pkts)
+        report[port] = {"expected": len(pending[port]), "matched": 0,
+                        "missing": [], "unexpected": [], "skipped": [],
+                        "other": []}
+
+    for port, pkts in expectations.items():
+        add_port(port, pkts)
+    all_matchers = [match for pkts in pending.values() for _, match in pkts]
+
+    def classify(port, pkt):
+        if port not in report:
+            add_port(port, None)
+        for i, (_, match) in enumerate(pending[port]):
+            if match(pkt):
+                del pending[port][i]
+                report[port]["matched"] += 1
+                return
+        if any([match(pkt) for match in all_matchers]):
+            report[port]["unexpected"].append(pkt)
+        elif pending[port] or not report[port]["expected"]:
+            report[port]["skipped"].append(pkt)
         else:
-            verify_no_packet(test, pkt, (device, port))
-    verify_no_other_packets(test, device_number=device_number)
+            report[port]["other"].append(pkt)
+
+    logging.debug("Checking for pkts on device %d, ports %r", device_number,
+                  sorted(expectations.keys()))
+    end_time = time.time() + timeout
+    negative_end_time = None
+    while True:
+        now = time.time()
+        if negative_end_time is None and \
+           (now >= end_time or not any(pending.values())):
+            negative_end_time = now + negative_timeout
+        remaining = (negative_end_time or end_time) - now
+        if remaining <= 0:
+            break
+        quiet_window = None
+        if negative_end_time is not None:
+            quiet_window = ptf.ptfutils.default_negative_quiet_window
+        (rcv_device, rcv_port, rcv_pkt, pkt_time) = dp_poll(
+            test, device_number=device_number, timeout=remaining,
+            quiet_window=quiet_window)
+        if rcv_pkt is not None:
+            classify(rcv_port, rcv_pkt)
+        elif quiet_window is not None:
+            break
+
+    errors = []
+    for port in sorted(report.keys()):
+        r = report[port]
+        r["missing"] = [pkt for pkt, _ in pending[port]]
+        if r["missing"]:
+            errors.append("did not receive %d expected pkt(s) on port %r" %
+                          (len(r["missing"]), port))
+        if r["unexpected"]:
+            errors.append("received %d extra or misdelivered pkt(s) on port %r" %
+                          (len(r["unexpected"]), port))
+        if r["other"] and not ptf.config["relax"]:
+            logging.debug("Received unexpected packet on device %d, port %r: %s",
+                          device_number, port, format_packet(r["other"][0]))
+            errors.append("received %d unexpected pkt(s) on port %r" %
+                          (len(r["other"]), port))
+    test.assertTrue(not errors, "Device %d: %s" % (device_number, "; ".join(errors)))
+    return report
 
 def verify_no_packet_any(test, pkt, ports=[], device_number=0):
     """
@@ -2376,15 +2542,43 @@ def count_matched_packets(test, exp_packet, port, device_number=0, timeout=1):
     As soon as the packets stop arriving, the function waits for the timeout value and returns the counter
     """
     total_rcv_pkt_cnt = 0
-    while True:
-        (rcv_device, rcv_port, rcv_pkt, pkt_time) = dp_poll(test, device_number=device_number, port_number=port, timeout=timeout)
-        if rcv_pkt is not None:
-            if ptf.dataplane.match_exp_pkt(exp_packet, rcv_pkt):
-                total_rcv_pkt_cnt += 1
-        else:
+    exp_packet_match = ptf.dataplane.compile_exp_pkt(exp_packet)
+    for (rcv_device, rcv_port, rcv_pkt, pkt_time) in dp_stream(
+            test, device_number=device_number, ports=port, timeout=timeout):
+        if exp_packet_match(rcv_pkt):
+            total_rcv_pkt_cnt += 1
+
+    return total_rcv_pkt_cnt
+
+def count_matched_packets_all_ports(test, exp_packet, ports=[], device_number=0, timeout=1):
+    """
+    Receive all packets on all the ports of the device and count how many
+    expected packets were received on the given ports.
+    As soon as no expected packet has been received for the timeout value,
+    returns the counter
+    """
+    total_rcv_pkt_cnt = 0
+    exp_packet_match = ptf.dataplane.compile_exp_pkt(exp_packet)
+    last_matched_packet_time = time.time()
+    for (rcv_device, rcv_port, rcv_pkt, pkt_time) in dp_stream(
+            test, device_number=device_number, timeout=timeout):
+        if rcv_port in ports and exp_packet_match(rcv_pkt):
+            total_rcv_pkt_cnt += 1
+            last_matched_packet_time = time.time()
+        elif time.time() - last_matched_packet_time > timeout:
             break
 
     return total_rcv_pkt_cnt
 
+def count_matched_packets_async(test, exp_packet, port, device_number=0, timeout=1):
+    """
+    Start counting expected packets on the port in the background, see
+    count_matched_packets. Returns a ptfutils.BackgroundCall: call result() on
+    it, once done sending, to get the counter.
+    """
+    return ptf.ptfutils.BackgroundCall(
+        count_matched_packets, test, exp_packet, port,
+        device_number=device_number, timeout=timeout)
+
 
 __all__ = list(set(locals()) - _import_blacklist)
@@ -102,7 +102,7 @@ class ThriftInterfaceDataPlane(ThriftInterface):
         if self.dataplane != None:
             self.dataplane.flush()
             if config["log_dir"] != None:
-                filename = os.path.join(config["log_dir"], str(self)) + ".pcap"
+                filename = os.path.join(config["log_dir"], str(self)) + ".pcapng"
                 self.dataplane.start_pcap(filename)
 
     def tearDown(self):
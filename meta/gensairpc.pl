@@ -155,6 +155,7 @@ my $vars = {
     apis            => $data->{apis},
     functions       => $data->{functions},
     methods         => $data->{methods},
+    bulk_functions  => $data->{bulk_functions},
     structs         => $data->{structs},
     dbg             => $dbg,
     mandatory_attrs => $mandatory_attrs,
@@ -257,6 +258,24 @@ sub generate_server_template_from_skeleton {
                 # Replace "printf" with function body template
                 say {$server_template} '[% PROCESS sai_rpc_function_body -%]';
             }
+            when (/\s(\w+)\s$PREFIX(bulk_\w+)[(]/) {
+
+                # Bulk functions are described by bulk_functions
+                # and always return sai_thrift_bulk_result_t
+                say {$server_template}
+"[% function_name = 'sai_$2'; ret_type = '$1'; bulk = bulk_functions.\$function_name -%]";
+                print {$server_template} $line;
+            }
+            when (/\s(\w+)\s$PREFIX(set_\w+_attributes)[(]/) {
+
+                # Multi-attribute set functions are defined by the related
+                # 'set attribute' function, and return a list of statuses
+                my $function_name = "sai_$2";
+                $function_name =~ s/s$//;
+                say {$server_template}
+"[% function_name = 'sai_$2'; ret_type = '$1'; function = functions.$function_name -%]";
+                print {$server_template} $line;
+            }
             when (/\s(\w+)\s$PREFIX(\w+)[(]/) {
 
                 # Get the return type and the function name and
@@ -334,6 +353,7 @@ sub get_api_name {
 # types definitions.
 sub get_definitions {
     my %methods_table;
+    my %bulk_functions;
     my %all_functions;
     my %all_structs;
     my %all_attrs;
@@ -376,7 +396,7 @@ sub get_definitions {
 
                     next
                       if get_struct( $apis{$api}, \%all_structs,
-                        \%methods_table, $_ );
+                        \%methods_table, \%bulk_functions, $api, $_ );
 
                     next
                       if $api ne 'common'
@@ -398,11 +418,12 @@ sub get_definitions {
     my $api_list = assign_attr_types( \%apis, \@all_enums );
 
     return {
-        apis      => $api_list,
-        attrs     => \%all_attrs,
-        structs   => \%all_structs,
-        functions => \%all_functions,
-        methods   => \%methods_table
+        apis           => $api_list,
+        attrs          => \%all_attrs,
+        structs        => \%all_structs,
+        functions      => \%all_functions,
+        methods        => \%methods_table,
+        bulk_functions => \%bulk_functions
     };
 }
 
@@ -545,13 +566,51 @@ sub get_method_names {
     return \%methods;
 }
 
+# SAI bulk functions take arrays of attribute lists, which cannot be handled
+# like the other function arguments. Moreover, all OID objects share the same
+# sai_bulk_object_*_fn types, so the bulk functions are identified by the API
+# method names instead (e.g. create_next_hop_group_members), and their RPC
+# interface is defined by the templates.
+sub get_bulk_functions {
+    my $struct   = shift;
+    my $api_name = shift;
+
+    my %bulk_functions;
+
+    for my $method ( GetStructKeysInOrder($struct) ) {
+        my $type =
+          { SAI::Struct::Member->parse_xml_typedef( $struct->{$method} ) }
+          ->{type};
+        next unless $type =~ /^sai_bulk_\w+_fn$/;
+        next unless $method =~ /^(create|remove|set|get)_(\w+?)(?:_attribute)?$/;
+
+        my ( $operation, $object ) = ( $1, $2 );
+
+        # Method names use the plural of the object name
+        $object =~ s/ies$/y/ or $object =~ s/s$//;
+
+        $bulk_functions{"sai_bulk_${operation}_$object"} = {
+            name      => "sai_bulk_${operation}_$object",
+            operation => $operation,
+            object    => $object,
+            api       => $api_name,
+            method    => $method,
+            entry     => ( $type !~ /^sai_bulk_object_/ ? 1 : 0 ),
+        };
+    }
+
+    return \%bulk_functions;
+}
+
 # Create and store the Struct object.
 # The struct of API function pointers is an exception - just the its name.
 sub get_struct {
     my $api           = shift;
     my $all_structs   = shift;
-    my $methods_table = shift;
-    my $xml_typedef   = shift;
+    my $methods_table  = shift;
+    my $bulk_functions = shift;
+    my $api_name       = shift;
+    my $xml_typedef    = shift;
 
     my @members;
     my $name;
@@ -567,6 +626,8 @@ sub get_struct {
     if ( $name =~ /_api_t$/ ) {
         my $method_names = get_method_names( \%struct_def );
         %{$methods_table} = ( %{$methods_table}, %{$method_names} );
+        my $bulk_names = get_bulk_functions( \%struct_def, $api_name );
+        %{$bulk_functions} = ( %{$bulk_functions}, %{$bulk_names} );
         return 1;
     }
 
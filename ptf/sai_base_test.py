@@ -133,6 +133,10 @@ class ThriftInterfaceDataPlane(ThriftInterface):
     def tearDown(self):
         if config['log_dir'] is not None:
             self.dataplane.stop_pcap()
+        # log per-port queue drops, to tell packets lost by PTF apart from
+        # packets lost by the device (not available in all PTF versions)
+        if hasattr(self.dataplane, 'dump_queue_stats'):
+            self.dataplane.dump_queue_stats()
         super(ThriftInterfaceDataPlane, self).tearDown()
 
 
@@ -570,15 +574,14 @@ class SaiHelperBase(ThriftInterfaceDataPlane):
 
         return True
 
-    @staticmethod
-    def status():
+    def status(self):
         """
-        Returns the last operation status.
+        Returns the last operation status of the test client.
 
         Returns:
             int: sai call result
         """
-        return adapter.status
+        return adapter.sai_thrift_last_status(self.client)
 
     @staticmethod
     def saiWaitFdbAge(timeout):
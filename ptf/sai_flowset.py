@@ -0,0 +1,407 @@
+# Copyright 2021-present Intel Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Thrift SAI interface hash test flow sets
+
+A HashFlowSet generates a large number of flows varying the packet fields
+selected by a hash test hash_dict, sends them all and counts on which of the
+egress ports they are received. The per port counts are compatible with
+saihash.verify_equaly_balanced and the other LB checks.
+"""
+
+import copy
+import random
+import socket
+import struct
+
+from ptf.mask import Mask
+from ptf.packet import *
+from ptf.testutils import *
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from ptf.packet_template import PacketTemplate
+except ImportError:
+    PacketTemplate = None
+
+# hash_dict key: (IPv4 packet field, IPv6 packet field), the fields are named
+# after the simple_*_packet arguments
+HASH_DICT_FIELDS = {
+    'hash_src_ip': ('ip_src', 'ipv6_src'),
+    'hash_dst_ip': ('ip_dst', 'ipv6_dst'),
+    'hash_src_mac': ('eth_src', 'eth_src'),
+    'hash_dst_mac': ('eth_dst', 'eth_dst'),
+    'hash_udp_sport': ('udp_sport', 'udp_sport'),
+    'hash_udp_dport': ('udp_dport', 'udp_dport'),
+    'hash_flow_label': (None, 'ipv6_fl'),
+}
+
+# packet field: (scapy header, scapy field name)
+FIELD_HEADERS = {
+    'eth_src': (Ether, 'src'),
+    'eth_dst': (Ether, 'dst'),
+    'ip_src': (IP, 'src'),
+    'ip_dst': (IP, 'dst'),
+    'ipv6_src': (IPv6, 'src'),
+    'ipv6_dst': (IPv6, 'dst'),
+    'ipv6_fl': (IPv6, 'fl'),
+    'udp_sport': (UDP, 'sport'),
+    'udp_dport': (UDP, 'dport'),
+}
+
+# number of random low order bits in the varied addresses, the routes used
+# by the hash tests are /16 for IPv4 and /65 for IPv6
+IPV4_HOST_BITS = 16
+IPV6_HOST_BITS = 32
+MAC_HOST_BITS = 24
+
+# L4 ports are taken from the dynamic range, so that no flow uses a port the
+# switch may handle differently (e.g. VXLAN)
+L4_PORT_MIN = 49152
+L4_PORT_MAX = 65535
+FLOW_LABEL_MAX = 0xFFFFF
+
+
+def _random_ints(rng, low, high, count):
+    """
+    Returns count random integers in [low, high]
+
+    Args:
+        rng (object): numpy.random.RandomState or random.Random instance
+        low (int): minimum value
+        high (int): maximum value
+        count (int): number of values
+
+    Returns:
+        list: random integers
+    """
+    if numpy is not None:
+        return rng.randint(low, high + 1, size=count, dtype=numpy.int64)
+    return [rng.randint(low, high) for _ in range(count)]
+
+
+def _random_addresses(rng, address, host_bits, count, exclude=()):
+    """
+    Returns count addresses with the host_bits low order bits of address
+    replaced by random values, other than all zeros and all ones
+
+    Args:
+        rng (object): numpy.random.RandomState or random.Random instance
+        address (bytes): base address in network byte order
+        host_bits (int): number of random bits, at most 32
+        count (int): number of addresses
+        exclude (set): addresses in network byte order which are not
+                       returned
+
+    Returns:
+        list: addresses in network byte order
+    """
+    prefix, suffix = address[:-4], struct.unpack('!I', address[-4:])[0]
+    suffix &= ~((1 << host_bits) - 1) & 0xFFFFFFFF
+    hosts = _random_ints(rng, 1, (1 << host_bits) - 2, count)
+    if numpy is not None:
+        data = (numpy.uint32(suffix) | hosts.astype(numpy.uint32)).astype(
+            '>u4').tobytes()
+        addresses = [prefix + data[i:i + 4] for i in range(0, len(data), 4)]
+    else:
+        addresses = [prefix + struct.pack('!I', suffix | host)
+                     for host in hosts]
+    for index, host in enumerate(addresses):
+        while host in exclude:
+            host = _random_addresses(rng, address, host_bits, 1)[0]
+        addresses[index] = host
+    return addresses
+
+
+def _mac_to_bytes(mac):
+    return struct.pack('!6B', *[int(byte, 16) for byte in mac.split(':')])
+
+
+def _bytes_to_mac(data):
+    return ':'.join('%02x' % byte for byte in bytearray(data))
+
+
+class HashFlowSet(object):
+    """
+    Flows varying the packet fields selected by a hash_dict
+
+    Every flow is a dict of packet field values, which override the base
+    packet fields when the flow packet is built.
+
+    The varied destination addresses stay clear of the neighbors addresses:
+    a neighbor host route is more specific than the tested route, so that
+    the flows sent to a neighbor would not be load balanced.
+    """
+
+    def __init__(self, hash_dict, count, base, ipv6=False, routed=True,
+                 ip_host_bits=None, seed=None, neighbors=()):
+        """
+        Args:
+            hash_dict (dict): dictionary with variables that defines the list
+                              of traffic header hashed fields
+            count (int): number of flows
+            base (dict): simple_*_packet arguments of the base packet
+            ipv6 (boolean): True for IPv6 flows
+            routed (boolean): the flows are routed, their destination MAC is
+                              the router MAC and is not varied
+            ip_host_bits (int): number of varied IP address low order bits
+            seed (int): random generator seed, for repeatable flow sets,
+                        a random one (kept in the seed attribute) if None
+            neighbors (list): neighbors IP addresses, never used as
+                              destination
+        """
+        self.base = dict(base)
+        self.ipv6 = ipv6
+        self.routed = routed
+        family = socket.AF_INET6 if ipv6 else socket.AF_INET
+        self.neighbors = set(socket.inet_pton(family, ip) for ip in neighbors)
+        if ip_host_bits is None:
+            ip_host_bits = IPV6_HOST_BITS if ipv6 else IPV4_HOST_BITS
+        if seed is None:
+            seed = random.SystemRandom().randint(0, 0xFFFFFFFF)
+        self.seed = seed
+        if numpy is not None:
+            rng = numpy.random.RandomState(seed)
+        else:
+            rng = random.Random(seed)
+
+        self.fields = []
+        for key in sorted(HASH_DICT_FIELDS):
+            if not hash_dict.get(key):
+                continue
+            field = HASH_DICT_FIELDS[key][1 if ipv6 else 0]
+            if field is None or (routed and field == 'eth_dst'):
+                continue
+            self.fields.append(field)
+
+        columns = []
+        for field in self.fields:
+            columns.append(self._field_values(rng, field, ip_host_bits, count))
+        self.flows = [dict(zip(self.fields, values))
+                      for values in zip(*columns)] if columns else \
+            [{} for _ in range(count)]
+        self.unmatched = 0
+
+    def __len__(self):
+        return len(self.flows)
+
+    def subset(self, start, stop):
+        """
+        Returns a flow set of the flows from start to stop of this one
+
+        Args:
+            start (int): index of the first flow
+            stop (int): index after the last flow
+
+        Returns:
+            HashFlowSet: flow set sharing the base packet and fields
+        """
+        flow_set = copy.copy(self)
+        flow_set.flows = self.flows[start:stop]
+        flow_set.unmatched = 0
+        return flow_set
+
+    def sampler(self, send):
+        """
+        Returns an adaptive_analysis sample function drawing consecutive
+        subsets of this flow set, so that all the looks of an analysis use
+        flows of a single (seeded) set
+
+        Args:
+            send (function): called with a flow set, returns its per path
+                             counts
+
+        Returns:
+            function: sample function
+        """
+        sent = [0]
+
+        def sample(count):
+            flow_set = self.subset(sent[0], sent[0] + count)
+            sent[0] += count
+            return send(flow_set)
+        return sample
+
+    def _field_values(self, rng, field, ip_host_bits, count):
+        """
+        Returns count random values of a packet field
+        """
+        if field in ('eth_src', 'eth_dst'):
+            return [_bytes_to_mac(mac) for mac in _random_addresses(
+                rng, _mac_to_bytes(self.base[field]), MAC_HOST_BITS, count)]
+        exclude = self.neighbors if field in ('ip_dst', 'ipv6_dst') else ()
+        if field in ('ip_src', 'ip_dst'):
+            return [socket.inet_ntoa(ip) for ip in _random_addresses(
+                rng, socket.inet_aton(self.base[field]), ip_host_bits,
+                count, exclude)]
+        if field in ('ipv6_src', 'ipv6_dst'):
+            return [socket.inet_ntop(socket.AF_INET6, ip)
+                    for ip in _random_addresses(
+                        rng,
+                        socket.inet_pton(socket.AF_INET6, self.base[field]),
+                        ip_host_bits, count, exclude)]
+        if field == 'ipv6_fl':
+            values = _random_ints(rng, 0, FLOW_LABEL_MAX, count)
+        else:
+            values = _random_ints(rng, L4_PORT_MIN, L4_PORT_MAX, count)
+        return [int(value) for value in values]
+
+    def packets(self, builder):
+        """
+        Builds the flow packets
+
+        The base packet is built once and the flow packets are derived from
+        it with a PacketTemplate when available.
+
+        Args:
+            builder (function): simple_*_packet function building the packets
+
+        Returns:
+            list: flow packets
+        """
+        if PacketTemplate is None:
+            return [builder(**dict(self.base, **flow)) for flow in self.flows]
+        template = PacketTemplate(builder(**self.base))
+        return [template.build(**flow) for flow in self.flows]
+
+    def expected_mask(self, exp_pkt):
+        """
+        Returns a mask matching the expected packet of any flow
+
+        The destination MAC (which depends on the egress port), the checksums
+        and the varied fields which are not rewritten by the switch are
+        ignored.
+
+        Args:
+            exp_pkt (packet): expected packet for the base flow
+
+        Returns:
+            Mask: expected packet mask
+        """
+        exp_mask = Mask(exp_pkt)
+        exp_mask.set_do_not_care_scapy(Ether, 'dst')
+        if exp_pkt.haslayer(IP):
+            exp_mask.set_do_not_care_scapy(IP, 'chksum')
+        if exp_pkt.haslayer(UDP):
+            exp_mask.set_do_not_care_scapy(UDP, 'chksum')
+        for field in self.fields:
+            if self.routed and field.startswith('eth_'):
+                continue
+            exp_mask.set_do_not_care_scapy(*FIELD_HEADERS[field])
+        return exp_mask
+
+    def collect(self, test, exp_mask, ports, counts, expected, timeout):
+        """
+        Receives packets until the expected number of packets matching the
+        mask is counted or no packet is received for timeout seconds
+
+        The packets are polled with dp_poll, so that the test filters (e.g.
+        the IPv6 neighbor discovery filter) apply.
+
+        Args:
+            test (BaseTest): the test
+            exp_mask (Mask): expected packet mask
+            ports (list): egress ports
+            counts (list): per port counts, updated
+            expected (int): number of packets to receive
+            timeout (int): receive timeout
+        """
+        received = 0
+        while received < expected:
+            result = dp_poll(test, timeout=timeout)
+            # the vendored ptf returns a tuple, upstream ptf a PollSuccess or
+            # PollFailure object
+            if isinstance(result, tuple):
+                port, pkt = result[1], result[2]
+            else:
+                port = getattr(result, 'port', None)
+                pkt = getattr(result, 'packet', None)
+            if pkt is None:
+                break
+            if port in ports and exp_mask.pkt_match(pkt):
+                counts[ports.index(port)] += 1
+                received += 1
+            else:
+                self.unmatched += 1
+
+    def send(self, test, port_id, packets):
+        """
+        Sends packets out of a port, in a single batch when the DataPlane
+        supports it
+
+        Args:
+            test (BaseTest): the test
+            port_id (int): port number or (device number, port number)
+            packets (list): packets
+        """
+        send_batch = getattr(test.dataplane, 'send_batch', None)
+        if send_batch is None:
+            for pkt in packets:
+                send_packet(test, port_id, pkt)
+            return
+        device, port = port_to_tuple(port_id)
+        data = [bytes(pkt) for pkt in packets]
+        for pkt in data:
+            test.before_send(pkt, device_number=device, port_number=port)
+        send_batch(device, port, data)
+
+    def send_and_count(self, test, builder, src_port, exp_pkt, ports,
+                       traffic=True, timeout=1):
+        """
+        Sends all the flows and counts their egress ports
+
+        The flows are sent in bursts, each burst being collected in one
+        receive pass. Bursts are no larger than the DataPlane receive queues
+        so that no packet is dropped even when all of them egress on the same
+        port.
+
+        Args:
+            test (BaseTest): the test
+            builder (function): simple_*_packet function building the packets
+            src_port (int): ingress port
+            exp_pkt (packet): expected packet for the base flow
+            ports (list): egress ports
+            traffic (boolean): informs if traffic is expected on egress ports
+            timeout (int): receive timeout
+
+        Returns:
+            list: list of numbers of flows egressed on every port
+        """
+        packets = self.packets(builder)
+        exp_mask = self.expected_mask(exp_pkt)
+        counts = [0] * len(ports)
+        burst = max(1, getattr(test.dataplane, 'qlen', 100))
+        self.unmatched = 0
+
+        test.dataplane.flush()
+        for start in range(0, len(packets), burst):
+            chunk = packets[start:start + burst]
+            self.send(test, src_port, chunk)
+            self.collect(test, exp_mask, ports, counts, len(chunk), timeout)
+
+        if traffic:
+            test.assertEqual(
+                sum(counts), len(packets),
+                "%d of %d flows not received" % (
+                    len(packets) - sum(counts), len(packets)))
+        else:
+            test.assertEqual(
+                sum(counts) + self.unmatched, 0,
+                "Unexpected packets received")
+        return counts
@@ -0,0 +1,490 @@
+# Copyright 2021-present Intel Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Thrift SAI interface load balancing analysis
+
+Statistical checks of the per path packet counts measured by the ECMP and
+LAG tests:
+- chi-square and G goodness of fit tests against the expected (equal or
+  weighted) distribution,
+- per path confidence intervals of the traffic share, from which a path is
+  proven to receive at least, or less than, a minimum fraction of its
+  expected share,
+- polarisation detection between two hash stages,
+- adaptive sampling, drawing flows until the verdict is known at the
+  requested confidence.
+
+Only the standard library is used.
+"""
+
+import math
+
+BALANCED = 'balanced'
+UNBALANCED = 'unbalanced'
+UNDECIDED = 'undecided'
+
+# minimum accepted fraction of the expected share of a path
+DEFAULT_MIN_SHARE = 0.4
+DEFAULT_CONFIDENCE = 0.99
+DEFAULT_MAX_SAMPLES = 10000
+
+_EPSILON = 1e-12
+_TINY = 1e-300
+
+
+def _gamma_q(a, x):
+    """
+    Regularized upper incomplete gamma function Q(a, x)
+
+    Args:
+        a (float): shape
+        x (float): lower integration limit
+
+    Returns:
+        float: Q(a, x)
+    """
+    if x <= 0:
+        return 1.0
+    log_prefix = -x + a * math.log(x) - math.lgamma(a)
+    if x < a + 1:
+        # series of P(a, x)
+        term = 1.0 / a
+        total = term
+        n = 1
+        while abs(term) > abs(total) * _EPSILON:
+            term *= x / (a + n)
+            total += term
+            n += 1
+        return max(0.0, 1.0 - total * math.exp(log_prefix))
+    # continued fraction of Q(a, x), modified Lentz method
+    b = x + 1 - a
+    c = 1 / _TINY
+    d = 1 / b
+    h = d
+    i = 1
+    while True:
+        an = -i * (i - a)
+        b += 2
+        d = an * d + b
+        if abs(d) < _TINY:
+            d = _TINY
+        c = b + an / c
+        if abs(c) < _TINY:
+            c = _TINY
+        d = 1 / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1) < _EPSILON:
+            break
+        i += 1
+    return math.exp(log_prefix) * h
+
+
+def chi2_sf(stat, dof):
+    """
+    Chi-square distribution survival function
+
+    Args:
+        stat (float): test statistic
+        dof (int): degrees of freedom
+
+    Returns:
+        float: probability of a statistic at least as large as stat
+    """
+    if dof <= 0:
+        return 1.0
+    return _gamma_q(dof / 2.0, stat / 2.0)
+
+
+def normal_quantile(prob):
+    """
+    Standard normal distribution quantile, by bisection of math.erfc
+
+    Args:
+        prob (float): probability, in (0, 1)
+
+    Returns:
+        float: z such that P(Z <= z) = prob
+    """
+    low, high = -40.0, 40.0
+    for _ in range(100):
+        mid = (low + high) / 2
+        if 0.5 * math.erfc(-mid / math.sqrt(2)) < prob:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
+
+
+def wilson_interval(count, total, z):
+    """
+    Wilson score interval of a proportion
+
+    Args:
+        count (int): number of successes
+        total (int): number of trials
+        z (float): standard normal quantile of the interval
+
+    Returns:
+        tuple: (lower bound, upper bound)
+    """
+    if total == 0:
+        return (0.0, 1.0)
+    share = float(count) / total
+    z2 = z * z
+    denominator = 1 + z2 / total
+    center = (share + z2 / (2 * total)) / denominator
+    half = z * math.sqrt(share * (1 - share) / total +
+                         z2 / (4.0 * total * total)) / denominator
+    return (max(0.0, center - half), min(1.0, center + half))
+
+
+def expected_shares(weights):
+    """
+    Converts path weights (e.g. weighted ECMP member weights) to expected
+    traffic shares
+
+    Args:
+        weights (list): path weights
+
+    Returns:
+        list: expected shares, summing to 1
+    """
+    total = float(sum(weights))
+    if total <= 0:
+        raise ValueError("At least one path weight must be positive")
+    return [weight / total for weight in weights]
+
+
+def chi_square_test(counts, shares):
+    """
+    Pearson chi-square goodness of fit test
+
+    Paths with a zero expected share are not part of the test. Without any
+    count there is nothing to test, the statistic is then 0.
+
+    Args:
+        counts (list): observed per path counts
+        shares (list): expected per path shares
+
+    Returns:
+        tuple: (statistic, degrees of freedom, p-value)
+    """
+    total = sum(counts)
+    stat = 0.0
+    paths = 0
+    for count, share in zip(counts, shares):
+        if share <= 0:
+            continue
+        if total:
+            expected = total * share
+            stat += (count - expected) ** 2 / expected
+        paths += 1
+    dof = paths - 1
+    return stat, dof, chi2_sf(stat, dof)
+
+
+def g_test(counts, shares):
+    """
+    G (log-likelihood ratio) goodness of fit test
+
+    Paths with a zero expected share are not part of the test. Without any
+    count there is nothing to test, the statistic is then 0.
+
+    Args:
+        counts (list): observed per path counts
+        shares (list): expected per path shares
+
+    Returns:
+        tuple: (statistic, degrees of freedom, p-value)
+    """
+    total = sum(counts)
+    stat = 0.0
+    paths = 0
+    for count, share in zip(counts, shares):
+        if share <= 0:
+            continue
+        if count:
+            stat += 2 * count * math.log(count / (total * share))
+        paths += 1
+    dof = paths - 1
+    return stat, dof, chi2_sf(stat, dof)
+
+
+def required_samples(share, min_share=DEFAULT_MIN_SHARE,
+                     confidence=DEFAULT_CONFIDENCE, comparisons=1):
+    """
+    Estimates the number of samples after which a path receiving exactly
+    its expected share is proven to receive at least min_share of it
+
+    Args:
+        share (float): expected share of the path
+        min_share (float): minimum accepted fraction of the expected share
+        confidence (float): confidence of the verdict
+        comparisons (int): number of simultaneous intervals
+
+    Returns:
+        int: number of samples
+    """
+    z = normal_quantile(1 - (1 - confidence) / (2.0 * comparisons))
+    return int(math.ceil(z * z * (1 - share) /
+                         (share * (1 - min_share) ** 2)))
+
+
+class LBAnalysis(object):
+    """
+    Load balancing analysis of per path counts
+
+    verdict is BALANCED if every path is proven to receive at least
+    min_share of its expected share, UNBALANCED if a path is proven to
+    receive less (or receives traffic while its expected share is 0, or no
+    path receives any traffic) and UNDECIDED if the counts do not allow
+    either conclusion.
+    """
+
+    def __init__(self, counts, weights=None, min_share=DEFAULT_MIN_SHARE,
+                 confidence=DEFAULT_CONFIDENCE, looks=1):
+        """
+        Args:
+            counts (list): per path counts
+            weights (list): path weights, equal weights if None
+            min_share (float): minimum accepted fraction of the expected
+                               share of a path
+            confidence (float): confidence of the verdict, shared by all
+                                the paths and looks
+            looks (int): number of analyses of a growing sample made to
+                         reach a verdict
+        """
+        self.counts = list(counts)
+        self.total = sum(self.counts)
+        if weights is None:
+            weights = [1] * len(self.counts)
+        if len(weights) != len(self.counts):
+            raise ValueError("Expected %d path weights" % len(self.counts))
+        self.shares = expected_shares(weights)
+        self.min_share = min_share
+        self.confidence = confidence
+
+        self.chi2, self.dof, self.chi2_pvalue = chi_square_test(
+            self.counts, self.shares)
+        self.g, _, self.g_pvalue = g_test(self.counts, self.shares)
+
+        alpha = (1 - confidence) / (len(self.counts) * looks)
+        self.z = normal_quantile(1 - alpha / 2)
+        self.intervals = [wilson_interval(count, self.total, self.z)
+                          for count in self.counts]
+
+        self.underloaded = []
+        proven = 0
+        for path, (count, share) in enumerate(zip(self.counts,
+                                                  self.shares)):
+            low, high = self.intervals[path]
+            if share <= 0:
+                if count:
+                    self.underloaded.append(path)
+                continue
+            if high < min_share * share:
+                self.underloaded.append(path)
+            elif low >= min_share * share:
+                proven += 1
+        if not self.total:
+            # nothing received, e.g. all the packets were dropped
+            self.underloaded = [path for path, share in enumerate(self.shares)
+                                if share > 0]
+        if self.underloaded:
+            self.verdict = UNBALANCED
+        elif proven == len([s for s in self.shares if s > 0]):
+            self.verdict = BALANCED
+        else:
+            self.verdict = UNDECIDED
+
+    @property
+    def balanced(self):
+        """
+        True only if the counts are proven balanced, an UNDECIDED verdict
+        is not balanced
+        """
+        return self.verdict == BALANCED
+
+    def fits(self, significance=1 - DEFAULT_CONFIDENCE):
+        """
+        Checks if the goodness of fit tests do not reject the expected
+        distribution
+
+        Args:
+            significance (float): significance level
+
+        Returns:
+            boolean: True if neither the chi-square nor the G test p-value
+                     is below significance
+        """
+        return min(self.chi2_pvalue, self.g_pvalue) >= significance
+
+    def __str__(self):
+        return ("counts=%s total=%d verdict=%s chi2=%.2f (p=%.4f) "
+                "G=%.2f (p=%.4f) shares=%s" % (
+                    self.counts, self.total, self.verdict, self.chi2,
+                    self.chi2_pvalue, self.g, self.g_pvalue,
+                    ["%.3f-%.3f" % interval for interval in self.intervals]))
+
+
+def active_paths(counts):
+    """
+    Counts the paths which received traffic
+
+    Args:
+        counts (list): per path counts
+
+    Returns:
+        int: number of paths with a non zero count
+    """
+    return len([count for count in counts if count])
+
+
+def single_path(counts, total=None):
+    """
+    Checks if all the traffic went through a single path
+
+    Args:
+        counts (list): per path counts
+        total (int): expected total count, not checked if None
+
+    Returns:
+        boolean: True if at most one path received traffic, all of it
+    """
+    if active_paths(counts) > 1:
+        return False
+    return total is None or sum(counts) in (0, total)
+
+
+def sample_schedule(initial, max_samples):
+    """
+    Returns the cumulative sample sizes at which an adaptive analysis
+    looks at the counts, doubling from initial up to max_samples
+
+    Args:
+        initial (int): first sample size
+        max_samples (int): maximum sample size
+
+    Returns:
+        list: cumulative sample sizes
+    """
+    schedule = []
+    size = max(1, min(initial, max_samples))
+    while True:
+        schedule.append(size)
+        if size >= max_samples:
+            return schedule
+        size = min(size * 2, max_samples)
+
+
+def adaptive_analysis(sample, paths, weights=None,
+                      min_share=DEFAULT_MIN_SHARE,
+                      confidence=DEFAULT_CONFIDENCE,
+                      max_samples=DEFAULT_MAX_SAMPLES):
+    """
+    Draws samples until the load balancing verdict is known
+
+    The first sample is the size needed to prove an exactly balanced path
+    at the requested confidence, the sample size then doubles until a
+    verdict is reached or max_samples is drawn. The confidence is split
+    between all the looks, so that the verdict holds at the requested
+    confidence whatever the look it is reached at.
+
+    Args:
+        sample (function): called with a number of flows, returns the per
+                           path counts of that many new flows
+        paths (int): number of paths
+        weights (list): path weights, equal weights if None
+        min_share (float): minimum accepted fraction of the expected share
+                           of a path
+        confidence (float): confidence of the verdict
+        max_samples (int): maximum number of flows
+
+    Returns:
+        LBAnalysis: analysis of all the counts drawn
+    """
+    shares = expected_shares(weights or [1] * paths)
+    initial = required_samples(min([s for s in shares if s > 0]),
+                               min_share, confidence, paths)
+    schedule = sample_schedule(initial, max_samples)
+    # the initial size depends on the number of looks and the other way
+    # round, a second pass settles both
+    initial = required_samples(min([s for s in shares if s > 0]),
+                               min_share, confidence,
+                               paths * len(schedule))
+    schedule = sample_schedule(initial, max_samples)
+
+    counts = [0] * paths
+    analysis = None
+    for size in schedule:
+        new_counts = sample(size - sum(counts))
+        counts = [old + new for old, new in zip(counts, new_counts)]
+        analysis = LBAnalysis(counts, weights, min_share, confidence,
+                              looks=len(schedule))
+        if analysis.verdict != UNDECIDED:
+            break
+    return analysis
+
+
+class Polarisation(object):
+    """
+    Polarisation analysis of two hash stages
+
+    table[i][j] is the number of flows which took path i at the first
+    stage and path j at the second one. Hashing is polarised when the
+    second stage path depends on the first stage one, typically when both
+    stages use the same hash function and fields: the flows reaching a
+    second stage switch through a given path then all take a subset of
+    its paths. This is tested with a chi-square test of independence.
+    """
+
+    def __init__(self, table, confidence=DEFAULT_CONFIDENCE):
+        """
+        Args:
+            table (list): list of per first stage path lists of second
+                          stage path counts
+            confidence (float): confidence of the verdict
+        """
+        self.table = [list(row) for row in table]
+        rows = [sum(row) for row in self.table]
+        columns = [sum(column) for column in zip(*self.table)]
+        self.total = sum(rows)
+        self.chi2 = 0.0
+        for row, row_total in zip(self.table, rows):
+            for count, column_total in zip(row, columns):
+                if not row_total or not column_total:
+                    continue
+                expected = float(row_total) * column_total / self.total
+                self.chi2 += (count - expected) ** 2 / expected
+        used_rows = len([r for r in rows if r])
+        used_columns = len([c for c in columns if c])
+        self.dof = (used_rows - 1) * (used_columns - 1)
+        self.pvalue = chi2_sf(self.chi2, self.dof)
+        # Cramer's V: 0 for independent stages, 1 for fully polarised ones
+        dimension = min(used_rows, used_columns) - 1
+        if dimension > 0 and self.total:
+            self.strength = math.sqrt(self.chi2 / (self.total * dimension))
+        else:
+            self.strength = 0.0
+        self.polarised = self.dof > 0 and self.pvalue < 1 - confidence
+        # second stage paths used by the flows of every first stage path
+        self.active = [active_paths(row) for row in self.table]
+
+    def __str__(self):
+        return ("polarised=%s chi2=%.2f (p=%.4f) strength=%.3f "
+                "active second stage paths=%s" % (
+                    self.polarised, self.chi2, self.pvalue, self.strength,
+                    self.active))
@@ -100,13 +100,19 @@ class BufferStatistics(MinimalPortVlanConfig):
         ipg_curr_occupancy_bytes = 0
         ipg_shared_curr_occupancy_bytes = 0
 
+        # only the polled counters are fetched while the traffic is running
+        ipg_counter_ids = [
+            SAI_INGRESS_PRIORITY_GROUP_STAT_CURR_OCCUPANCY_BYTES,
+            SAI_INGRESS_PRIORITY_GROUP_STAT_SHARED_CURR_OCCUPANCY_BYTES]
+
         traffic = Process(target=self.sendTraffic)
 
         traffic.start()
 
         while traffic.is_alive():
             stats = sai_thrift_get_buffer_pool_stats(
-                self.client, self.ingr_pool)
+                self.client, self.ingr_pool,
+                counter_ids=[SAI_BUFFER_POOL_STAT_CURR_OCCUPANCY_BYTES])
 
             if (stats["SAI_BUFFER_POOL_STAT_CURR_OCCUPANCY_BYTES"]
                     > bp_curr_occupancy_bytes):
@@ -114,7 +120,7 @@ class BufferStatistics(MinimalPortVlanConfig):
                                                 "CURR_OCCUPANCY_BYTES"]
 
             stats = sai_thrift_get_ingress_priority_group_stats(
-                self.client, self.ipg)
+                self.client, self.ipg, counter_ids=ipg_counter_ids)
 
             if (stats["SAI_INGRESS_PRIORITY_GROUP_STAT_CURR_OCCUPANCY_BYTES"]
                     > ipg_curr_occupancy_bytes):
@@ -618,12 +624,15 @@ class BufferPoolNumber(MinimalPortVlanConfig):
 
         for i in range(ingr_pool_num):
             stats = sai_thrift_get_ingress_priority_group_stats(
-                self.client, self.ipgs[i])
+                self.client, self.ipgs[i],
+                counter_ids=[SAI_INGRESS_PRIORITY_GROUP_STAT_PACKETS])
             self.assertEqual(
                 stats["SAI_INGRESS_PRIORITY_GROUP_STAT_PACKETS"], 1)
 
         for i in range(egr_pool_num):
-            stats = sai_thrift_get_queue_stats(self.client, self.queues[i])
+            stats = sai_thrift_get_queue_stats(
+                self.client, self.queues[i],
+                counter_ids=[SAI_QUEUE_STAT_PACKETS])
             self.assertEqual(stats["SAI_QUEUE_STAT_PACKETS"], 1)
 
     def tearDown(self):
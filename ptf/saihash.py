@@ -20,11 +20,14 @@ import binascii
 
 from ptf.testutils import *
 from sai_base_test import *
+from sai_flowset import HashFlowSet
+from sai_lb_analysis import active_paths, adaptive_analysis, single_path
 
 ROUTER_MAC = '00:77:66:55:44:00'
 MAX_ITRS = 50
 L3_MAX_ITRS = 200
 LAG_MAX_ITRS = 120
+FLOW_SET_FLOWS = 2000
 DEBUG = False
 
 
@@ -40,8 +43,11 @@ TEST_LAG_SEED1 = 411  # LAG seed tests second value
 #    avrg = 13
 #    min = 13 * 0.5 = 6.5
 # value reduced to 0.4 due to high chance of test failing
+# For the adaptive flow set tests, every port must be proven, at
+# TEST_HASH_CONFIDENCE, to receive at least that fraction of its equal share
 TEST_HASH_CHECK_BASE = 0.4
 SEED_TEST_CHECK_BASE = 0.2
+TEST_HASH_CONFIDENCE = 0.99
 
 
 def test_header(test_name, module=None):
@@ -130,7 +136,8 @@ def hash_fields_to_hash_names(hash_list):
 
 
 def verify_equaly_balanced(ecmp_count, pkt_count=MAX_ITRS,
-                           expected_base=TEST_HASH_CHECK_BASE):
+                           expected_base=TEST_HASH_CHECK_BASE,
+                           analysis=None):
     """
     Verifies if ecmp paths are egualy balanced
 
@@ -139,11 +146,21 @@ def verify_equaly_balanced(ecmp_count, pkt_count=MAX_ITRS,
         pkt_count (int): traffic number
         expected_base (int): percentage minimum accepted value of the port
                              count for the equally balanced traffic
+        analysis (LBAnalysis): statistical analysis of an adaptive sample,
+                               which must then be proven balanced; the
+                               fixed per port minimum is used if None
 
     Returns:
         boolean: True if traffic considerd equally balanced,
                  False otherwise
     """
+    if analysis is not None:
+        if not analysis.balanced:
+            # "Ecmp paths are not equally balanced"
+            print("verify_equaly_balanced:", analysis)
+            return False
+        return True
+
     base = ((pkt_count / len(ecmp_count)) * expected_base)
     for count in ecmp_count:
         if count < base:
@@ -196,11 +213,7 @@ def verify_lb_active_ports(lb_counts):
     Returns:
         int: balanced ports counter
     """
-    cnt = 0
-    for port_cnt in lb_counts:
-        if port_cnt != 0:
-            cnt += 1
-    return cnt
+    return active_paths(lb_counts)
 
 
 def verify_no_lb(lb_counts, max_iters=MAX_ITRS):
@@ -216,16 +229,7 @@ def verify_no_lb(lb_counts, max_iters=MAX_ITRS):
         boolean: True if load balancing has no effect,
                  False otherwise
     """
-    cnt = 0
-    for port_cnt in lb_counts:
-        if port_cnt != 0:
-            if port_cnt != max_iters:
-                # should be 0 or max_iters only
-                return False
-            cnt += 1
-        if cnt > 1:
-            return False
-    return True
+    return single_path(lb_counts, max_iters)
 
 
 def hash_dict_negation(hash_dict):
@@ -711,6 +715,8 @@ class SAIHashTest(SAIHashTestBase):
         nhop_ip5 = '44.55.55.55'
         nhop_ip6 = '44.66.66.66'
         nhop_ip7 = '44.77.77.77'
+        self.neighbor_ips = [nhop_ip1, nhop_ip2, nhop_ip3, nhop_ip4,
+                             nhop_ip5, nhop_ip6, nhop_ip7]
 
         # set switch src mac address
         sai_thrift_set_switch_attribute(
@@ -988,7 +994,31 @@ class SAIHashTest(SAIHashTestBase):
         finally:
             super(SAIHashTest, self).tearDown()
 
-    def l3IPv4LagPacketTest(self, hash_dict, traffic=True, max_itrs=MAX_ITRS):
+    def l3IPv4LagFlowSet(self, hash_dict, flow_count):
+        """
+        Function that builds the random flows of the IPv4 LAG hash test
+
+        Args:
+            hash_dict (dict): dictionary with variables that defines the list
+            of hash test fields and traffic header hashed fields
+            flow_count (int): number of flows
+
+        Returns:
+            HashFlowSet: flow set
+        """
+        base = dict(eth_dst=ROUTER_MAC,
+                    eth_src='00:22:22:22:22:22',
+                    ip_dst='10.70.70.1',
+                    ip_src='192.168.8.1',
+                    udp_sport=7,
+                    udp_dport=7,
+                    ip_id=106,
+                    ip_ttl=64)
+        return HashFlowSet(hash_dict, flow_count, base,
+                           neighbors=self.neighbor_ips)
+
+    def l3IPv4LagPacketTest(self, hash_dict, traffic=True, max_itrs=MAX_ITRS,
+                            flow_count=None, flow_set=None):
         """
         Function that performs the IPv4 LAG hash test with L3 hashed traffic
 
@@ -997,10 +1027,26 @@ class SAIHashTest(SAIHashTestBase):
             of hash test fields and traffic header hashed fields
             traffic (boolean): informs if traffic is expected on egress ports
             max_itrs (int): maximum number of iterations
+            flow_count (int): if set, number of random flows sent with
+                              a HashFlowSet instead of max_itrs iterations
+            flow_set (HashFlowSet): if set, flows sent instead of max_itrs
+                                    iterations, see l3IPv4LagFlowSet
 
         Returns:
             list: list of numbers of packet egressed on specific test member
         """
+        if flow_count:
+            flow_set = self.l3IPv4LagFlowSet(hash_dict, flow_count)
+        if flow_set is not None:
+            exp_pkt = simple_udp_packet(**dict(flow_set.base,
+                                               eth_dst='00:77:77:77:77:77',
+                                               eth_src=ROUTER_MAC,
+                                               ip_ttl=63))
+            return flow_set.send_and_count(
+                self, simple_udp_packet, self.dev_port4, exp_pkt,
+                [self.dev_port4, self.dev_port5, self.dev_port6],
+                traffic=traffic)
+
         count = [0, 0, 0]
         src_mac_start = '00:22:22:22:{0}:{1}'
         dst_mac_start = '00:99:99:99:{0}:{1}'
@@ -1067,7 +1113,31 @@ class SAIHashTest(SAIHashTestBase):
 
         return count
 
-    def l3IPv4EcmpPacketTest(self, hash_dict, traffic=True, max_itrs=MAX_ITRS):
+    def l3IPv4EcmpFlowSet(self, hash_dict, flow_count):
+        """
+        Function that builds the random flows of the IPv4 ECMP test
+
+        Args:
+            hash_dict (dict): dictionary with variables that defines the list
+            of hash test fields and traffic header hashed fields
+            flow_count (int): number of flows
+
+        Returns:
+            HashFlowSet: flow set
+        """
+        base = dict(eth_dst=ROUTER_MAC,
+                    eth_src='00:22:22:22:22:22',
+                    ip_dst='10.10.10.1',
+                    ip_src='192.168.8.1',
+                    udp_sport=7,
+                    udp_dport=7,
+                    ip_id=106,
+                    ip_ttl=64)
+        return HashFlowSet(hash_dict, flow_count, base,
+                           neighbors=self.neighbor_ips)
+
+    def l3IPv4EcmpPacketTest(self, hash_dict, traffic=True, max_itrs=MAX_ITRS,
+                             flow_count=None, flow_set=None):
         """
         Function that performs the IPv4 ECMP test with L3 hashed traffic
 
@@ -1076,10 +1146,28 @@ class SAIHashTest(SAIHashTestBase):
             of hash test fields and traffic header hashed fields
             traffic (boolean): informs if traffic is expected on egress ports
             max_itrs (int): maximum number of iterations
+            flow_count (int): if set, number of random flows sent with
+                              a HashFlowSet instead of max_itrs iterations
+            flow_set (HashFlowSet): if set, flows sent instead of max_itrs
+                                    iterations, see l3IPv4EcmpFlowSet
 
         Returns:
             list: list of numbers of packet egressed on specific test port
         """
+        if flow_count:
+            flow_set = self.l3IPv4EcmpFlowSet(hash_dict, flow_count)
+        if flow_set is not None:
+            # the expected destination MAC depends on the next hop, it is
+            # ignored by the flow set
+            exp_pkt = simple_udp_packet(**dict(flow_set.base,
+                                               eth_src=ROUTER_MAC,
+                                               ip_ttl=63))
+            return flow_set.send_and_count(
+                self, simple_udp_packet, self.dev_port15, exp_pkt,
+                [self.dev_port10, self.dev_port11, self.dev_port12,
+                 self.dev_port13],
+                traffic=traffic)
+
         count = [0, 0, 0, 0]
         src_mac_start = '00:22:22:22:{0}:{1}'
         dst_mac_start = '00:99:99:99:{0}:{1}'
@@ -1638,7 +1726,8 @@ class SAIHashTest(SAIHashTestBase):
                          hash_src_ip=None,
                          hash_dst_ip=None,
                          hash_udp_sport=None,
-                         hash_udp_dport=None):
+                         hash_udp_dport=None,
+                         flow_count=None):
         """
         Verifies traffic distribution using all the fields selected
         for ECMP IPv4 Hash
@@ -1650,6 +1739,8 @@ class SAIHashTest(SAIHashTestBase):
                                       traffic
             hash_udp_dport (boolean): indicates if test uses udp dport hashed
                                       traffic
+            flow_count (int): if set, number of random flows used instead of
+                              the default iterations
         """
 
         hash_dict = {'hash_src_ip': hash_src_ip, 'hash_dst_ip': hash_dst_ip,
@@ -1664,18 +1755,34 @@ class SAIHashTest(SAIHashTestBase):
         self.setupECMPIPv4Hash(hash_fields)
 
         # should ballance equally
-        ecmp_count = self.l3IPv4EcmpPacketTest(hash_dict)
+        if flow_count:
+            # as many flows as needed for a verdict, up to flow_count, all
+            # taken from a single seeded flow set
+            flow_set = self.l3IPv4EcmpFlowSet(hash_dict, flow_count)
+            analysis = adaptive_analysis(
+                flow_set.sampler(lambda flows: self.l3IPv4EcmpPacketTest(
+                    hash_dict, flow_set=flows)),
+                4, min_share=TEST_HASH_CHECK_BASE,
+                confidence=TEST_HASH_CONFIDENCE, max_samples=flow_count)
+            print("ECMP LB analysis (flow set seed %d):" % flow_set.seed,
+                  analysis)
+            ecmp_count = analysis.counts
+        else:
+            analysis = None
+            ecmp_count = self.l3IPv4EcmpPacketTest(hash_dict)
         print("ECMP LB count:", ecmp_count)
         nbr_active_ports = verify_lb_active_ports(ecmp_count)
         self.assertEqual(nbr_active_ports, 4)
 
-        equaly_balanced = verify_equaly_balanced(ecmp_count)
+        equaly_balanced = verify_equaly_balanced(ecmp_count,
+                                                 analysis=analysis)
         self.assertTrue(equaly_balanced,
                         "Ecmp paths are not equally balanced")
         ecmp_count = self.l3IPv4EcmpPacketTest(hash_dict_negation(
-            hash_dict))
+            hash_dict), flow_count=flow_count)
         print("ECMP LB count (LB NOT expected):", ecmp_count)
-        no_lb = verify_no_lb(ecmp_count, max_iters=MAX_ITRS)
+        no_lb = verify_no_lb(ecmp_count,
+                             max_iters=flow_count or MAX_ITRS)
         self.assertTrue(no_lb, "Not expected to balance")
 
     def ecmpIPv4vsIPv6HashTest(self):
@@ -1874,7 +1981,8 @@ class SAIHashTest(SAIHashTestBase):
                           hash_src_ip=None,
                           hash_dst_ip=None,
                           hash_udp_sport=None,
-                          hash_udp_dport=None):
+                          hash_udp_dport=None,
+                          flow_count=None):
         """
         Verfies L3 IPv4 traffic distribution using all the field selected
         for IPv4 LAG Hash
@@ -1886,6 +1994,8 @@ class SAIHashTest(SAIHashTestBase):
                                       traffic
             hash_udp_dport (boolean): indicates if test uses udp dport hashed
                                       traffic
+            flow_count (int): if set, number of random flows used instead of
+                              the default iterations
         """
 
         hash_dict = {'hash_src_ip': hash_src_ip,
@@ -1898,17 +2008,33 @@ class SAIHashTest(SAIHashTestBase):
               % (hash_fields_to_hash_names(hash_fields)))
         self.setupLAGIPv4Hash(hash_fields)
 
-        lag_hashing_counts = self.l3IPv4LagPacketTest(hash_dict)
+        if flow_count:
+            # as many flows as needed for a verdict, up to flow_count, all
+            # taken from a single seeded flow set
+            flow_set = self.l3IPv4LagFlowSet(hash_dict, flow_count)
+            analysis = adaptive_analysis(
+                flow_set.sampler(lambda flows: self.l3IPv4LagPacketTest(
+                    hash_dict, flow_set=flows)),
+                3, min_share=TEST_HASH_CHECK_BASE,
+                confidence=TEST_HASH_CONFIDENCE, max_samples=flow_count)
+            print("LAG LB analysis (flow set seed %d):" % flow_set.seed,
+                  analysis)
+            lag_hashing_counts = analysis.counts
+        else:
+            analysis = None
+            lag_hashing_counts = self.l3IPv4LagPacketTest(hash_dict)
         print("LAG hash LB count (LB expected):", lag_hashing_counts)
         nbr_active_ports = verify_lb_active_ports(lag_hashing_counts)
         self.assertEqual(nbr_active_ports, 3)
-        equaly_balanced = verify_equaly_balanced(lag_hashing_counts)
+        equaly_balanced = verify_equaly_balanced(lag_hashing_counts,
+                                                 analysis=analysis)
         self.assertTrue(equaly_balanced,
                         "LAG members are not equally balanced")
         lag_hashing_counts = self.l3IPv4LagPacketTest(
-            hash_dict_negation(hash_dict))
+            hash_dict_negation(hash_dict), flow_count=flow_count)
         print("LAG hash LB count (LB NOT expected):", lag_hashing_counts)
-        no_lb = verify_no_lb(lag_hashing_counts, max_iters=MAX_ITRS)
+        no_lb = verify_no_lb(lag_hashing_counts,
+                             max_iters=flow_count or MAX_ITRS)
         self.assertTrue(no_lb, "Not expected to balance")
 
     def lagHashAlgorithmTest(self):
@@ -2079,6 +2205,7 @@ class SAIIPv6HashTest(SAIHashTestBase):
         nhop_ip6 = '6000:1:1:0:0:0:0:1'
         nhop_ip7 = '7000:1:1:0:0:0:0:1'
         nhop_ip8 = '0001:1:1:0:0:0:0:1'
+        self.neighbor_ips = [nhop_ip5, nhop_ip6, nhop_ip7, nhop_ip8]
 
         # set switch src mac address
         sai_thrift_set_switch_attribute(
@@ -2245,15 +2372,49 @@ class SAIIPv6HashTest(SAIHashTestBase):
         finally:
             super(SAIIPv6HashTest, self).tearDown()
 
-    def l3IPv6EcmpPacketTest(self, hash_dict):
+    def l3IPv6EcmpFlowSet(self, hash_dict, flow_count):
+        """
+        Function that builds the random flows of the IPv6 ECMP test
+        Args:
+            hash_dict (dict): dictionary with variables that defines the list
+            of hash test fields and traffic header hashed fields
+            flow_count (int): number of flows
+        Returns:
+            HashFlowSet: flow set
+        """
+        base = dict(eth_dst=ROUTER_MAC,
+                    eth_src='00:22:22:22:22:22',
+                    ipv6_dst='1000:1:1:0:0:0:0:1',
+                    ipv6_src='6000:1:1:0:0:0:0:100',
+                    udp_sport=7,
+                    udp_dport=7,
+                    ipv6_hlim=64)
+        return HashFlowSet(hash_dict, flow_count, base, ipv6=True,
+                           neighbors=self.neighbor_ips)
+
+    def l3IPv6EcmpPacketTest(self, hash_dict, flow_count=None, flow_set=None):
         """
         Function that performs the IPv6 ECMP test with L3 hashed traffic
         Args:
             hash_dict (dict): dictionary with variables that defines the list
             of hash test fields and traffic header hashed fields
+            flow_count (int): if set, number of random flows sent with
+                              a HashFlowSet instead of MAX_ITRS iterations
+            flow_set (HashFlowSet): if set, flows sent instead of MAX_ITRS
+                                    iterations, see l3IPv6EcmpFlowSet
         Returns:
             list: list of numbers of packet egressed on specific test port
         """
+        if flow_count:
+            flow_set = self.l3IPv6EcmpFlowSet(hash_dict, flow_count)
+        if flow_set is not None:
+            exp_pkt = simple_udpv6_packet(**dict(flow_set.base,
+                                                 eth_src=ROUTER_MAC,
+                                                 ipv6_hlim=63))
+            return flow_set.send_and_count(
+                self, simple_udpv6_packet, self.dev_port11, exp_pkt,
+                [self.dev_port25, self.dev_port26, self.dev_port27])
+
         ecmp_count = [0, 0, 0]
         src_mac_start = '00:22:22:22:{0}:{1}'
         src_mac = '00:22:22:22:22:22'
@@ -2518,7 +2679,8 @@ class SAIIPv6HashTest(SAIHashTestBase):
                          hash_src_ip=None,
                          hash_dst_ip=None,
                          hash_udp_sport=None,
-                         hash_udp_dport=None):
+                         hash_udp_dport=None,
+                         flow_count=None):
         """
         Verifies traffic distribution using all the fields selected
         for ECMP IPv6 Hash
@@ -2530,6 +2692,8 @@ class SAIIPv6HashTest(SAIHashTestBase):
                                       traffic
             hash_udp_dport (boolean): indicates if test uses udp dport hashed
                                       traffic
+            flow_count (int): if set, number of random flows used instead of
+                              the default iterations
         """
 
         hash_dict = {'hash_src_ip': hash_src_ip, 'hash_dst_ip': hash_dst_ip,
@@ -2543,20 +2707,35 @@ class SAIIPv6HashTest(SAIHashTestBase):
         # setup IPv6 hash fields for all fields
         self.setupECMPIPv6Hash(hash_fields)
 
-        ecmp_count = self.l3IPv6EcmpPacketTest(hash_dict)
+        if flow_count:
+            # as many flows as needed for a verdict, up to flow_count, all
+            # taken from a single seeded flow set
+            flow_set = self.l3IPv6EcmpFlowSet(hash_dict, flow_count)
+            analysis = adaptive_analysis(
+                flow_set.sampler(lambda flows: self.l3IPv6EcmpPacketTest(
+                    hash_dict, flow_set=flows)),
+                3, min_share=TEST_HASH_CHECK_BASE,
+                confidence=TEST_HASH_CONFIDENCE, max_samples=flow_count)
+            print("ECMP LB analysis (flow set seed %d):" % flow_set.seed,
+                  analysis)
+            ecmp_count = analysis.counts
+        else:
+            analysis = None
+            ecmp_count = self.l3IPv6EcmpPacketTest(hash_dict)
 
         print("ECMP LB count:", ecmp_count)
         nbr_active_ports = verify_lb_active_ports(ecmp_count)
         self.assertTrue(
             nbr_active_ports == 3,
             "Expected to balance equally on all next hops.")
-        equaly_balanced = verify_equaly_balanced(ecmp_count)
+        equaly_balanced = verify_equaly_balanced(ecmp_count,
+                                                 analysis=analysis)
         self.assertTrue(equaly_balanced,
                         "Ecmp paths are not equally balanced")
 
         print("Verify no load balancing for non hashed traffic.")
         ecmp_count = self.l3IPv6EcmpPacketTest(hash_dict_negation(
-            hash_dict))
+            hash_dict), flow_count=flow_count)
 
         print("ECMP no LB count:", ecmp_count)
         nbr_active_ports = verify_lb_active_ports(ecmp_count)
@@ -2901,6 +3080,23 @@ class EcmpIPv4HashTest(SAIHashTest):
             hash_udp_dport=True)
 
 
+@group("draft")
+class EcmpIPv4FlowSetHashTest(SAIHashTest):
+    """
+    Verfies traffic distribution using all the fields selected
+    for ECMP IPv4 Hash with a large random flow set
+    """
+
+    def runTest(self):
+        test_header("EcmpIPv4FlowSetHashTest")
+        self.ecmpIPv4HashTest(
+            hash_src_ip=True,
+            hash_dst_ip=True,
+            hash_udp_sport=True,
+            hash_udp_dport=True,
+            flow_count=FLOW_SET_FLOWS)
+
+
 @group("draft")
 class EcmpIPv4vsIPv6HashTest(SAIHashTest):
     """
@@ -2959,6 +3155,23 @@ class L3LagIPv4HashTest(SAIHashTest):
             hash_udp_dport=True)
 
 
+@group("draft")
+class L3LagIPv4FlowSetHashTest(SAIHashTest):
+    """
+    Verfies L3 IPv4 traffic distribution using all the fields selected
+    for IPv4 LAG Hash with a large random flow set
+    """
+
+    def runTest(self):
+        test_header("l3LagIPv4FlowSetHashTest")
+        self.l3LagIPv4HashTest(
+            hash_src_ip=True,
+            hash_dst_ip=True,
+            hash_udp_sport=True,
+            hash_udp_dport=True,
+            flow_count=FLOW_SET_FLOWS)
+
+
 @group("draft")
 class LagHashAlgorithmTest(SAIHashTest):
     """
@@ -3186,6 +3399,23 @@ class EcmpIPv6HashTest(SAIIPv6HashTest):
             hash_udp_dport=True)
 
 
+@group("draft")
+class EcmpIPv6FlowSetHashTest(SAIIPv6HashTest):
+    """
+    Verfies traffic distribution using all the field selected
+    for ECMP IPv6 Hash with a large random flow set
+    """
+
+    def runTest(self):
+        test_header("EcmpIPv6FlowSetHashTest")
+        self.ecmpIPv6HashTest(
+            hash_src_ip=True,
+            hash_dst_ip=True,
+            hash_udp_sport=True,
+            hash_udp_dport=True,
+            flow_count=FLOW_SET_FLOWS)
+
+
 @group("draft")
 class EcmpIPv6DstIPHashTest(SAIIPv6HashTest):
     """
@@ -243,7 +243,8 @@ class QueueConfigData(SaiHelper):
         send_packet(self, self.dev_port25, pkt)
         verify_packet(self, exp_pkt, self.dev_port26)
         print("\tPacket received on PORT26")
-        stats = sai_thrift_get_queue_stats(self.client, queue_id[0])
+        stats = sai_thrift_get_queue_stats(
+            self.client, queue_id[0], counter_ids=[SAI_QUEUE_STAT_PACKETS])
         cnt = stats["SAI_QUEUE_STAT_PACKETS"]
         self.assertEqual(cnt, 1)
 
@@ -282,7 +283,8 @@ class QueueConfigData(SaiHelper):
         send_packet(self, self.dev_port25, pkt)
         verify_packet(self, exp_pkt, self.dev_port26)
         print("\tPacket received on PORT26")
-        stats = sai_thrift_get_queue_stats(self.client, queue_id[0])
+        stats = sai_thrift_get_queue_stats(
+            self.client, queue_id[0], counter_ids=[SAI_QUEUE_STAT_PACKETS])
         cnt = stats["SAI_QUEUE_STAT_PACKETS"]
         self.assertEqual(cnt, 1)
         print("\tTest completed successfully")
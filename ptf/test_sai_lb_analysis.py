@@ -0,0 +1,197 @@
+# Copyright 2021-present Intel Corporation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Unit tests of the load balancing analysis module
+
+They do not need a switch, run them with:
+    python -m unittest test_sai_lb_analysis
+"""
+
+import unittest
+
+from sai_lb_analysis import *
+
+
+class DistributionsTest(unittest.TestCase):
+    """
+    Checks the statistical functions against known values
+    """
+
+    def test_chi2_sf(self):
+        self.assertAlmostEqual(chi2_sf(3.841458820694124, 1), 0.05, places=6)
+        self.assertAlmostEqual(chi2_sf(9.487729036781154, 4), 0.05, places=6)
+        self.assertAlmostEqual(chi2_sf(6.634896601021214, 1), 0.01, places=6)
+        # continued fraction branch
+        self.assertAlmostEqual(chi2_sf(29.58829844507442, 10), 0.001,
+                               places=6)
+        self.assertEqual(chi2_sf(0, 3), 1.0)
+        self.assertEqual(chi2_sf(5, 0), 1.0)
+
+    def test_normal_quantile(self):
+        self.assertAlmostEqual(normal_quantile(0.975), 1.959964, places=5)
+        self.assertAlmostEqual(normal_quantile(0.995), 2.575829, places=5)
+        self.assertAlmostEqual(normal_quantile(0.5), 0.0, places=9)
+
+    def test_wilson_interval(self):
+        low, high = wilson_interval(50, 100, 1.959964)
+        self.assertAlmostEqual(low, 0.403832, places=5)
+        self.assertAlmostEqual(high, 0.596168, places=5)
+        self.assertEqual(wilson_interval(0, 0, 1.96), (0.0, 1.0))
+        low, high = wilson_interval(0, 10, 1.96)
+        self.assertEqual(low, 0.0)
+        self.assertTrue(0 < high < 1)
+
+    def test_expected_shares(self):
+        self.assertEqual(expected_shares([1, 3]), [0.25, 0.75])
+        self.assertRaises(ValueError, expected_shares, [0, 0])
+
+    def test_goodness_of_fit(self):
+        stat, dof, pvalue = chi_square_test([10, 20, 30], [1 / 3.0] * 3)
+        self.assertAlmostEqual(stat, 10.0)
+        self.assertEqual(dof, 2)
+        self.assertAlmostEqual(pvalue, 0.006737947, places=6)
+        stat, dof, pvalue = g_test([10, 20, 30], [1 / 3.0] * 3)
+        self.assertAlmostEqual(stat, 10.464962, places=5)
+        self.assertEqual(dof, 2)
+        # zero share paths are not tested
+        _, dof, _ = chi_square_test([10, 10, 0], [0.5, 0.5, 0])
+        self.assertEqual(dof, 1)
+
+    def test_goodness_of_fit_no_counts(self):
+        self.assertEqual(chi_square_test([0, 0, 0], [1 / 3.0] * 3),
+                         (0.0, 2, 1.0))
+        self.assertEqual(g_test([0, 0, 0], [1 / 3.0] * 3), (0.0, 2, 1.0))
+
+
+class LBAnalysisTest(unittest.TestCase):
+    """
+    Checks the LBAnalysis verdicts
+    """
+
+    def test_balanced(self):
+        analysis = LBAnalysis([340, 330, 330])
+        self.assertEqual(analysis.verdict, BALANCED)
+        self.assertTrue(analysis.balanced)
+        self.assertTrue(analysis.fits())
+
+    def test_skewed(self):
+        analysis = LBAnalysis([500, 500, 10])
+        self.assertEqual(analysis.verdict, UNBALANCED)
+        self.assertEqual(analysis.underloaded, [2])
+        self.assertFalse(analysis.balanced)
+        self.assertFalse(analysis.fits())
+
+    def test_undecided_is_not_balanced(self):
+        for counts in ([24, 25, 1], [24, 24, 2], [16, 16, 16, 2]):
+            analysis = LBAnalysis(counts)
+            self.assertNotEqual(analysis.verdict, BALANCED, counts)
+            self.assertFalse(analysis.balanced, counts)
+
+    def test_unused_path(self):
+        analysis = LBAnalysis([1000, 1000, 0])
+        self.assertEqual(analysis.verdict, UNBALANCED)
+        self.assertFalse(analysis.balanced)
+
+    def test_no_counts(self):
+        analysis = LBAnalysis([0, 0, 0])
+        self.assertEqual(analysis.verdict, UNBALANCED)
+        self.assertEqual(analysis.underloaded, [0, 1, 2])
+        self.assertFalse(analysis.balanced)
+        str(analysis)
+
+    def test_weighted(self):
+        self.assertEqual(LBAnalysis([250, 750], weights=[1, 3]).verdict,
+                         BALANCED)
+        self.assertEqual(LBAnalysis([500, 500, 0],
+                                    weights=[1, 1, 0]).verdict, BALANCED)
+        self.assertEqual(LBAnalysis([500, 490, 10],
+                                    weights=[1, 1, 0]).verdict, UNBALANCED)
+        self.assertRaises(ValueError, LBAnalysis, [1, 2], weights=[1])
+
+
+class HelpersTest(unittest.TestCase):
+    """
+    Checks the path helpers, the adaptive sampling and the polarisation
+    analysis
+    """
+
+    def test_single_path(self):
+        self.assertEqual(active_paths([0, 5, 0, 1]), 2)
+        self.assertTrue(single_path([0, 50, 0], 50))
+        self.assertTrue(single_path([0, 0, 0], 50))
+        self.assertFalse(single_path([0, 49, 0], 50))
+        self.assertFalse(single_path([25, 25, 0], 50))
+        self.assertTrue(single_path([0, 7, 0]))
+
+    def test_sample_schedule(self):
+        self.assertEqual(sample_schedule(100, 1000),
+                         [100, 200, 400, 800, 1000])
+        self.assertEqual(sample_schedule(2000, 1000), [1000])
+
+    def test_required_samples(self):
+        # larger for smaller shares and higher confidences
+        self.assertGreater(required_samples(0.25), required_samples(0.5))
+        self.assertGreater(required_samples(0.5, confidence=0.999),
+                           required_samples(0.5))
+
+    def sampler(self, pattern):
+        """
+        Returns a sample function sending the flows in turn to the paths
+        of pattern, and the list of the requested sample sizes
+        """
+        sizes = []
+        state = {'next': 0}
+
+        def sample(count):
+            sizes.append(count)
+            counts = [0] * (max(pattern) + 1)
+            for _ in range(count):
+                counts[pattern[state['next'] % len(pattern)]] += 1
+                state['next'] += 1
+            return counts
+        return sample, sizes
+
+    def test_adaptive_balanced(self):
+        sample, sizes = self.sampler([0, 1, 2])
+        analysis = adaptive_analysis(sample, 3, max_samples=10000)
+        self.assertEqual(analysis.verdict, BALANCED)
+        self.assertEqual(sum(analysis.counts), sum(sizes))
+        self.assertLess(sum(sizes), 10000)
+
+    def test_adaptive_unbalanced(self):
+        sample, _ = self.sampler([0] * 10 + [1] * 10 + [2])
+        analysis = adaptive_analysis(sample, 3, max_samples=10000)
+        self.assertEqual(analysis.verdict, UNBALANCED)
+        self.assertEqual(analysis.underloaded, [2])
+
+    def test_adaptive_max_samples(self):
+        sample, sizes = self.sampler([0, 1, 2])
+        analysis = adaptive_analysis(sample, 3, max_samples=10)
+        self.assertEqual(sum(sizes), 10)
+        self.assertFalse(analysis.balanced)
+
+    def test_polarisation(self):
+        polarised = Polarisation([[100, 0], [0, 100]])
+        self.assertTrue(polarised.polarised)
+        self.assertAlmostEqual(polarised.strength, 1.0)
+        self.assertEqual(polarised.active, [1, 1])
+        independent = Polarisation([[50, 50], [50, 50]])
+        self.assertFalse(independent.polarised)
+        self.assertAlmostEqual(independent.strength, 0.0)
+        self.assertFalse(Polarisation([[0, 0], [0, 0]]).polarised)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""
+Measure sai_thrift_get_switch_attribute() with the 15 switch resources
+attributes read by saveNumberOfAvaiableResources() at every test setUp
+and tearDown
+
+By default the RPC client is replaced by a local one, which returns the
+requested attributes without any communication, so that the numbers only
+reflect the sai_adapter attributes encoding and decoding. Use --server to
+measure whole RPCs instead. Example:
+
+    python benchmarks/get_switch_attribute.py --iterations 20000
+    python benchmarks/get_switch_attribute.py --server 127.0.0.1
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+from sai_thrift.ttypes import *
+import sai_thrift.sai_adapter as adapter
+
+THRIFT_PORT = 9092
+
+RESOURCES = dict(
+    available_ipv4_route_entry=True,
+    available_ipv6_route_entry=True,
+    available_ipv4_nexthop_entry=True,
+    available_ipv6_nexthop_entry=True,
+    available_ipv4_neighbor_entry=True,
+    available_ipv6_neighbor_entry=True,
+    available_next_hop_group_entry=True,
+    available_next_hop_group_member_entry=True,
+    available_fdb_entry=True,
+    available_ipmc_entry=True,
+    available_snat_entry=True,
+    available_dnat_entry=True,
+    available_double_nat_entry=True,
+    number_of_ecmp_groups=True,
+    ecmp_members=True)
+
+
+class LocalClient(object):
+    """
+    RPC client returning a value for every requested switch attribute
+    (all the resources attributes are u32)
+    """
+    def sai_thrift_get_switch_attribute(self, attr_list):
+        return sai_thrift_attribute_list_t(
+            attr_list=[sai_thrift_attribute_t(
+                id=attr.id, value=sai_thrift_attribute_value_t(u32=1000))
+                       for attr in attr_list.attr_list],
+            attr_count=len(attr_list.attr_list))
+
+
+def connect(server):
+    from thrift.transport import TSocket
+    from thrift.transport import TTransport
+    from thrift.protocol import TBinaryProtocol
+    from sai_thrift import sai_rpc
+
+    transport = TTransport.TBufferedTransport(
+        TSocket.TSocket(server, THRIFT_PORT))
+    transport.open()
+    return sai_rpc.Client(TBinaryProtocol.TBinaryProtocol(transport))
+
+
+def run(client, iterations):
+    start = time.time()
+    for _ in range(iterations):
+        attrs = adapter.sai_thrift_get_switch_attribute(client, **RESOURCES)
+    elapsed = time.time() - start
+    assert len(attrs) == 2 * len(RESOURCES), "missing attributes"
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--iterations", type=int, default=10000)
+    parser.add_argument("--server", help="RPC server address")
+    args = parser.parse_args()
+
+    client = connect(args.server) if args.server else LocalClient()
+    elapsed = run(client, args.iterations)
+    print("%d calls %8.3f s %8.1f us/call" % (
+        args.iterations, elapsed, elapsed / args.iterations * 10**6))
+
+
+if __name__ == "__main__":
+    main()